@@ -0,0 +1,170 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Synthetic packages and a stand-in Cloudify context for the benchmarks.
+#
+# A package is generated in a blueprint directory as package/ (or
+# package.zip) with files spread over subdirectories of FILES_PER_DIRECTORY
+# files. A fraction of the files are templates, the rest are plain text or
+# binary files. LatencyContext serves the resources from the blueprint
+# directory and sleeps before each request to simulate the round trip to
+# the manager.
+
+import os
+import time
+import shutil
+import zipfile
+
+import jinja2
+
+from cloudify.mocks import MockCloudifyContext
+
+PACKAGE_NAME = 'package'
+FILES_PER_DIRECTORY = 100
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+TEMPLATE_LINE = 'echo "{{ name }} {{ index }}"\n'
+TEXT_LINE = 'echo "plain text line of a script"\n'
+SCRIPT = 'echo {{ name }} > output\n'
+
+
+def _write_file(path, line, size):
+    # Content is a repeated line, so that files of any size are generated
+    # quickly and compress like scripts rather than random data.
+    chunk = (line * (WRITE_CHUNK_SIZE // len(line) + 1))[:WRITE_CHUNK_SIZE]
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(chunk[:remaining])
+            remaining -= len(chunk)
+
+
+def _write_binary_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(os.urandom(min(remaining, WRITE_CHUNK_SIZE)))
+            remaining -= WRITE_CHUNK_SIZE
+
+
+def generate_package(blueprint_directory,
+                     files,
+                     file_size,
+                     template_ratio=0.1,
+                     binary_ratio=0.0,
+                     layout='dir'):
+    """
+    Generate a package with an exec script and the given number of files.
+
+    :param files: Number of generated files besides the exec script
+    :param file_size: Size of each of the files in bytes
+    :param template_ratio: Fraction of the files, which are templates
+    :param binary_ratio: Fraction of the files, which are binary
+    :param layout: 'dir' for a directory, 'zip' for a ZIP archive
+    :return: Tuple (resource_dir, resource_list) of the package
+    """
+    package_directory = os.path.join(blueprint_directory, PACKAGE_NAME)
+    os.makedirs(package_directory)
+    with open(os.path.join(package_directory, 'exec'), 'w') as f:
+        f.write(SCRIPT)
+
+    templates = int(files * template_ratio)
+    binaries = int(files * binary_ratio)
+    resource_list = ['exec']
+    for index in range(files):
+        directory = 'dir{0:05d}'.format(index // FILES_PER_DIRECTORY)
+        if index % FILES_PER_DIRECTORY == 0:
+            os.makedirs(os.path.join(package_directory, directory))
+        path = os.path.join(directory, 'file{0:06d}'.format(index))
+        if index < templates:
+            _write_file(
+                os.path.join(package_directory, path),
+                TEMPLATE_LINE, file_size)
+            resource_list.append(path)
+        elif index < templates + binaries:
+            _write_binary_file(
+                os.path.join(package_directory, path), file_size)
+        else:
+            _write_file(
+                os.path.join(package_directory, path),
+                TEXT_LINE, file_size)
+
+    if layout == 'dir':
+        return PACKAGE_NAME, resource_list
+
+    with zipfile.ZipFile(os.path.join(
+            blueprint_directory, PACKAGE_NAME + '.zip'), 'w',
+            zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+        for root, _, filenames in os.walk(package_directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                archive.write(
+                    path, os.path.relpath(path, package_directory))
+    shutil.rmtree(package_directory)
+    return PACKAGE_NAME + '.zip', resource_list
+
+
+class LatencyContext(MockCloudifyContext):
+    """
+    Context, which serves resources from a local blueprint directory
+    with a fixed latency per request, like the Cloudify context does
+    from the file server of the manager.
+    """
+
+    def __init__(self, blueprint_directory, latency=0.0, **kwargs):
+        super(LatencyContext, self).__init__(**kwargs)
+        self.blueprint_directory = blueprint_directory
+        self.latency = latency
+        self.requests = 0
+
+    def _open_resource(self, resource_path):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return open(
+            os.path.join(self.blueprint_directory, resource_path), 'rb')
+
+    def get_resource(self, resource_path):
+        with self._open_resource(resource_path) as f:
+            return f.read()
+
+    def get_resource_version(self, resource_path):
+        """
+        Stand-in for transfer.get_resource_version, which asks the file
+        server of the manager with a HEAD request.
+        """
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        path = os.path.join(self.blueprint_directory, resource_path)
+        return path, str(os.path.getmtime(path))
+
+    def download_resource(self, resource_path, target_path=None):
+        with self._open_resource(resource_path) as source:
+            with open(target_path, 'wb') as target:
+                shutil.copyfileobj(source, target, WRITE_CHUNK_SIZE)
+        return target_path
+
+    def download_resource_and_render(self,
+                                     resource_path,
+                                     target_path=None,
+                                     template_variables=None):
+        # The Cloudify context compiles each template it renders.
+        template_variables = dict(template_variables or {}, ctx=self)
+        rendered = jinja2.Template(
+            self.get_resource(resource_path)).render(template_variables)
+        with open(target_path, 'wb') as target:
+            target.write(rendered.encode('utf-8'))
+        return target_path
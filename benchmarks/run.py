@@ -0,0 +1,271 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Benchmarks of package staging and execution.
+#
+# Run from the root of the repository, e.g.:
+#   python -m benchmarks.run --files 1,1000,50000 --sizes 1K,1M \
+#       --layouts dir,zip --variants default,render_locally \
+#       --latency 0.005 --output results.json
+#
+# For every combination of the parameters a synthetic package is generated
+# and staged (target "package", get_package_dir) or staged and executed
+# (target "execute", execute) several times. The first run is cold, the
+# following runs reuse extracted archives and, for the incremental and cache
+# variants, the working directory or the cache. Results are written as JSON.
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+from cloudify.state import current_ctx
+
+from exec_plugin import tasks, transfer
+from exec_plugin.metrics import Metrics
+
+from .fixtures import generate_package, LatencyContext
+
+# Options of resource_config of each variant. The cache directory is filled
+# in for each scenario. Resources, which are available in the deployment
+# directory, are copied from it by default, so the variants measuring
+# downloads (remote, cache) download them.
+VARIANTS = {
+    'default': {},
+    'serial': {'download_workers': 1},
+    'render_locally': {'render_locally': True},
+    'stream_archives': {'stream_archives': True},
+    'incremental': {'incremental': True},
+    'cache': {
+        'resource_cache': {'enabled': True},
+        'local_resources': 'download'
+    },
+    'no_detection': {'template_filter': {'detect': False}},
+    'local_link': {'local_resources': 'link'},
+    'remote': {'local_resources': 'download'}
+}
+
+# Variants, which keep the working directory between the runs.
+PERSISTENT_VARIANTS = ('incremental',)
+
+TARGETS = ('package', 'execute')
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def parse_list(value, parse=str):
+    return [parse(item) for item in value.split(',') if item.strip()]
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    }
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_once(ctx, target, resource_config, working_directory):
+    ctx.instance.runtime_properties['current_working_directory'] = \
+        working_directory
+    ctx.requests = 0
+    start = time.time()
+    if target == 'package':
+        metrics = Metrics()
+        tasks.get_package_dir(
+            metrics=metrics,
+            **tasks.parse_resource_config(resource_config))
+        report = metrics.report()
+    else:
+        tasks.execute(resource_config, store_metrics=True)
+        report = ctx.instance.runtime_properties['exec_metrics']
+    return time.time() - start, ctx.requests, report
+
+
+def run_scenario(scenario, variants, targets, latency, repeat):
+    get_resource_version = transfer.get_resource_version
+    directory = tempfile.mkdtemp(prefix='exec-benchmark-')
+    try:
+        blueprint_directory = os.path.join(directory, 'blueprint')
+        os.makedirs(blueprint_directory)
+        start = time.time()
+        resource_dir, resource_list = generate_package(
+            blueprint_directory, **scenario)
+        generation_seconds = time.time() - start
+
+        ctx = LatencyContext(
+            blueprint_directory,
+            latency,
+            node_id='benchmark',
+            properties={'resource_config': {}})
+        logging.getLogger(ctx.logger.name).setLevel(logging.WARNING)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            blueprint_directory
+        current_ctx.set(ctx)
+        # There is no file server to version the cached resources.
+        transfer.get_resource_version = ctx.get_resource_version
+
+        results = []
+        for variant in variants:
+            resource_config = dict(
+                VARIANTS[variant],
+                resource_dir=resource_dir,
+                resource_list=resource_list,
+                template_variables={'name': 'benchmark', 'index': 0})
+            # Workspaces and partial downloads of the benchmark are kept
+            # apart from these of the agent, so that their garbage
+            # collection never touches the real ones.
+            resource_config['workspace'] = {
+                'root': os.path.join(directory, 'workspaces')}
+            resource_config['transfer'] = {
+                'directory': os.path.join(directory, 'partial')}
+            if 'resource_cache' in resource_config:
+                resource_config['resource_cache'] = dict(
+                    resource_config['resource_cache'],
+                    directory=os.path.join(directory, 'cache', variant))
+            for target in targets:
+                runs = []
+                working_directory = tempfile.mkdtemp(dir=directory)
+                for _ in range(repeat):
+                    if variant not in PERSISTENT_VARIANTS:
+                        working_directory = tempfile.mkdtemp(dir=directory)
+                    runs.append(run_once(
+                        ctx, target, resource_config, working_directory))
+                seconds = [run[0] for run in runs]
+                results.append(dict(
+                    scenario,
+                    variant=variant,
+                    target=target,
+                    latency=latency,
+                    generation_seconds=round(generation_seconds, 6),
+                    runs=[round(run, 6) for run in seconds],
+                    cold=round(seconds[0], 6),
+                    warm=round(median(seconds[1:]), 6)
+                    if len(seconds) > 1 else None,
+                    requests=runs[-1][1],
+                    metrics=runs[-1][2]))
+                logging.info(
+                    '%s %s %s: cold %.3fs',
+                    json.dumps(scenario, sort_keys=True),
+                    variant, target, seconds[0])
+        return results
+    finally:
+        transfer.get_resource_version = get_resource_version
+        current_ctx.clear()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark staging and execution of packages.')
+    parser.add_argument(
+        '--files', default='1,100,1000',
+        help='Comma separated numbers of files in a package.')
+    parser.add_argument(
+        '--sizes', default='1K',
+        help='Comma separated sizes of files, with K, M or G suffixes.')
+    parser.add_argument(
+        '--layouts', default='dir,zip',
+        help='Comma separated layouts of packages: dir, zip.')
+    parser.add_argument(
+        '--template-ratio', type=float, default=0.1,
+        help='Fraction of files, which are templates.')
+    parser.add_argument(
+        '--binary-ratio', type=float, default=0.0,
+        help='Fraction of files, which are binary.')
+    parser.add_argument(
+        '--variants', default='default,remote',
+        help='Comma separated variants: {0}.'.format(
+            ', '.join(sorted(VARIANTS))))
+    parser.add_argument(
+        '--targets', default=','.join(TARGETS),
+        help='Comma separated targets: package, execute.')
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help='Latency of each resource request in seconds.')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of runs of each benchmark.')
+    parser.add_argument(
+        '--output', default='-',
+        help='Path of the JSON results, "-" for standard output.')
+    args = parser.parse_args(argv)
+
+    variants = parse_list(args.variants)
+    targets = parse_list(args.targets)
+    unknown = set(variants) - set(VARIANTS) | set(targets) - set(TARGETS)
+    if unknown:
+        parser.error('Unknown variants or targets: {0}'.format(
+            ', '.join(sorted(unknown))))
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(message)s')
+
+    results = []
+    for layout in parse_list(args.layouts):
+        for size in parse_list(args.sizes, parse_size):
+            for files in parse_list(args.files, int):
+                results.extend(run_scenario(
+                    {
+                        'files': files,
+                        'file_size': size,
+                        'template_ratio': args.template_ratio,
+                        'binary_ratio': args.binary_ratio,
+                        'layout': layout
+                    },
+                    variants, targets, args.latency, args.repeat))
+
+    document = json.dumps(
+        {'environment': get_environment(), 'results': results},
+        indent=2, sort_keys=True)
+    if args.output == '-':
+        sys.stdout.write(document + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(document + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Content-addressed cache of downloaded resources.
+#
+# The cache lives on the agent and consists of two directories:
+#   * objects - files named after the SHA-256 of their content,
+#   * keys - small files named after a hash of the version of the resource
+#     on the file server (its URL and ETag or Last-Modified), containing
+#     the name of the object.
+# A resource, which didn't change since the last download, is found by its
+# key and placed in the working directory by reflink or copy, so that it
+# doesn't have to be downloaded again. Objects are evicted in the least
+# recently used order once the cache exceeds its maximum size.
+
+import os
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), 'cloudify-exec-cache')
+DEFAULT_CACHE_MAX_SIZE = 1024 ** 3
+CHUNK_SIZE = 1024 * 1024
+
+# ioctl request number of FICLONE from linux/fs.h.
+FICLONE = 0x40049409
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _objects_directory(cache_directory):
+    return os.path.join(cache_directory, 'objects')
+
+
+def _keys_directory(cache_directory):
+    return os.path.join(cache_directory, 'keys')
+
+
+def get_cache_key(source_path):
+    """
+    :param source_path: Absolute path of a resource on the local file system
+    :return: String object identifying the current version of the resource
+        or None, if the resource is not available locally
+    """
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return None
+    return hashlib.sha1('{0}:{1}:{2}'.format(
+        os.path.abspath(source_path),
+        stat.st_size,
+        stat.st_mtime)).hexdigest()
+
+
+def get_resource_key(*parts):
+    """
+    :param parts: Strings identifying a version of a resource, which is
+        not available locally, e.g. its URL and its ETag
+    :return: Cache key of the resource
+    """
+    return hashlib.sha1('\n'.join(
+        part.encode('utf-8') if isinstance(part, unicode) else str(part)
+        for part in parts)).hexdigest()
+
+
+def get_content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_same_file_system(source, target):
+    """
+    :return: True if a file at the target path would be on the same file
+        system as the source, so that it can be hard linked
+    """
+    try:
+        return os.stat(source).st_dev == \
+            os.stat(os.path.dirname(os.path.abspath(target))).st_dev
+    except OSError:
+        return False
+
+
+def clone_file(source, target, allow_link=True):
+    """
+    Place a file from the cache or the local file system at the target
+    path. It tries a reflink first, then a hard link (if allow_link is True
+    and both paths are on the same file system) and finally falls back to
+    a regular copy.
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(source, target)
+        return
+    except (IOError, OSError):
+        if os.path.lexists(target):
+            os.remove(target)
+    if allow_link and is_same_file_system(source, target):
+        try:
+            os.link(source, target)
+            return
+        except OSError:
+            pass
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    shutil.copystat(source, target)
+
+
+def lookup(cache_directory, cache_key):
+    """
+    :return: Path of the cached object or None in case of cache miss
+    """
+    try:
+        with open(os.path.join(
+                _keys_directory(cache_directory), cache_key)) as f:
+            object_path = os.path.join(
+                _objects_directory(cache_directory), f.read().strip())
+        # Mark the object as recently used.
+        os.utime(object_path, None)
+    except (IOError, OSError):
+        return None
+    return object_path
+
+
+def store(cache_directory, cache_key, path):
+    """
+    Add a downloaded file to the cache. Both the object and the key are
+    written to temporary files first and renamed, so concurrent operations
+    never see partially written entries.
+    """
+    objects_directory = _objects_directory(cache_directory)
+    keys_directory = _keys_directory(cache_directory)
+    _makedirs(objects_directory)
+    _makedirs(keys_directory)
+
+    content_hash = get_content_hash(path)
+    object_path = os.path.join(objects_directory, content_hash)
+    if not os.path.exists(object_path):
+        fd, tmp_object_path = tempfile.mkstemp(dir=objects_directory)
+        os.close(fd)
+        shutil.copy2(path, tmp_object_path)
+        os.rename(tmp_object_path, object_path)
+
+    fd, tmp_key_path = tempfile.mkstemp(dir=keys_directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(content_hash)
+    os.rename(tmp_key_path, os.path.join(keys_directory, cache_key))
+    return object_path
+
+
+def evict(cache_directory, max_size):
+    """
+    Remove the least recently used objects until the cache fits in max_size
+    bytes and drop the keys, which point to removed objects.
+    """
+    objects_directory = _objects_directory(cache_directory)
+    keys_directory = _keys_directory(cache_directory)
+    if not os.path.isdir(objects_directory):
+        return
+
+    objects = []
+    for name in os.listdir(objects_directory):
+        try:
+            stat = os.stat(os.path.join(objects_directory, name))
+        except OSError:
+            continue
+        objects.append((stat.st_mtime, stat.st_size, name))
+
+    total_size = sum(size for _, size, _ in objects)
+    removed = set()
+    for _, size, name in sorted(objects):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(objects_directory, name))
+        except OSError:
+            continue
+        total_size -= size
+        removed.add(name)
+
+    if not removed or not os.path.isdir(keys_directory):
+        return
+    for name in os.listdir(keys_directory):
+        key_path = os.path.join(keys_directory, name)
+        try:
+            with open(key_path) as f:
+                if f.read().strip() in removed:
+                    os.remove(key_path)
+        except (IOError, OSError):
+            continue
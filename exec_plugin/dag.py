@@ -0,0 +1,149 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Scheduling of steps, which depend on each other.
+#
+# Steps form a directed acyclic graph by the ids in their depends_on. They
+# are started in the topological order (ties are broken by the order of
+# the list) as soon as all of their dependencies succeeded, by a pool of at
+# most workers threads. The results are collected in the thread, which
+# schedules the steps, so it is the only one changing the state. A step,
+# which depends on a failed or skipped step, is skipped. With the fail_fast
+# policy no new steps are started after a step fails, the running ones are
+# left to finish. With the continue policy, independent steps still run.
+
+import Queue
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_WORKERS = 4
+
+POLICY_FAIL_FAST = 'fail_fast'
+POLICY_CONTINUE = 'continue'
+POLICIES = (POLICY_FAIL_FAST, POLICY_CONTINUE)
+
+STATUS_SUCCEEDED = 'succeeded'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+
+
+class InvalidSteps(Exception):
+    """ The steps don't form a directed acyclic graph. """
+
+
+def get_order(steps):
+    """
+    :param steps: List of dicts with keys: id and depends_on (list of ids)
+    :return: List of the ids in a topological order, which keeps the order
+        of the list where possible
+    :raises: InvalidSteps
+    """
+    ids = [step['id'] for step in steps]
+    if len(set(ids)) != len(ids):
+        raise InvalidSteps('Ids of steps are not unique.')
+    dependencies = {}
+    for step in steps:
+        unknown = set(step.get('depends_on', [])) - set(ids)
+        if unknown:
+            raise InvalidSteps('Step {0} depends on unknown steps: {1}'.format(
+                step['id'], ', '.join(sorted(unknown))))
+        dependencies[step['id']] = set(step.get('depends_on', []))
+
+    order = []
+    done = set()
+    while len(order) < len(ids):
+        ready = [step_id for step_id in ids
+                 if step_id not in done and dependencies[step_id] <= done]
+        if not ready:
+            raise InvalidSteps('Steps depend on each other in a cycle: '
+                               '{0}'.format(', '.join(
+                                   step_id for step_id in ids
+                                   if step_id not in done)))
+        order.extend(ready)
+        done.update(ready)
+    return order
+
+
+def _run(run_step, step):
+    # Exceptions are turned into results, so that the scheduler always gets
+    # one for each started step.
+    try:
+        result = run_step(step)
+    except Exception as e:
+        result = {'returncode': None, 'stderr': str(e), 'timed_out': False}
+    failed = result['returncode'] != 0 or result['timed_out']
+    result['status'] = STATUS_FAILED if failed else STATUS_SUCCEEDED
+    return step['id'], result
+
+
+def run_steps(steps,
+              run_step,
+              workers=DEFAULT_WORKERS,
+              policy=POLICY_FAIL_FAST,
+              initializer=None,
+              initargs=()):
+    """
+    Run steps in the order of their dependencies, concurrently where they
+    don't depend on each other.
+
+    :param run_step: Function called with a step in a thread of the pool,
+        which returns a dict with keys: returncode, stderr and timed_out
+    :param initializer: Function called with initargs in each thread of
+        the pool
+    :return: Dict mapping the ids of the steps to their results with the
+        status added, steps, which didn't run, have status skipped
+    :raises: InvalidSteps
+    """
+    order = get_order(steps)
+    steps = dict((step['id'], step) for step in steps)
+    results = {}
+    if not order:
+        return results
+
+    finished = Queue.Queue()
+    pending = list(order)
+    running = 0
+    failed = False
+    pool = ThreadPool(min(workers, len(order)), initializer, initargs)
+    try:
+        while pending or running:
+            for step_id in list(pending):
+                statuses = [
+                    results[dependency]['status']
+                    if dependency in results else None
+                    for dependency in steps[step_id].get('depends_on', [])]
+                if (failed and policy == POLICY_FAIL_FAST) or \
+                        STATUS_FAILED in statuses or \
+                        STATUS_SKIPPED in statuses:
+                    pending.remove(step_id)
+                    results[step_id] = {
+                        'returncode': None, 'stderr': '', 'timed_out': False,
+                        'status': STATUS_SKIPPED}
+                elif running < workers and all(
+                        status == STATUS_SUCCEEDED for status in statuses):
+                    pending.remove(step_id)
+                    running += 1
+                    pool.apply_async(
+                        _run, (run_step, steps[step_id]),
+                        callback=finished.put)
+            if running:
+                step_id, result = finished.get()
+                running -= 1
+                results[step_id] = result
+                if result['status'] == STATUS_FAILED:
+                    failed = True
+    finally:
+        pool.close()
+        pool.join()
+    return results
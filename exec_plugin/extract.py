@@ -0,0 +1,189 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Extraction of ZIP archives.
+#
+# The members are planned from the central directory of the archive, which
+# is read without decompressing anything: the number of members, their
+# total declared size and the compression ratio of each of them are checked
+# against the limits first, so that an archive, which would fill the disk,
+# is rejected before anything is written. Directories are created up front
+# and files are decompressed by a pool of threads (zlib releases the GIL),
+# each reading the archive through its own file object and writing in
+# chunks of CHUNK_SIZE, so the memory used doesn't depend on the size of
+# the members. A member, which decompresses to more than its declared size,
+# is rejected as well. Paths of members are sanitized like
+# ZipFile.extractall does.
+
+import os
+import errno
+import zipfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Decompression is bound by the CPU, so there is no point in more threads
+# than processors.
+DEFAULT_WORKERS = min(4, multiprocessing.cpu_count())
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+DEFAULT_MAX_MEMBERS = 100000
+DEFAULT_MAX_RATIO = 200
+CHUNK_SIZE = 1024 * 1024
+
+# Smaller archives are extracted by a single thread, since starting
+# a pool of threads takes longer than extracting them.
+PARALLEL_MIN_MEMBERS = 64
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+
+
+class ArchiveLimitExceeded(Exception):
+    """ The archive exceeds the limits of extraction. """
+
+
+def get_member_path(member, target_directory):
+    """
+    :return: Path of a member in target_directory, sanitized like
+        ZipFile.extractall does, or None if nothing is left of it
+    """
+    filename = member.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        filename = filename.replace(os.path.altsep, os.path.sep)
+    filename = os.path.splitdrive(filename)[1]
+    components = [
+        component for component in filename.split(os.path.sep)
+        if component not in ('', os.path.curdir, os.path.pardir)]
+    if not components:
+        return None
+    return os.path.join(target_directory, *components)
+
+
+def plan_extraction(archive, target_directory, limits=None):
+    """
+    :param archive: zipfile.ZipFile object
+    :param limits: Dict with keys: max_size (total uncompressed bytes),
+        max_members and max_ratio (of uncompressed to compressed size of
+        a member)
+    :return: Tuple (directories, files), where files is a list of tuples
+        (member, path)
+    :raises: ArchiveLimitExceeded
+    """
+    limits = limits or {}
+    max_size = limits.get('max_size', DEFAULT_MAX_SIZE)
+    max_members = limits.get('max_members', DEFAULT_MAX_MEMBERS)
+    max_ratio = limits.get('max_ratio', DEFAULT_MAX_RATIO)
+
+    members = archive.infolist()
+    if max_members and len(members) > max_members:
+        raise ArchiveLimitExceeded(
+            '{0} members, the limit is {1}.'.format(
+                len(members), max_members))
+
+    directories = set([target_directory])
+    files = []
+    total_size = 0
+    for member in members:
+        path = get_member_path(member, target_directory)
+        if not path:
+            continue
+        if member.filename.endswith('/'):
+            directories.add(path)
+            continue
+        total_size += member.file_size
+        if max_ratio and member.file_size > CHUNK_SIZE and \
+                member.file_size > max_ratio * max(member.compress_size, 1):
+            raise ArchiveLimitExceeded(
+                '{0} is compressed {1} times, the limit is {2}.'.format(
+                    member.filename,
+                    member.file_size // max(member.compress_size, 1),
+                    max_ratio))
+        directories.add(os.path.dirname(path))
+        files.append((member, path))
+    if max_size and total_size > max_size:
+        raise ArchiveLimitExceeded(
+            '{0} bytes uncompressed, the limit is {1}.'.format(
+                total_size, max_size))
+    return sorted(directories), files
+
+
+def extract_member(archive, member, path):
+    """
+    Write a member to path in chunks.
+
+    :raises: ArchiveLimitExceeded if it decompresses to more bytes than
+        its declared size
+    """
+    written = 0
+    with archive.open(member) as source, open(path, 'wb') as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            written += len(chunk)
+            if written > member.file_size:
+                raise ArchiveLimitExceeded(
+                    '{0} is larger than its declared size {1}.'.format(
+                        member.filename, member.file_size))
+            target.write(chunk)
+
+
+def _extract_members(archive_path, files, workers):
+    # Each of the threads reads the archive with its own ZipFile object,
+    # since a ZipFile can't be read by several threads at once.
+    archives = []
+    local = threading.local()
+
+    def extract(item):
+        archive = getattr(local, 'archive', None)
+        if archive is None:
+            archive = local.archive = zipfile.ZipFile(archive_path)
+            archives.append(archive)
+        extract_member(archive, *item)
+
+    pool = ThreadPool(workers)
+    try:
+        pool.map(extract, files)
+    finally:
+        pool.close()
+        pool.join()
+        for archive in archives:
+            archive.close()
+
+
+def extract_archive(archive, archive_path, target_directory, settings=None):
+    """
+    Extract all of the members of an archive to target_directory.
+
+    :param archive: zipfile.ZipFile object of the archive at archive_path
+    :param settings: Dict with the limits (see plan_extraction) and workers,
+        the number of threads
+    :return: Tuple (files, size), the number of extracted files and their
+        total uncompressed size
+    :raises: ArchiveLimitExceeded
+    """
+    settings = settings or {}
+    workers = settings.get('workers', DEFAULT_WORKERS)
+    directories, files = plan_extraction(archive, target_directory, settings)
+    for directory in directories:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    total_size = sum(member.file_size for member, _ in files)
+    if workers > 1 and (len(files) >= PARALLEL_MIN_MEMBERS or
+                        total_size >= PARALLEL_MIN_SIZE):
+        _extract_members(
+            archive_path, files, min(workers, len(files)))
+    else:
+        for member, path in files:
+            extract_member(archive, member, path)
+    return len(files), total_size
@@ -0,0 +1,214 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Lazy staging of packages.
+#
+# Only directories and the resources matching the eager globs are staged
+# before the script runs. The other resources are listed in LAZY_MANIFEST
+# and fetched on demand: the script calls the FETCH_HELPER (its path is in
+# the EXEC_FETCH environment variable) with paths of files or directories
+# and the helper asks the FetchServer of the operation over a Unix socket
+# (EXEC_FETCH_SOCKET) to stage them. The list, the helper and the socket are
+# kept in a temporary directory of the FetchServer, outside of the working
+# directory, so they never replace files of the package.
+
+import os
+import json
+import socket
+import shutil
+import fnmatch
+import tempfile
+import threading
+from collections import OrderedDict
+
+from cloudify.state import current_ctx
+
+LAZY_MANIFEST = '.exec_lazy_manifest.json'
+FETCH_HELPER = 'exec-fetch'
+ACCEPT_INTERVAL = 0.5
+
+HELPER_SOURCE = '''#!{python}
+# Fetch resources of the package, which were not staged yet.
+# Usage: {helper} PATH... | --list
+import os
+import sys
+import json
+import socket
+
+
+def main(paths):
+    if not paths or paths[0] in ('-h', '--help'):
+        sys.stdout.write('Usage: {helper} PATH... | --list\\n')
+        return 0 if paths else 1
+    if paths == ['--list']:
+        with open({manifest!r}) as f:
+            for path in json.load(f):
+                sys.stdout.write(path + '\\n')
+        return 0
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(os.environ['EXEC_FETCH_SOCKET'])
+    client.sendall(json.dumps(
+        {{'paths': [os.path.abspath(path) for path in paths]}}
+    ).encode('utf-8') + b'\\n')
+    response = json.loads(client.makefile('rb').readline().decode('utf-8'))
+    for error in response['errors']:
+        sys.stderr.write(error + '\\n')
+    return 1 if response['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
+'''
+
+
+def split_manifest(manifest, eager, directory_kind):
+    """
+    :param eager: List of globs matched against paths in the working
+        directory
+    :return: Tuple of manifests (eager, lazy). Directories are always eager.
+    """
+    eager_manifest = OrderedDict()
+    lazy_manifest = OrderedDict()
+    for relative_path, entry in manifest.iteritems():
+        if entry['kind'] == directory_kind or any(
+                fnmatch.fnmatch(relative_path, pattern) for pattern in eager):
+            eager_manifest[relative_path] = entry
+        else:
+            lazy_manifest[relative_path] = entry
+    return eager_manifest, lazy_manifest
+
+
+def install_helper(directory, lazy_manifest, python):
+    """
+    Write the list of lazy resources and the fetch helper to directory,
+    which must not be the working directory.
+
+    :return: Path of the helper
+    """
+    manifest_path = os.path.join(directory, LAZY_MANIFEST)
+    with open(manifest_path, 'w') as f:
+        json.dump(list(lazy_manifest), f, indent=2)
+    helper_path = os.path.join(directory, FETCH_HELPER)
+    with open(helper_path, 'w') as f:
+        f.write(HELPER_SOURCE.format(
+            python=python, helper=FETCH_HELPER, manifest=manifest_path))
+    os.chmod(helper_path, 0755)
+    return helper_path
+
+
+class FetchServer(object):
+    """
+    Serve fetch requests of the script of an operation.
+
+    :param fetch: Function called with a manifest of the requested
+        resources, which stages them or raises an exception
+    """
+
+    def __init__(self, working_directory, lazy_manifest, fetch):
+        self.working_directory = working_directory
+        self.lazy_manifest = lazy_manifest
+        self.fetch = fetch
+        self.fetched = set()
+        self.socket_directory = None
+        self.socket_path = None
+        self._server = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._ctx = current_ctx.get_ctx()
+
+    def start(self):
+        self.socket_directory = tempfile.mkdtemp(prefix='exec-fetch-')
+        self.socket_path = os.path.join(self.socket_directory, 'socket')
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen(16)
+        self._server.settimeout(ACCEPT_INTERVAL)
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        if self._server:
+            self._server.close()
+        if self.socket_directory:
+            shutil.rmtree(self.socket_directory, ignore_errors=True)
+
+    def get_environment(self, helper_path):
+        return {
+            'EXEC_FETCH': helper_path,
+            'EXEC_FETCH_SOCKET': self.socket_path
+        }
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            try:
+                connection, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            connection.settimeout(None)
+            handler = threading.Thread(
+                target=self._handle, args=(connection,))
+            handler.daemon = True
+            handler.start()
+
+    def _handle(self, connection):
+        current_ctx.set(self._ctx)
+        try:
+            request = json.loads(connection.makefile('rb').readline())
+            errors = self.fetch_paths(request.get('paths', []))
+            connection.sendall(json.dumps({'errors': errors}) + '\n')
+        except Exception as e:
+            connection.sendall(json.dumps({'errors': [str(e)]}) + '\n')
+        finally:
+            connection.close()
+
+    def fetch_paths(self, paths):
+        """
+        Stage the resources at the given paths or under them, unless they
+        were already staged.
+
+        :return: List of errors
+        """
+        errors = []
+        requested = OrderedDict()
+        for path in paths:
+            relative_path = os.path.relpath(path, self.working_directory)
+            matched = [
+                lazy_path for lazy_path in self.lazy_manifest
+                if lazy_path == relative_path or
+                relative_path == os.curdir or
+                lazy_path.startswith(relative_path.rstrip('/') + '/')]
+            if not matched and not os.path.exists(path):
+                errors.append('{0}: not a part of the package'.format(path))
+            for lazy_path in matched:
+                requested[lazy_path] = self.lazy_manifest[lazy_path]
+        # Requests are staged one at a time, so that concurrent requests
+        # for the same resource stage it only once.
+        with self._lock:
+            pending = OrderedDict(
+                (lazy_path, entry) for lazy_path, entry
+                in requested.iteritems() if lazy_path not in self.fetched)
+            if pending:
+                try:
+                    self.fetch(pending)
+                except Exception as e:
+                    errors.append(str(e))
+                else:
+                    self.fetched.update(pending)
+        return errors
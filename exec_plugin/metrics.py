@@ -0,0 +1,113 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Timing instrumentation of the phases of an operation.
+#
+# A Metrics object collects wall time, number of files and number of bytes
+# of each phase (extraction of archives, walking directories, staging of
+# resources, running the script...) and the slowest files. Per-file phases
+# (download and render) are measured in each of the worker threads, so their
+# time is the sum of the times of the files, not wall time. When metrics are
+# not collected, NULL_METRICS is used, which doesn't measure anything.
+
+import time
+import heapq
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+DEFAULT_SLOWEST_FILES = 10
+
+
+class Metrics(object):
+
+    enabled = True
+
+    def __init__(self, slowest_files=DEFAULT_SLOWEST_FILES):
+        self._lock = threading.Lock()
+        self._phases = OrderedDict()
+        self._slowest_files = []
+        self._max_slowest_files = slowest_files
+        self._start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def add(self, name, seconds=0, files=0, size=0):
+        with self._lock:
+            phase = self._phases.setdefault(
+                name, {'seconds': 0, 'files': 0, 'bytes': 0})
+            phase['seconds'] += seconds
+            phase['files'] += files
+            phase['bytes'] += size
+
+    def record_file(self, name, path, seconds, size):
+        self.add(name, seconds, 1, size)
+        with self._lock:
+            item = (seconds, path, name, size)
+            if len(self._slowest_files) < self._max_slowest_files:
+                heapq.heappush(self._slowest_files, item)
+            else:
+                heapq.heappushpop(self._slowest_files, item)
+
+    def report(self):
+        """
+        :return: Dict, which can be serialized to JSON, with keys: phases,
+            slowest_files and seconds (wall time since the creation)
+        """
+        with self._lock:
+            phases = OrderedDict(
+                (name, dict(phase, seconds=round(phase['seconds'], 6)))
+                for name, phase in self._phases.iteritems())
+            slowest_files = [
+                {
+                    'path': path,
+                    'phase': name,
+                    'seconds': round(seconds, 6),
+                    'bytes': size
+                }
+                for seconds, path, name, size
+                in sorted(self._slowest_files, reverse=True)]
+        return {
+            'phases': phases,
+            'slowest_files': slowest_files,
+            'seconds': round(time.time() - self._start, 6)
+        }
+
+
+class NullMetrics(object):
+
+    enabled = False
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def add(self, name, seconds=0, files=0, size=0):
+        pass
+
+    def record_file(self, name, path, seconds, size):
+        pass
+
+    def report(self):
+        return None
+
+
+NULL_METRICS = NullMetrics()
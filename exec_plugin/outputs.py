@@ -0,0 +1,96 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Structured outputs of scripts.
+#
+# The path of an empty file is exported to the script in the EXEC_OUTPUTS
+# variable. The script appends lines to it, either key=value (the value is
+# a string) or a JSON object, which keys are merged. Later lines replace
+# the keys of earlier ones. After the script succeeds, the file is read line
+# by line and the outputs are applied to the runtime properties at once,
+# instead of the script calling ctx once for each of them. Keys reserved by
+# the plugin are rejected.
+
+import os
+import json
+import tempfile
+
+OUTPUTS_VARIABLE = 'EXEC_OUTPUTS'
+DEFAULT_MAX_SIZE = 1024 * 1024
+
+
+class InvalidOutputs(Exception):
+    """ The outputs of a script can't be parsed. """
+
+
+def create_outputs_file():
+    """
+    :return: Path of a new empty file for the outputs of a script
+    """
+    descriptor, path = tempfile.mkstemp(prefix='exec-outputs-')
+    os.close(descriptor)
+    return path
+
+
+def remove_outputs_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def read_outputs(path, max_size=DEFAULT_MAX_SIZE, reserved=()):
+    """
+    :param reserved: Keys, which the outputs must not contain
+    :return: Dict of the outputs written to the file at path
+    :raises: InvalidOutputs if a line is neither key=value nor a JSON
+        object, if the file is larger than max_size bytes or if it sets
+        a reserved key
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return {}
+    if max_size and size > max_size:
+        raise InvalidOutputs('{0} bytes of outputs, the limit is {1}.'.format(
+            size, max_size))
+
+    outputs = {}
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            if line.lstrip().startswith('{'):
+                try:
+                    value = json.loads(line)
+                except ValueError as e:
+                    raise InvalidOutputs('Line {0}: {1}'.format(number, e))
+                if not isinstance(value, dict):
+                    raise InvalidOutputs(
+                        'Line {0}: not a JSON object.'.format(number))
+                outputs.update(value)
+            elif '=' in line:
+                key, value = line.split('=', 1)
+                outputs[key.strip()] = value
+            else:
+                raise InvalidOutputs(
+                    'Line {0}: neither key=value nor a JSON object.'.format(
+                        number))
+    invalid = set(outputs) & set(reserved)
+    if invalid:
+        raise InvalidOutputs('Reserved keys: {0}'.format(
+            ', '.join(sorted(invalid))))
+    return outputs
@@ -0,0 +1,101 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Local rendering of templates, which are not downloaded through
+# ctx.download_resource_and_render. It follows the same rules as the
+# Cloudify context: the context is available in templates as "ctx".
+#
+# Compiled templates are kept in a process-wide LRU cache keyed by a hash of
+# their source, so a template rendered many times (e.g. once per batch item
+# or on every operation of a long-lived agent) is parsed only once. Each
+# render reports whether it hit the cache, so that operations count their
+# own hits and misses. The statistics of the cache itself are process-wide.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import jinja2
+
+from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+
+TEMPLATE_CACHE_SIZE = 1024
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+_statistics = {'hits': 0, 'misses': 0}
+
+
+def get_render_variables(template_variables):
+    if 'ctx' in template_variables:
+        raise NonRecoverableError(
+            'Key not allowed - a key named ctx is in template_variables')
+    render_variables = template_variables.copy()
+    render_variables['ctx'] = current_ctx.get_ctx()
+    return render_variables
+
+
+def get_template(resource):
+    """
+    :param resource: String object containing the template
+    :return: Tuple (template, hit), where template is the compiled
+        jinja2.Template, taken from the cache if possible
+    """
+    if isinstance(resource, unicode):
+        key = hashlib.sha1(resource.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(resource).hexdigest()
+    with _templates_lock:
+        template = _templates.pop(key, None)
+        if template is not None:
+            _templates[key] = template
+            _statistics['hits'] += 1
+            return template, True
+        _statistics['misses'] += 1
+    # Compile outside of the lock, so that other threads are not blocked.
+    template = jinja2.Template(resource)
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template, False
+
+
+def get_cache_statistics():
+    with _templates_lock:
+        return dict(_statistics, size=len(_templates))
+
+
+def clear_cache():
+    with _templates_lock:
+        _templates.clear()
+        _statistics['hits'] = 0
+        _statistics['misses'] = 0
+
+
+def render_resource(resource, template_variables):
+    """
+    :param resource: String object containing the template
+    :param template_variables: Dict of variables used for rendering
+    :return: Tuple (rendered_resource, hit), where rendered_resource is
+        a string object and hit is True if the compiled template was cached
+    """
+    template, hit = get_template(resource)
+    rendered_resource = template.render(
+        get_render_variables(template_variables))
+    if isinstance(rendered_resource, unicode):
+        rendered_resource = rendered_resource.encode('utf-8')
+    return rendered_resource, hit
@@ -0,0 +1,107 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Incremental synchronization of the working directory.
+#
+# The manifest is a JSON file kept in the working directory. For each staged
+# file (relative to the working directory) it records the version of its
+# source, the digest of template_variables it was rendered with (None for
+# copied files), and the size and modification time of the staged file.
+# A file is staged again only if any of these changed. The content of staged
+# files is not hashed, so the check doesn't read the package.
+
+import os
+import json
+import errno
+import hashlib
+import tempfile
+
+MANIFEST_FILE = '.exec_manifest.json'
+
+
+def get_manifest_path(working_directory):
+    return os.path.join(working_directory, MANIFEST_FILE)
+
+
+def get_variables_digest(template_variables):
+    return hashlib.sha1(json.dumps(
+        template_variables, sort_keys=True, default=str)).hexdigest()
+
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_manifest(manifest_path, manifest):
+    fd, tmp_manifest_path = tempfile.mkstemp(
+        dir=os.path.dirname(manifest_path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.rename(tmp_manifest_path, manifest_path)
+
+
+def get_entry(path, source_key, variables_digest):
+    stat = os.stat(path)
+    return {
+        'source': source_key,
+        'variables': variables_digest,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+
+
+def is_up_to_date(entry, path, source_key, variables_digest):
+    """
+    :return: True if the file at path was staged from the same version of
+        the source with the same template_variables and wasn't modified since.
+        Sources, which are not available locally (source_key is None), are
+        never considered up to date.
+    """
+    if not entry or not source_key:
+        return False
+    if entry.get('source') != source_key or \
+            entry.get('variables') != variables_digest:
+        return False
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_size == entry.get('size') and \
+        stat.st_mtime == entry.get('mtime')
+
+
+def remove_stale_entries(working_directory, manifest, current_paths):
+    """
+    Remove files, which were staged before, but are not a part of
+    the package anymore.
+
+    :return: List of removed relative paths
+    """
+    removed = []
+    for relative_path in manifest:
+        if relative_path in current_paths:
+            continue
+        try:
+            os.remove(os.path.join(working_directory, relative_path))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.EISDIR):
+                raise
+        removed.append(relative_path)
+    return removed
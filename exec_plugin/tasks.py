@@ -1,16 +1,102 @@
 
 import os
-import subprocess
-import tempfile
+import sys
+import copy
+import json
 import errno
+import fnmatch
+import shutil
+import signal
+import hashlib
 import zipfile
-import copy
+import resource
+import tempfile
+import subprocess
+import time
+import Queue
+import threading
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from cloudify import ctx
+from cloudify.state import current_ctx
 from cloudify.exceptions import (
     NonRecoverableError,
     OperationRetry)
 
+from . import (
+    cache, dag, extract, lazy, outputs, render, sync, transfer, worker,
+    workspace)
+from .metrics import Metrics, NULL_METRICS
+
+DEFAULT_DOWNLOAD_WORKERS = 10
+
+# Modes of placing resources, which are available on the local file system,
+# in the working directory: reflink or copy, reflink, hard link or copy, and
+# always downloading them with ctx.download_resource.
+LOCAL_RESOURCES_COPY = 'copy'
+LOCAL_RESOURCES_LINK = 'link'
+LOCAL_RESOURCES_DOWNLOAD = 'download'
+LOCAL_RESOURCES_MODES = (
+    LOCAL_RESOURCES_COPY, LOCAL_RESOURCES_LINK, LOCAL_RESOURCES_DOWNLOAD)
+
+# Kinds of entries of the staging manifest.
+RESOURCE_TEMPLATE = 'template'
+RESOURCE_COPY = 'copy'
+RESOURCE_DIRECTORY = 'dir'
+
+# Templates are recognized by the delimiters of jinja2 blocks. Files with NUL
+# bytes, files without delimiters and files larger than the maximum size are
+# copied instead of being rendered.
+TEMPLATE_DELIMITERS = ('{{', '{%', '{#')
+DEFAULT_TEMPLATE_MAX_SIZE = 10 * 1024 * 1024
+
+# Extracted archives are marked with EXTRACTION_MARKER file. Archives
+# extracted into directories, which the plugin didn't create, are marked with
+# EXTRACTION_MARKER.<name of the directory> next to them instead. Temporary
+# directories used during extraction start with EXTRACTION_PREFIX. These,
+# which are older than STALE_EXTRACTION_AGE seconds, were left behind by
+# interrupted operations.
+EXTRACTION_MARKER = '.exec_extracted'
+EXTRACTION_PREFIX = '.exec_extract.'
+STALE_EXTRACTION_AGE = 60 * 60
+
+# Output of the executed script is logged in batches of at most
+# OUTPUT_BATCH_LINES lines, at least every OUTPUT_FLUSH_INTERVAL seconds.
+OUTPUT_BATCH_LINES = 100
+OUTPUT_FLUSH_INTERVAL = 1.0
+OUTPUT_QUEUE_SIZE = 1000
+STDERR_TAIL_LINES = 50
+
+DEFAULT_KILL_TIMEOUT = 10
+DEFAULT_BATCH_WORKERS = 10
+DEFAULT_POLL_INTERVAL = 5
+
+# Workspaces of node instances are removed after a successful script of
+# this operation (see cleanup).
+DELETE_OPERATION = 'cloudify.interfaces.lifecycle.delete'
+
+# Runtime properties of the plugin, which outputs of scripts can't set.
+RESERVED_RUNTIME_PROPERTIES = (
+    'blueprint_directory',
+    'deployment_directory',
+    'current_working_directory',
+    'exec_async',
+    'exec_memo',
+    'exec_metrics',
+    'exec_prefetch',
+    'batch_results',
+    'step_results',
+    'workspace_usage')
+
+# Keys of the resource_limits input mapped to the limits set on the process.
+RESOURCE_LIMITS = {
+    'cpu': resource.RLIMIT_CPU,
+    'address_space': resource.RLIMIT_AS,
+    'open_files': resource.RLIMIT_NOFILE
+}
+
 
 def verify_os_file_path(os_file_path):
     if not os.path.exists(os_file_path):
@@ -46,10 +132,16 @@ def get_directory_by_property_name(property_name,
     return verify_os_file_path(directory)
 
 
-def get_current_working_directory():
+def get_current_working_directory(workspace_root=None):
+    # Working directories are managed workspaces, so that they are removed
+    # on delete and by the garbage collection.
     return get_directory_by_property_name(
         'current_working_directory',
-        tempfile.mkdtemp)
+        workspace.create_workspace,
+        creation_action_args=[
+            workspace_root or workspace.DEFAULT_WORKSPACE_ROOT,
+            ctx.deployment.id,
+            ctx.instance.id])
 
 
 def get_blueprint_directory():
@@ -76,17 +168,272 @@ def get_deployment_directory():
         return get_blueprint_directory()
       
       
+class ResolvedPaths(object):
+    """
+    Directories used by a single operation. Each of them is resolved on
+    first use and cached, so that runtime properties and the file system
+    are not queried again for every staged file. A directory, which doesn't
+    exist yet, is not cached and is resolved again on next access. The
+    pools of threads, which stage resources, are kept for the operation too
+    and have to be stopped with close.
+
+    :param workspace_root: Directory, which new working directories are
+        created in (workspace.DEFAULT_WORKSPACE_ROOT by default)
+    """
+
+    def __init__(self, workspace_root=None):
+        self._directories = {}
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+        self.workspace_root = workspace_root
+
+    def get_pool(self, workers):
+        """
+        :return: ThreadPool with workers threads, created on first use and
+            reused by all of the stagings of the operation, since starting
+            and joining a pool takes about 0.1 seconds
+        """
+        with self._pools_lock:
+            pool = self._pools.get(workers)
+            if pool is None:
+                # The context is stored per thread, so it has to be handed
+                # over to each of the workers.
+                pool = self._pools[workers] = ThreadPool(
+                    workers, current_ctx.set, (current_ctx.get_ctx(),))
+        return pool
+
+    def close(self):
+        """ Stop the pools of the operation. """
+        with self._pools_lock:
+            pools = self._pools.values()
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+            pool.join()
+
+    def _get(self, name, resolver):
+        if not self._directories.get(name):
+            self._directories[name] = resolver()
+        return self._directories[name]
+
+    def invalidate(self, name=None):
+        """
+        Forget a resolved directory, or all of them if name is None.
+        Should be called after a directory is created or removed.
+        """
+        if name:
+            self._directories.pop(name, None)
+        else:
+            self._directories.clear()
+
+    @property
+    def blueprint_directory(self):
+        return self._get('blueprint_directory', get_blueprint_directory)
+
+    @property
+    def deployment_directory(self):
+        return self._get('deployment_directory', get_deployment_directory)
+
+    @property
+    def current_working_directory(self):
+        return self._get(
+            'current_working_directory',
+            lambda: get_current_working_directory(self.workspace_root))
+
+
+@contextmanager
+def resolve_paths(paths=None):
+    """
+    Use the ResolvedPaths of an operation or, if paths is None, new ones,
+    which are closed on exit.
+    """
+    if paths is not None:
+        yield paths
+        return
+    paths = ResolvedPaths()
+    try:
+        yield paths
+    finally:
+        paths.close()
+
+
+def get_archive_signature(archive_path, archive):
+    """
+    :param archive_path: Path of the ZIP archive
+    :param archive: zipfile.ZipFile object of the archive
+    :return: Dict identifying the archive by its path, size, modification
+        time and the CRCs of its members, which are read from the central
+        directory without decompressing anything
+    """
+    stat = os.stat(archive_path)
+    members = hashlib.sha1()
+    for member in archive.infolist():
+        members.update('{0}:{1}:{2}\n'.format(
+            member.filename, member.file_size, member.CRC))
+    return {
+        'archive': os.path.abspath(archive_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'members': members.hexdigest()
+    }
+
+
+def get_extraction_marker_path(target_directory, in_place=False):
+    """
+    :param in_place: The archive is extracted into a directory, which the
+        plugin didn't create, so the marker is kept next to the directory,
+        which never becomes owned by the plugin
+    """
+    if in_place:
+        return os.path.join(
+            os.path.dirname(target_directory),
+            '{0}.{1}'.format(
+                EXTRACTION_MARKER, os.path.basename(target_directory)))
+    return os.path.join(target_directory, EXTRACTION_MARKER)
+
+
+def read_extraction_marker(target_directory, in_place=False):
+    try:
+        with open(get_extraction_marker_path(
+                target_directory, in_place)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_extraction_marker(target_directory, signature, in_place=False):
+    with open(get_extraction_marker_path(
+            target_directory, in_place), 'w') as f:
+        json.dump(signature, f)
+
+
+def _replace_extracted_directory(extracted_directory,
+                                 target_directory,
+                                 signature):
+    try:
+        os.rename(extracted_directory, target_directory)
+        return
+    except OSError as e:
+        if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+            raise
+
+    # Another operation might have extracted the same archive meanwhile.
+    marker = read_extraction_marker(target_directory)
+    if marker == signature:
+        return
+    if marker is None and os.path.isdir(target_directory):
+        raise NonRecoverableError(
+            'Directory {0} was not extracted by the plugin, it is not '
+            'replaced.'.format(target_directory))
+
+    # Move the outdated extraction out of the way and put the new one
+    # in its place.
+    outdated_directory = tempfile.mkdtemp(
+        dir=os.path.dirname(target_directory), prefix=EXTRACTION_PREFIX)
+    try:
+        try:
+            os.rename(target_directory,
+                      os.path.join(outdated_directory, 'outdated'))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.rename(extracted_directory, target_directory)
+    finally:
+        shutil.rmtree(outdated_directory, ignore_errors=True)
+
+
+def remove_stale_extractions(parent_directory):
+    deadline = time.time() - STALE_EXTRACTION_AGE
+    for name in os.listdir(parent_directory):
+        path = os.path.join(parent_directory, name)
+        try:
+            if name.startswith(EXTRACTION_PREFIX) and \
+                    os.path.getmtime(path) < deadline:
+                ctx.logger.debug('Removing stale {0}'.format(path))
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def extract_archive_into(archive, archive_path, target_directory,
+                         extraction_settings=None,
+                         metrics=NULL_METRICS):
+    try:
+        files, size = extract.extract_archive(
+            archive, archive_path, target_directory, extraction_settings)
+    except extract.ArchiveLimitExceeded as e:
+        raise NonRecoverableError(
+            'Archive {0} was not extracted: {1}'.format(archive_path, e))
+    metrics.add('extract', files=files, size=size)
+
+
 def extract_archive_from_path(archive_path,
                               target_directory,
-                              intermediate_actions=None):
+                              intermediate_actions=None,
+                              extraction_settings=None,
+                              metrics=NULL_METRICS):
+    # The archive is extracted only if it changed since the last extraction.
+    # It is extracted to a temporary directory next to the target first and
+    # then renamed, so that concurrent operations never see a partially
+    # extracted archive. Only directories created this way are replaced. A
+    # target directory, which the plugin didn't create (e.g. resources of the
+    # blueprint next to the archive), is never replaced nor removed - the
+    # archive is extracted into it, as it was always done.
     return_value = None
     with zipfile.ZipFile(archive_path) as archive:
         if intermediate_actions:
             return_value = intermediate_actions()
-        archive.extractall(target_directory)
+
+        signature = get_archive_signature(archive_path, archive)
+        marker = read_extraction_marker(target_directory)
+        if marker == signature:
+            ctx.logger.debug(
+                'Archive {0} is already extracted.'.format(archive_path))
+            return return_value
+
+        if marker is None and os.path.isdir(target_directory):
+            if read_extraction_marker(
+                    target_directory, in_place=True) == signature:
+                ctx.logger.debug(
+                    'Archive {0} is already extracted.'.format(archive_path))
+                return return_value
+            extract_archive_into(
+                archive, archive_path, target_directory, extraction_settings,
+                metrics)
+            write_extraction_marker(
+                target_directory, signature, in_place=True)
+            return return_value
+
+        parent_directory = os.path.dirname(target_directory)
+        try:
+            os.makedirs(parent_directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        remove_stale_extractions(parent_directory)
+        extracted_directory = tempfile.mkdtemp(
+            dir=parent_directory, prefix=EXTRACTION_PREFIX)
+        try:
+            extract_archive_into(
+                archive, archive_path, extracted_directory,
+                extraction_settings, metrics)
+            write_extraction_marker(extracted_directory, signature)
+            _replace_extracted_directory(
+                extracted_directory, target_directory, signature)
+        finally:
+            shutil.rmtree(extracted_directory, ignore_errors=True)
         return return_value
 
 
+def get_listed_templates(resource_list):
+    """
+    :return: Set of the paths in resource_list, which are not archives
+    """
+    return set(
+        template_path for template_path in resource_list
+        if os.path.splitext(template_path)[1] != '.zip')
+
+
 def get_resource_relative_path(resource, relative_dir):
     """
     :param resource: Entry of the list returned by os.walk()
@@ -97,264 +444,1033 @@ def get_resource_relative_path(resource, relative_dir):
     return resource[0][len(relative_dir) + 1:]
 
 
-def get_package_dir_from_dir_and_list(resource_dir,
-                                      resource_list,
-                                      template_variables={}):
-    # Case, when user defines a directory with files, which need to be
-    # downloaded, but doesn't want to render all of them - only these
-    # defined in resource_list.
-
-    ctx.logger.debug('resource_dir and resource_list params are not empty.')
-
-    # Deal with ZIP files
-    filename, extension = os.path.splitext(resource_dir)
-    if extension == '.zip':
-        archive_path = os.path.join(get_deployment_directory(), resource_dir)
-        target_directory = os.path.join(get_deployment_directory(), filename)
-        resource_dir = filename
-        extract_archive_from_path(archive_path, target_directory)
+def add_manifest_entry(manifest,
+                       relative_path,
+                       kind,
+                       source,
+                       dest,
+                       archive=None,
+                       listed=False):
+    """
+    Add a resource to the staging manifest, replacing an existing entry
+    with the same path.
+
+    :param manifest: OrderedDict mapping paths relative to the working
+        directory to dicts describing how each resource is staged
+    :param relative_path: Path of the resource in the working directory
+    :param kind: RESOURCE_TEMPLATE, RESOURCE_COPY or RESOURCE_DIRECTORY
+    :param source: Path of the resource relative to the blueprint or,
+        if archive is set, name of the member of the archive
+    :param dest: Absolute path of the resource in the working directory
+    :param archive: Absolute path of a ZIP archive, which the resource
+        is streamed from
+    :param listed: True if the resource is a template listed explicitly in
+        resource_list, so it is always rendered
+    """
+    manifest[relative_path] = {
+        'kind': kind,
+        'source': source,
+        'dest': dest,
+        'archive': archive,
+        'listed': listed
+    }
 
-    # Deal with ZIP files in resource_list
-    for template_path in copy.copy(resource_list):
 
+def walk_resources(directory, relative_dir):
+    """
+    :param directory: Directory to walk
+    :param relative_dir: Directory, which the yielded paths are relative to
+    :return: Generator of (relative_path, kind) tuples for every file and
+        every empty leaf directory in the directory
+    """
+    for walked_resource in os.walk(directory):
+        # Skip archives, which are being extracted at the moment, and
+        # extraction markers.
+        walked_resource[1][:] = [
+            dirname for dirname in walked_resource[1]
+            if not dirname.startswith(EXTRACTION_PREFIX)]
+        filenames = [
+            filename for filename in walked_resource[2]
+            if filename != EXTRACTION_MARKER and
+            not filename.startswith(EXTRACTION_MARKER + '.')]
+        resource_path = get_resource_relative_path(
+            walked_resource, relative_dir)
+        if filenames:
+            for filename in filenames:
+                yield os.path.join(resource_path, filename), RESOURCE_COPY
+        elif not walked_resource[1]:
+            yield resource_path, RESOURCE_DIRECTORY
+
+
+def walk_archive(archive_path, relative_dir, extraction_settings=None):
+    """
+    :param archive_path: Path of a ZIP archive
+    :param relative_dir: Path, which the archive would be extracted to,
+        relative to the directory the yielded paths are relative to
+    :param extraction_settings: Dict with the limits of extraction (see
+        extract.plan_extraction), which the archive is checked against
+    :return: List of (relative_path, kind, archive_path, member) tuples
+        for every member of the archive. Paths of the members are
+        sanitized like ZipFile.extractall does.
+    """
+    resources = []
+    with zipfile.ZipFile(archive_path) as archive:
+        try:
+            directories, files = extract.plan_extraction(
+                archive, relative_dir, extraction_settings)
+        except extract.ArchiveLimitExceeded as e:
+            raise NonRecoverableError(
+                'Archive {0} was not streamed: {1}'.format(archive_path, e))
+    for directory in directories:
+        if directory != relative_dir:
+            resources.append((
+                directory, RESOURCE_DIRECTORY, archive_path,
+                os.path.relpath(directory, relative_dir) + '/'))
+    for member, path in files:
+        resources.append((
+            path, RESOURCE_COPY, archive_path, member.filename))
+    return resources
+
+
+def expand_resource_list(resource_list,
+                         relative_dir,
+                         stream_archives=False,
+                         metrics=NULL_METRICS,
+                         extraction_settings=None):
+    """
+    Replace ZIP archives in resource_list with the resources extracted
+    from them. Each archive is extracted next to itself or, if
+    stream_archives is True, its members are streamed from the archive
+    without extracting it. resource_list itself is not modified.
+
+    :param resource_list: List of paths relative to relative_dir
+    :param relative_dir: Absolute path of the directory, which
+        resource_list is relative to
+    :param stream_archives: Stream members of archives instead of
+        extracting them
+    :param metrics: Metrics object, which the extraction is recorded in
+    :param extraction_settings: Dict with the limits and the number of
+        workers of extraction (see extract.extract_archive)
+    :return: List of (relative_path, kind, archive_path, member) tuples.
+        archive_path and member are None for resources, which are not
+        streamed from an archive.
+    """
+    resources = []
+    for template_path in resource_list:
         filename, extension = os.path.splitext(template_path)
+        if extension == '.zip' and stream_archives:
+            with metrics.phase('walk'):
+                resources.extend(walk_archive(
+                    os.path.join(relative_dir, template_path), filename,
+                    extraction_settings))
+        elif extension == '.zip':
+            target_directory = os.path.join(relative_dir, filename)
+            with metrics.phase('extract'):
+                extract_archive_from_path(
+                    os.path.join(relative_dir, template_path),
+                    target_directory,
+                    extraction_settings=extraction_settings,
+                    metrics=metrics)
+            with metrics.phase('walk'):
+                resources.extend(
+                    (resource_path, kind, None, None)
+                    for resource_path, kind
+                    in walk_resources(target_directory, relative_dir))
+        else:
+            resources.append((template_path, RESOURCE_COPY, None, None))
+    return resources
 
-        if extension == '.zip':
-            resource_list.remove(template_path)
-            archive_path = os.path.join(
-                get_deployment_directory(), resource_dir, template_path)
-            target_directory = os.path.join(
-                get_deployment_directory(), resource_dir, filename)
-            extract_archive_from_path(archive_path, target_directory)
-
-            for extracted_template in os.walk(target_directory):
-                extracted_template_path = get_resource_relative_path(
-                    extracted_template,
-                    os.path.join(get_deployment_directory(), resource_dir))
-
-                if extracted_template[2]:
-                    for filename in extracted_template[2]:
-                        resource_list.append(
-                            os.path.join(extracted_template_path, filename))
-                elif not extracted_template[1] and not extracted_template[2]:
-                    resource_list.append(extracted_template_path)
-
-    merged_list = []
 
-    # This loop goes through a directory defined in resource_dir parameter
-    # and prepares a list of paths inside it.
-    for resource_path in os.walk(os.path.join(
-            get_deployment_directory(), resource_dir)):
-        trimmed_resource_path = get_resource_relative_path(
-            resource_path, os.path.join(get_deployment_directory()))
-
-        if resource_path[2]:
-            for filename in resource_path[2]:
-                merged_list.append(
-                    os.path.join(trimmed_resource_path, filename))
-        elif not resource_path[1] and not resource_path[2]:
-            merged_list.append(trimmed_resource_path)
-
-    # This loop goes through a templates list defined in resource_list
-    # parameter. For each template it renders it (resolves all of variables
-    # defined in template_variables parameter) and downloads it to working
-    # directory. Finally, it removes a path to this file from the merged_list,
-    # because it should be ommitted at the next step, which is copying the rest
-    # of the files, which are not templates.
-    for template_path in resource_list:
-        template_dirname = os.path.join(
-            resource_dir, os.path.dirname(template_path))
-        download_from_file = os.path.join(resource_dir, template_path)
-        download_to_directory = os.path.join(
-            get_current_working_directory(), template_dirname)
-        download_to_file = os.path.join(
-            get_current_working_directory(), download_from_file)
+def stream_archive_member(archive,
+                          member,
+                          download_to_file,
+                          is_template,
+                          template_variables):
+    """
+    Write a member of a ZIP archive to download_to_file in chunks, or render
+    it with template_variables if is_template is True.
 
+    :param archive: zipfile.ZipFile object opened with a file name, so that
+        each of the threads reads the archive using its own file object
+    :return: True if the compiled template was cached, False if it wasn't
+        and None if the member is not a template
+    """
+    if not is_template:
+        # The member is rejected, if it is larger than its declared size,
+        # which was checked against the limits by walk_archive.
         try:
-            os.makedirs(download_to_directory)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
+            extract.extract_member(
+                archive, archive.getinfo(member), download_to_file)
+        except extract.ArchiveLimitExceeded as e:
+            raise NonRecoverableError(str(e))
+        return None
+    with archive.open(member) as source:
+        rendered_resource, hit = render.render_resource(
+            source.read(), template_variables)
+    with open(download_to_file, 'wb') as target:
+        target.write(rendered_resource)
+    return hit
+
+
+def is_template_content(source, max_size=DEFAULT_TEMPLATE_MAX_SIZE):
+    """
+    :param source: File object opened in binary mode
+    :return: True if the content looks like a template: it contains
+        no NUL bytes, at least one of TEMPLATE_DELIMITERS and it is not
+        larger than max_size bytes
+    """
+    size = 0
+    found = False
+    tail = ''
+    for chunk in iter(lambda: source.read(cache.CHUNK_SIZE), b''):
+        size += len(chunk)
+        if size > max_size or '\0' in chunk:
+            return False
+        # A delimiter may be split between two chunks.
+        found = found or any(
+            delimiter in tail + chunk for delimiter in TEMPLATE_DELIMITERS)
+        tail = chunk[-1:]
+    return found
+
+
+def is_template(entry, relative_path, template_filter, deployment_directory,
+                archives):
+    """
+    Decide whether a manifest entry marked as a template has to be rendered.
+    Paths matching the exclude globs are never rendered. Templates listed
+    explicitly in resource_list and paths matching the include globs are
+    always rendered and the rest is sniffed, if detection is enabled.
+    Sources, which are not available locally, are rendered.
+    """
+    if any(fnmatch.fnmatch(relative_path, pattern)
+           for pattern in template_filter.get('exclude', [])):
+        return False
+    if entry.get('listed'):
+        return True
+    if any(fnmatch.fnmatch(relative_path, pattern)
+           for pattern in template_filter.get('include', [])):
+        return True
+    if not template_filter.get('detect', True):
+        return True
+    max_size = template_filter.get('max_size', DEFAULT_TEMPLATE_MAX_SIZE)
+    if entry['archive']:
+        archive = archives[entry['archive']]
+        if archive.getinfo(entry['source']).file_size > max_size:
+            return False
+        with archive.open(entry['source']) as source:
+            return is_template_content(source, max_size)
+    try:
+        with open(os.path.join(
+                deployment_directory, entry['source']), 'rb') as source:
+            return is_template_content(source, max_size)
+    except IOError:
+        return True
+
+
+def classify_templates(manifest,
+                       template_filter,
+                       paths,
+                       metrics=NULL_METRICS):
+    """
+    Mark templates of a manifest, which don't need to be rendered, to be
+    copied instead.
 
-        try:
+    :param template_filter: Dict with keys: detect (bool), include and
+        exclude (lists of globs matched against paths in the working
+        directory) and max_size (bytes)
+    """
+    template_filter = template_filter or {}
+    archives = {}
+    with metrics.phase('classify'):
+        _classify_templates(manifest, template_filter, paths, archives)
+    return manifest
+
+
+def _classify_templates(manifest, template_filter, paths, archives):
+    try:
+        for relative_path, entry in manifest.iteritems():
+            if entry['kind'] != RESOURCE_TEMPLATE:
+                continue
+            if entry['archive'] and entry['archive'] not in archives:
+                archives[entry['archive']] = zipfile.ZipFile(entry['archive'])
+            if not is_template(entry, relative_path, template_filter,
+                               paths.deployment_directory, archives):
+                entry['kind'] = RESOURCE_COPY
+    finally:
+        for archive in archives.itervalues():
+            archive.close()
+
+
+def get_source_key(entry, deployment_directory, archives):
+    """
+    :return: String object identifying the current version of the source of
+        a manifest entry or None, if it can't be determined locally
+    """
+    if not entry['archive']:
+        # There is no local copy of the package on a host agent.
+        if not deployment_directory:
+            return None
+        return cache.get_cache_key(
+            os.path.join(deployment_directory, entry['source']))
+    archive_key = cache.get_cache_key(entry['archive'])
+    if not archive_key:
+        return None
+    return hashlib.sha1('{0}:{1}:{2}'.format(
+        archive_key,
+        entry['source'],
+        archives[entry['archive']].getinfo(entry['source']).CRC)).hexdigest()
+
+
+def get_package_fingerprint(manifest, inputs, deployment_directory):
+    """
+    :param inputs: Object, which can be serialized to JSON, e.g. a list of
+        the inputs of the operation
+    :return: SHA-256 of the inputs, of the layout of the package and of the
+        current versions of its resources, or None if some of the resources
+        are not available locally, so they can't be versioned
+    """
+    digest = hashlib.sha256(json.dumps(inputs, sort_keys=True))
+    archives = {}
+    try:
+        for relative_path, entry in manifest.iteritems():
+            source_key = None
+            if entry['kind'] != RESOURCE_DIRECTORY:
+                if entry['archive'] and entry['archive'] not in archives:
+                    archives[entry['archive']] = \
+                        zipfile.ZipFile(entry['archive'])
+                source_key = get_source_key(
+                    entry, deployment_directory, archives)
+                if not source_key:
+                    return None
+            digest.update('{0}:{1}:{2}\n'.format(
+                relative_path, entry['kind'], source_key))
+    finally:
+        for archive in archives.itervalues():
+            archive.close()
+    return digest.hexdigest()
+
+
+def render_resource_locally(download_from_file,
+                            download_to_file,
+                            template_variables,
+                            template_sources):
+    """
+    Render a template with the local render engine. The source of each
+    template is fetched only once per template_sources dict and its
+    compiled form is cached by the render module.
+
+    :param template_sources: Dict mapping resource paths to their sources,
+        shared by all of the renders of the operation
+    :return: True if the compiled template was cached
+    """
+    resource = template_sources.get(download_from_file)
+    if resource is None:
+        resource = ctx.get_resource(download_from_file)
+        template_sources[download_from_file] = resource
+    rendered_resource, hit = render.render_resource(
+        resource, template_variables)
+    with open(download_to_file, 'wb') as f:
+        f.write(rendered_resource)
+    return hit
+
+
+def _download_single_resource(download):
+    entry, options = download
+    metrics = options['metrics']
+    if not metrics.enabled:
+        return _stage_resource(entry, options)
+    start = time.time()
+    error = _stage_resource(entry, options)
+    try:
+        size = os.path.getsize(entry['dest'])
+    except OSError:
+        size = 0
+    metrics.record_file(
+        'render' if entry['kind'] == RESOURCE_TEMPLATE else 'download',
+        entry['source'], time.time() - start, size)
+    return error
+
+
+def _stage_resource(entry, options):
+    download_from_file = entry['source']
+    download_to_file = entry['dest']
+    local_source = get_local_source(entry, options) \
+        if entry['kind'] == RESOURCE_COPY else None
+    executable = os.path.splitext(download_to_file)[1] == '.py'
+    hit = None
+    try:
+        if entry['archive']:
+            hit = stream_archive_member(
+                options['archives'][entry['archive']],
+                download_from_file,
+                download_to_file,
+                entry['kind'] == RESOURCE_TEMPLATE,
+                options['template_variables'])
+        elif entry['kind'] == RESOURCE_TEMPLATE and \
+                options['render_locally']:
+            hit = render_resource_locally(
+                download_from_file,
+                download_to_file,
+                options['template_variables'],
+                options['template_sources'])
+        elif entry['kind'] == RESOURCE_TEMPLATE:
             ctx.download_resource_and_render(
                 download_from_file,
                 download_to_file,
-                template_variables.copy())
-            if os.path.splitext(download_to_file)[1] == '.py':
-                os.chmod(download_to_file, 0755)
-        except IOError as e:
-            if e.errno != errno.EISDIR:
-                raise
+                options['template_variables'].copy())
+        elif local_source:
+            # Files made executable below are not hard linked, so that the
+            # mode of their source doesn't change.
+            cache.clone_file(
+                local_source,
+                download_to_file,
+                options['local_resources'] == LOCAL_RESOURCES_LINK and
+                not executable)
+        elif options['resource_cache'].get('enabled'):
+            download_cached_resource(
+                download_from_file,
+                download_to_file,
+                options['resource_cache'],
+                options['transfer_settings'])
+        else:
+            download_resource(
+                download_from_file,
+                download_to_file,
+                options['transfer_settings'])
+        if executable:
+            os.chmod(download_to_file, 0755)
+        if hit is not None:
+            with options['lock']:
+                options['render_statistics'][
+                    'hits' if hit else 'misses'] += 1
+    except transfer.TransferInterrupted as e:
+        options['interrupted'].append(download_from_file)
+        return '{0}: {1}'.format(download_from_file, e)
+    except IOError as e:
+        if e.errno != errno.EISDIR:
+            return '{0}: {1}'.format(download_from_file, e)
+    except Exception as e:
+        return '{0}: {1}'.format(download_from_file, e)
+
+
+def get_local_source(entry, options):
+    """
+    :return: Absolute path of the source of a copied resource, if it can be
+        placed in the working directory without ctx.download_resource,
+        or None
+    """
+    if entry['archive'] or \
+            options['local_resources'] == LOCAL_RESOURCES_DOWNLOAD or \
+            not options['deployment_directory']:
+        return None
+    source_path = os.path.join(
+        options['deployment_directory'], entry['source'])
+    if os.path.isfile(source_path) and os.access(source_path, os.R_OK):
+        return source_path
+    return None
+
+
+def download_resource(download_from_file,
+                      download_to_file,
+                      transfer_settings=None):
+    """
+    Download a resource, in chunks if transfer_settings enable it.
+    """
+    if transfer_settings and transfer_settings.get('enabled'):
+        transfer.download_resource(
+            download_from_file, download_to_file, transfer_settings)
+    else:
+        ctx.download_resource(download_from_file, download_to_file)
+
+
+def download_cached_resource(download_from_file,
+                             download_to_file,
+                             resource_cache,
+                             transfer_settings=None):
+    # Resources are versioned by the file server, so that the cache works
+    # on agents without a local copy of the package. Resources, which the
+    # file server doesn't version, bypass the cache.
+    cache_directory = resource_cache.get(
+        'directory') or cache.DEFAULT_CACHE_DIRECTORY
+    version = transfer.get_resource_version(download_from_file)
+    cache_key = cache.get_resource_key(*version) if version else None
+    if not cache_key:
+        download_resource(
+            download_from_file, download_to_file, transfer_settings)
+        return
 
-        if download_from_file in merged_list:
-            merged_list.remove(download_from_file)
+    object_path = cache.lookup(cache_directory, cache_key)
+    if object_path:
+        ctx.logger.debug('Cache hit: {0}'.format(download_from_file))
+        # Not a hard link, so that modifying the file in place doesn't
+        # modify the cached object shared by other operations.
+        cache.clone_file(object_path, download_to_file, allow_link=False)
+        return
 
-    # This loop goes through the merged_list and downloads the rest of
-    # files to our working directory.
-    for resource_path in merged_list:
-        resource_dirname = os.path.dirname(resource_path)
-        download_to_directory = os.path.join(
-            get_current_working_directory(), resource_dirname)
-        download_to_file = os.path.join(
-            get_current_working_directory(), resource_path)
+    ctx.logger.debug('Cache miss: {0}'.format(download_from_file))
+    download_resource(download_from_file, download_to_file, transfer_settings)
+    if os.path.isfile(download_to_file):
+        cache.store(cache_directory, cache_key, download_to_file)
+
+
+def download_resources(manifest,
+                       template_variables={},
+                       download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                       resource_cache=None,
+                       sync_manifest_path=None,
+                       paths=None,
+                       render_locally=False,
+                       template_sources=None,
+                       metrics=NULL_METRICS,
+                       local_resources=LOCAL_RESOURCES_COPY,
+                       transfer_settings=None,
+                       retained_paths=()):
+    """
+    Stage resources in the working directory using a pool of threads.
+
+    :param manifest: Staging manifest built with add_manifest_entry.
+        Templates are rendered with template_variables, copies are
+        downloaded unchanged and directories are created.
+    :param template_variables: Dict of variables used for rendering.
+    :param download_workers: Maximum number of concurrent downloads.
+    :param resource_cache: Dict with the local resource cache settings.
+        Resources, which are not rendered, are taken from the cache
+        if it is enabled.
+    :param sync_manifest_path: Path of the incremental synchronization
+        manifest. If set, only resources, which changed since the previous
+        run, are downloaded and files, which are not a part of the manifest
+        anymore, are removed.
+    :param paths: ResolvedPaths object of the current operation.
+    :param render_locally: Render templates with the local render engine
+        instead of ctx.download_resource_and_render.
+    :param template_sources: Dict of template sources, which can be shared
+        between calls rendering the same templates with different variables.
+    :param metrics: Metrics object, which the staging is recorded in.
+    :param local_resources: LOCAL_RESOURCES_COPY or LOCAL_RESOURCES_LINK to
+        place copied resources, which are available in the deployment
+        directory, in the working directory without downloading them,
+        LOCAL_RESOURCES_DOWNLOAD to always download them.
+    :param transfer_settings: Dict with the settings of chunked, resumable
+        downloads (see transfer.download_resource). Copied resources are
+        downloaded in chunks if it is enabled.
+    :param retained_paths: Relative paths of resources, which are a part
+        of the package, but are not staged by this call (e.g. lazy
+        resources), so incremental synchronization doesn't remove them.
+    :raises: NonRecoverableError listing every resource, which failed
+        to be downloaded, or OperationRetry if all of the failed downloads
+        can be resumed.
+    """
 
+    resource_cache = resource_cache or {}
+    with resolve_paths(paths) as paths:
+        deployment_directory = \
+            paths.deployment_directory \
+            if sync_manifest_path or \
+            local_resources != LOCAL_RESOURCES_DOWNLOAD else None
+
+        options = {
+            'template_variables': template_variables,
+            'resource_cache': resource_cache,
+            'deployment_directory': deployment_directory,
+            'render_locally': render_locally,
+            'template_sources':
+                {} if template_sources is None else template_sources,
+            # Archives, which resources are streamed from, are opened only
+            # once.
+            'archives': {},
+            'metrics': metrics,
+            'local_resources': local_resources,
+            'transfer_settings': transfer_settings or {},
+            'retained_paths': set(retained_paths),
+            'paths': paths,
+            # Resources, which downloads were interrupted, but can be resumed.
+            'interrupted': [],
+            # Hits and misses of the template cache counted by the renders of
+            # this call, not by the concurrent operations of the agent.
+            'render_statistics': {'hits': 0, 'misses': 0},
+            'lock': threading.Lock()
+        }
         try:
-            os.makedirs(download_to_directory)
+            for entry in manifest.itervalues():
+                if entry['archive'] and \
+                        entry['archive'] not in options['archives']:
+                    options['archives'][entry['archive']] = \
+                        zipfile.ZipFile(entry['archive'])
+            with metrics.phase('stage'):
+                _download_resources(
+                    manifest, download_workers, sync_manifest_path, options)
+        finally:
+            for archive in options['archives'].itervalues():
+                archive.close()
+            statistics = options['render_statistics']
+            if statistics['hits'] or statistics['misses']:
+                ctx.logger.debug(
+                    'Template cache: {0} hits, {1} misses.'.format(
+                        statistics['hits'], statistics['misses']))
+
+
+def _download_resources(manifest,
+                        download_workers,
+                        sync_manifest_path,
+                        options):
+    template_variables = options['template_variables']
+    resource_cache = options['resource_cache']
+    directories = set()
+    pending = []
+    for relative_path, entry in manifest.iteritems():
+        if entry['kind'] == RESOURCE_DIRECTORY:
+            directories.add(entry['dest'])
+        else:
+            directories.add(os.path.dirname(entry['dest']))
+            pending.append((relative_path, entry))
+
+    if sync_manifest_path:
+        working_directory = os.path.dirname(sync_manifest_path)
+        previous_sync_manifest = sync.load_manifest(sync_manifest_path)
+        variables_digest = sync.get_variables_digest(template_variables)
+        sync_manifest = {}
+        changed = []
+        for relative_path, entry in pending:
+            source_key = get_source_key(
+                entry, options['deployment_directory'], options['archives'])
+            entry_digest = variables_digest \
+                if entry['kind'] == RESOURCE_TEMPLATE else None
+            sync_entry = previous_sync_manifest.get(relative_path)
+            if sync.is_up_to_date(
+                    sync_entry, entry['dest'], source_key, entry_digest):
+                sync_manifest[relative_path] = sync_entry
+            else:
+                changed.append(
+                    (relative_path, entry, source_key, entry_digest))
+
+        removed = sync.remove_stale_entries(
+            working_directory,
+            previous_sync_manifest,
+            set(relative_path for relative_path, _ in pending) |
+            options['retained_paths'])
+        for relative_path in options['retained_paths']:
+            if relative_path in previous_sync_manifest:
+                sync_manifest[relative_path] = \
+                    previous_sync_manifest[relative_path]
+        ctx.logger.debug(
+            'Incremental sync: {0} up to date, {1} changed, '
+            '{2} removed.'.format(
+                len(sync_manifest), len(changed), len(removed)))
+        pending = [(relative_path, entry)
+                   for relative_path, entry, _, _ in changed]
+
+    # Create all of the target directories up front, so that the workers
+    # only have to write files.
+    for directory in directories:
+        try:
+            os.makedirs(directory)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
 
-        try:
-            ctx.download_resource(
-                resource_path,
-                download_to_file)
-            if os.path.splitext(download_to_file)[1] == '.py':
-                os.chmod(download_to_file, 0755)
-        except IOError as e:
-            if e.errno != errno.EISDIR:
-                raise
+    downloads = [(entry, options) for _, entry in pending]
+    if len(downloads) < 2 or download_workers == 1:
+        # A pool isn't worth starting for a single resource.
+        errors = map(_download_single_resource, downloads)
+    else:
+        errors = options['paths'].get_pool(download_workers).map(
+            _download_single_resource, downloads)
+
+    if resource_cache.get('enabled'):
+        cache.evict(
+            resource_cache.get('directory') or cache.DEFAULT_CACHE_DIRECTORY,
+            resource_cache.get('max_size', cache.DEFAULT_CACHE_MAX_SIZE))
+
+    if sync_manifest_path:
+        # Resources, which failed to be downloaded, are left out of the
+        # manifest, so that they are downloaded again next time.
+        for (relative_path, entry, source_key, entry_digest), error \
+                in zip(changed, errors):
+            if not error and os.path.isfile(entry['dest']):
+                sync_manifest[relative_path] = sync.get_entry(
+                    entry['dest'], source_key, entry_digest)
+        sync.save_manifest(sync_manifest_path, sync_manifest)
+
+    errors = [error for error in errors if error]
+    if errors and len(errors) == len(options['interrupted']):
+        # The partial files are kept, so the retry resumes the downloads.
+        raise OperationRetry(
+            'Interrupted download of {0} of {1} resources:\n{2}'.format(
+                len(errors), len(pending), '\n'.join(errors)))
+    if errors:
+        raise NonRecoverableError(
+            'Failed to download {0} of {1} resources:\n{2}'.format(
+                len(errors), len(pending), '\n'.join(errors)))
+
+
+def get_manifest_from_dir_and_list(resource_dir,
+                                   resource_list,
+                                   paths,
+                                   stream_archives=False,
+                                   metrics=NULL_METRICS,
+                                   extraction_settings=None):
+    # Case, when user defines a directory with files, which need to be
+    # downloaded, but doesn't want to render all of them - only these
+    # defined in resource_list.
+
+    ctx.logger.debug('resource_dir and resource_list params are not empty.')
+
+    deployment_directory = paths.deployment_directory
+    current_working_directory = paths.current_working_directory
+
+    # Deal with ZIP files. Archives in resource_list would be members of
+    # the resource_dir archive, so in such case it has to be extracted.
+    resources = None
+    filename, extension = os.path.splitext(resource_dir)
+    if extension == '.zip':
+        archive_path = os.path.join(deployment_directory, resource_dir)
+        if stream_archives and not any(
+                os.path.splitext(template_path)[1] == '.zip'
+                for template_path in resource_list):
+            with metrics.phase('walk'):
+                resources = walk_archive(
+                    archive_path, filename, extraction_settings)
+        else:
+            target_directory = os.path.join(deployment_directory, filename)
+            with metrics.phase('extract'):
+                extract_archive_from_path(
+                    archive_path, target_directory,
+                    extraction_settings=extraction_settings,
+                    metrics=metrics)
+        resource_dir = filename
 
-    return get_current_working_directory()
+    # This loop goes through a directory defined in resource_dir parameter
+    # and prepares a list of paths inside it.
+    if resources is None:
+        with metrics.phase('walk'):
+            resources = [
+                (resource_path, kind, None, None)
+                for resource_path, kind in walk_resources(
+                    os.path.join(deployment_directory, resource_dir),
+                    deployment_directory)]
 
+    # Deal with ZIP files in resource_list
+    templates = expand_resource_list(
+        resource_list,
+        os.path.join(deployment_directory, resource_dir),
+        stream_archives,
+        metrics,
+        extraction_settings)
+
+    manifest = OrderedDict()
+
+    # This loop adds all of the paths inside resource_dir to the manifest.
+    # By default they are copied unchanged to our working directory.
+    for resource_path, kind, archive, member in resources:
+        add_manifest_entry(
+            manifest, resource_path, kind,
+            member if archive else resource_path,
+            os.path.join(current_working_directory, resource_path),
+            archive)
 
-def get_package_dir_from_dir(resource_dir, template_variables={}):
+    # This loop goes through a templates list defined in resource_list
+    # parameter and marks each template to be rendered (resolves all of
+    # variables defined in template_variables parameter) instead of being
+    # copied.
+    listed_templates = get_listed_templates(resource_list)
+    for template_path, kind, archive, member in templates:
+        download_from_file = os.path.join(resource_dir, template_path)
+        listed = not archive and template_path in listed_templates
+        entry = manifest.get(download_from_file)
+        if not archive and entry and entry['archive']:
+            # The template is a member of the streamed resource_dir archive.
+            archive, member = entry['archive'], entry['source']
+        add_manifest_entry(
+            manifest, download_from_file,
+            RESOURCE_TEMPLATE if kind == RESOURCE_COPY else kind,
+            member if archive else download_from_file,
+            os.path.join(current_working_directory, download_from_file),
+            archive,
+            listed)
+
+    return manifest
+
+
+def get_manifest_from_dir(resource_dir,
+                          paths,
+                          stream_archives=False,
+                          metrics=NULL_METRICS,
+                          extraction_settings=None):
     # Case, when user defines path to a directory, where files, which need to
     # be downloaded and rendered, reside.
 
     ctx.logger.debug('only resource_dir is not empty.')
 
+    deployment_directory = paths.deployment_directory
+    current_working_directory = paths.current_working_directory
+
     # Deal with ZIP files
+    resources = None
     filename, extension = os.path.splitext(resource_dir)
     if extension == '.zip':
-        archive_path = os.path.join(get_deployment_directory(), resource_dir)
-        target_directory = os.path.join(get_deployment_directory(), filename)
+        archive_path = os.path.join(deployment_directory, resource_dir)
+        if stream_archives:
+            with metrics.phase('walk'):
+                resources = walk_archive(
+                    archive_path, filename, extraction_settings)
+        else:
+            target_directory = os.path.join(deployment_directory, filename)
+            with metrics.phase('extract'):
+                extract_archive_from_path(
+                    archive_path, target_directory,
+                    extraction_settings=extraction_settings,
+                    metrics=metrics)
         resource_dir = filename
-        extract_archive_from_path(archive_path, target_directory)
-
-    merged_list = []
 
     # This loop goes through a directory defined in resource_dir parameter
     # and prepares a list of paths inside it.
-    for resource_path in os.walk(
-            os.path.join(get_deployment_directory(), resource_dir)):
-        trimmed_resource_path = get_resource_relative_path(
-            resource_path, os.path.join(get_deployment_directory()))
-
-        if resource_path[2]:
-            for filename in resource_path[2]:
-                merged_list.append(
-                    os.path.join(trimmed_resource_path, filename))
-        elif not resource_path[1] and not resource_path[2]:
-            merged_list.append(trimmed_resource_path)
-
-    # This loop goes through the merged_list and downloads the rest of
-    # files to our working directory.
-    for template_path in merged_list:
-        template_dirname = os.path.dirname(template_path)
-        download_from_file = template_path
-        download_to_directory = os.path.join(
-            get_current_working_directory(), template_dirname)
-        download_to_file = os.path.join(
-            get_current_working_directory(), download_from_file)
-
-        try:
-            os.makedirs(download_to_directory)
-        except OSError as e:
-            if e.errno != errno.EEXIST:
-                raise
-
-        try:
-            ctx.download_resource_and_render(
-                download_from_file,
-                download_to_file,
-                template_variables.copy())
-            if os.path.splitext(download_to_file)[1] == '.py':
-                os.chmod(download_to_file, 0755)
-        except IOError as e:
-            if e.errno != errno.EISDIR:
-                raise
-
-    return get_current_working_directory()
-
-
-def get_package_dir_from_list(resource_list, template_variables={}):
+    if resources is None:
+        with metrics.phase('walk'):
+            resources = [
+                (resource_path, kind, None, None)
+                for resource_path, kind in walk_resources(
+                    os.path.join(deployment_directory, resource_dir),
+                    deployment_directory)]
+
+    # All of the files are added to the manifest as templates.
+    manifest = OrderedDict()
+    for resource_path, kind, archive, member in resources:
+        add_manifest_entry(
+            manifest, resource_path,
+            RESOURCE_TEMPLATE if kind == RESOURCE_COPY else kind,
+            member if archive else resource_path,
+            os.path.join(current_working_directory, resource_path),
+            archive)
+
+    return manifest
+
+
+def get_manifest_from_list(resource_list,
+                           paths,
+                           stream_archives=False,
+                           metrics=NULL_METRICS,
+                           extraction_settings=None):
     # Case, when user defines a list of files in resource_list,
     # which need to be downloaded and rendered.
 
     ctx.logger.debug('only resource_list is not empty.')
 
-    # Deal with ZIP files in resource_list
-    for template_path in copy.copy(resource_list):
-
-        filename, extension = os.path.splitext(template_path)
-
-        if extension == '.zip':
+    current_working_directory = paths.current_working_directory
 
-            resource_list.remove(template_path)
-
-            archive_path = os.path.join(
-                get_deployment_directory(), template_path)
-            target_directory = os.path.join(
-                get_deployment_directory(), filename)
-            extract_archive_from_path(archive_path, target_directory)
-
-            for extracted_template in os.walk(target_directory):
-                extracted_template_path = get_resource_relative_path(
-                    extracted_template, get_deployment_directory())
-                if extracted_template[2]:
-                    for filename in extracted_template[2]:
-                        resource_list.append(
-                            os.path.join(extracted_template_path, filename))
-                elif not extracted_template[1] and not extracted_template[2]:
-                    resource_list.append(extracted_template_path)
-
-    for template_path in resource_list:
+    # Deal with ZIP files in resource_list
+    templates = expand_resource_list(
+        resource_list, paths.deployment_directory, stream_archives, metrics,
+        extraction_settings)
+
+    # All of the templates are downloaded directly to our working directory.
+    manifest = OrderedDict()
+    listed_templates = get_listed_templates(resource_list)
+    for template_path, kind, archive, member in templates:
         resource_name = os.path.basename(template_path)
-        download_to = os.path.join(
-            get_current_working_directory(), resource_name)
-        try:
-            ctx.download_resource_and_render(
-                template_path,
-                download_to,
-                template_variables.copy())
-        except IOError as e:
-            if e.errno != errno.EISDIR:
-                raise
+        add_manifest_entry(
+            manifest, resource_name,
+            RESOURCE_TEMPLATE if kind == RESOURCE_COPY else kind,
+            member if archive else template_path,
+            os.path.join(current_working_directory, resource_name),
+            archive,
+            not archive and template_path in listed_templates)
 
-    return get_current_working_directory()
+    return manifest
 
 
-def get_package_dir(resource_dir='', resource_list=[], template_variables={}):
-    """ Download resources and return the path. """
+def get_package_manifest(resource_dir='',
+                         resource_list=[],
+                         paths=None,
+                         stream_archives=False,
+                         template_filter=None,
+                         metrics=NULL_METRICS,
+                         extraction_settings=None):
+    """ Prepare the staging manifest of a package. """
+
+    paths = paths or ResolvedPaths()
 
     if resource_dir and resource_list:
-        return get_package_dir_from_dir_and_list(
-            resource_dir=resource_dir,
-            resource_list=resource_list,
-            template_variables=template_variables)
+        manifest = get_manifest_from_dir_and_list(
+            resource_dir, resource_list, paths, stream_archives, metrics,
+            extraction_settings)
     elif resource_dir and not resource_list:
-        return get_package_dir_from_dir(
-            resource_dir=resource_dir,
-            template_variables=template_variables)
+        manifest = get_manifest_from_dir(
+            resource_dir, paths, stream_archives, metrics,
+            extraction_settings)
     elif not resource_dir and resource_list:
-        return get_package_dir_from_list(
-            resource_list=resource_list,
-            template_variables=template_variables)
+        manifest = get_manifest_from_list(
+            resource_list, paths, stream_archives, metrics,
+            extraction_settings)
     else:
         raise NonRecoverableError("At least one of the two properties, \
             resource_dir or resource_list, has to be defined.")
+    return classify_templates(manifest, template_filter, paths, metrics)
+
+
+def get_package_dir_from_dir_and_list(
+        resource_dir,
+        resource_list,
+        template_variables={},
+        download_workers=DEFAULT_DOWNLOAD_WORKERS,
+        resource_cache=None,
+        incremental=False,
+        paths=None,
+        stream_archives=False,
+        render_locally=False,
+        template_filter=None,
+        metrics=NULL_METRICS,
+        local_resources=LOCAL_RESOURCES_COPY,
+        transfer_settings=None,
+        extraction_settings=None):
+    with resolve_paths(paths) as paths:
+        manifest = get_manifest_from_dir_and_list(
+            resource_dir, resource_list, paths, stream_archives, metrics,
+            extraction_settings)
+        classify_templates(manifest, template_filter, paths, metrics)
+        return stage_manifest(
+            manifest, template_variables, download_workers, resource_cache,
+            incremental, paths, render_locally, metrics=metrics,
+            local_resources=local_resources,
+            transfer_settings=transfer_settings)
+
+
+def get_package_dir_from_dir(resource_dir,
+                             template_variables={},
+                             download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                             resource_cache=None,
+                             incremental=False,
+                             paths=None,
+                             stream_archives=False,
+                             render_locally=False,
+                             template_filter=None,
+                             metrics=NULL_METRICS,
+                             local_resources=LOCAL_RESOURCES_COPY,
+                             transfer_settings=None,
+                             extraction_settings=None):
+    with resolve_paths(paths) as paths:
+        manifest = get_manifest_from_dir(
+            resource_dir, paths, stream_archives, metrics, extraction_settings)
+        classify_templates(manifest, template_filter, paths, metrics)
+        return stage_manifest(
+            manifest, template_variables, download_workers, resource_cache,
+            incremental, paths, render_locally, metrics=metrics,
+            local_resources=local_resources,
+            transfer_settings=transfer_settings)
+
+
+def get_package_dir_from_list(resource_list,
+                              template_variables={},
+                              download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                              resource_cache=None,
+                              incremental=False,
+                              paths=None,
+                              stream_archives=False,
+                              render_locally=False,
+                              template_filter=None,
+                              metrics=NULL_METRICS,
+                              local_resources=LOCAL_RESOURCES_COPY,
+                              transfer_settings=None,
+                              extraction_settings=None):
+    with resolve_paths(paths) as paths:
+        manifest = get_manifest_from_list(
+            resource_list, paths, stream_archives, metrics,
+            extraction_settings)
+        classify_templates(manifest, template_filter, paths, metrics)
+        return stage_manifest(
+            manifest, template_variables, download_workers, resource_cache,
+            incremental, paths, render_locally, metrics=metrics,
+            local_resources=local_resources,
+            transfer_settings=transfer_settings)
+
+
+def stage_manifest(manifest,
+                   template_variables={},
+                   download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                   resource_cache=None,
+                   incremental=False,
+                   paths=None,
+                   render_locally=False,
+                   template_sources=None,
+                   metrics=NULL_METRICS,
+                   local_resources=LOCAL_RESOURCES_COPY,
+                   transfer_settings=None,
+                   retained_paths=()):
+    """ Download resources of a manifest and return the path. """
+
+    with resolve_paths(paths) as paths:
+        current_working_directory = paths.current_working_directory
+        download_resources(
+            manifest, template_variables, download_workers, resource_cache,
+            sync.get_manifest_path(current_working_directory)
+            if incremental else None,
+            paths, render_locally, template_sources, metrics, local_resources,
+            transfer_settings, retained_paths)
+        return current_working_directory
+
+
+def stage_package_manifest(manifest,
+                           package_parameters,
+                           paths,
+                           metrics=NULL_METRICS):
+    """
+    Stage a manifest with the parameters of parse_resource_config and return
+    the path.
+    """
+    return stage_manifest(
+        manifest,
+        package_parameters['template_variables'],
+        package_parameters['download_workers'],
+        package_parameters['resource_cache'],
+        package_parameters['incremental'],
+        paths,
+        package_parameters['render_locally'],
+        metrics=metrics,
+        local_resources=package_parameters['local_resources'],
+        transfer_settings=package_parameters['transfer_settings'])
+
+
+def get_package_dir(resource_dir='',
+                    resource_list=[],
+                    template_variables={},
+                    download_workers=DEFAULT_DOWNLOAD_WORKERS,
+                    resource_cache=None,
+                    incremental=False,
+                    paths=None,
+                    stream_archives=False,
+                    render_locally=False,
+                    template_filter=None,
+                    metrics=NULL_METRICS,
+                    local_resources=LOCAL_RESOURCES_COPY,
+                    transfer_settings=None,
+                    extraction_settings=None):
+    """ Download resources and return the path. """
+
+    with resolve_paths(paths) as paths:
+        manifest = get_package_manifest(
+            resource_dir, resource_list, paths, stream_archives,
+            template_filter, metrics, extraction_settings)
+        return stage_manifest(
+            manifest, template_variables, download_workers, resource_cache,
+            incremental, paths, render_locally, metrics=metrics,
+            local_resources=local_resources,
+            transfer_settings=transfer_settings)
 
 
-def handle_overrides(overrides, current):
+def handle_overrides(overrides, current, base_env=None, environment=None):
+    """
+    Apply subprocess_args_overrides to the arguments of subprocess.Popen.
+
+    :param environment: Dict of variables exported by the plugin, which
+        are added to the environment after the overrides
+    """
     if not isinstance(overrides, dict):
         INVALID_OVERRIDES_ERROR = \
             'Invalid overrides {0}: not a dict.'
         ctx.logger.debug(
             INVALID_OVERRIDES_ERROR.format(overrides))
-        return
-    if overrides.pop('PERSIST_CFY_AGENT_ENV_BOOL', True):
-        env = os.environ.copy()
+        overrides = {}
+    elif overrides.pop('PERSIST_CFY_AGENT_ENV_BOOL', True):
+        env = (os.environ if base_env is None else base_env).copy()
         _overrides_env = overrides.pop('env', {})
         _overrides_path = _overrides_env.pop('PATH', '')
         if _overrides_path:
@@ -364,22 +1480,180 @@ def handle_overrides(overrides, current):
         env.update(_overrides_env)
         overrides['env'] = env
     current.update(overrides)
+    if environment:
+        env = current.get('env')
+        if env is None:
+            env = os.environ if base_env is None else base_env
+        current['env'] = dict(env, **environment)
 
 
-def execute(resource_config,
-            file_to_source='exec',
-            subprocess_args_overrides=None,
-            ignore_failure=False,
-            retry_on_failure=False, **_):
+def _read_pipe(name, pipe, output_queue):
+    try:
+        for line in iter(pipe.readline, b''):
+            output_queue.put((name, line.rstrip('\n')))
+    finally:
+        pipe.close()
+        output_queue.put((name, None))
 
-    """ Execute some file in an extracted archive. """
 
-    resource_config = \
-        resource_config or ctx.node.properties['resource_config']
+def stream_process_output(process, log_prefix='', emit=None):
+    """
+    Forward stdout and stderr of a process to the logger as they arrive.
+    Both pipes are read by separate threads, so neither of them can block
+    the process. The queue between the readers and the logger is bounded,
+    so memory usage doesn't depend on the amount of output.
+
+    :param process: subprocess.Popen object
+    :param log_prefix: String object prepended to each logged batch
+    :param emit: Function called with the name of the pipe and a list of
+        lines instead of logging them
+    :return: String object containing the last STDERR_TAIL_LINES lines
+        of stderr
+    """
+
+    # Nothing is going to be written to stdin, close it as communicate() does.
+    if process.stdin:
+        process.stdin.close()
+
+    output_queue = Queue.Queue(OUTPUT_QUEUE_SIZE)
+    readers = []
+    for name, pipe in (('Out', process.stdout), ('Err', process.stderr)):
+        if not pipe:
+            continue
+        reader = threading.Thread(
+            target=_read_pipe, args=(name, pipe, output_queue))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+
+    batches = {'Out': [], 'Err': []}
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+    def flush():
+        for name in ('Out', 'Err'):
+            if batches[name]:
+                if emit:
+                    emit(name, batches[name])
+                else:
+                    ctx.logger.debug('{0}{1}: {2}'.format(
+                        log_prefix, name, '\n'.join(batches[name])))
+                batches[name] = []
+
+    open_pipes = len(readers)
+    last_flush = time.time()
+    while open_pipes:
+        try:
+            name, line = output_queue.get(timeout=OUTPUT_FLUSH_INTERVAL)
+        except Queue.Empty:
+            pass
+        else:
+            if line is None:
+                open_pipes -= 1
+            else:
+                batches[name].append(line)
+                if name == 'Err':
+                    stderr_tail.append(line)
+        if time.time() - last_flush >= OUTPUT_FLUSH_INTERVAL or \
+                any(len(batch) >= OUTPUT_BATCH_LINES
+                    for batch in batches.values()):
+            flush()
+            last_flush = time.time()
+    flush()
+
+    for reader in readers:
+        reader.join()
+    process.wait()
+    return '\n'.join(stderr_tail)
+
+
+def get_preexec_fn(resource_limits):
+    """
+    :param resource_limits: Dict mapping keys of RESOURCE_LIMITS to values
+    :return: Function, which is called in the child process before the
+        script is executed. It makes the child a leader of a new process
+        group, so that the whole tree can be killed, and sets the limits.
+    """
+    limits = [(RESOURCE_LIMITS[name], value)
+              for name, value in resource_limits.items()]
+
+    def preexec_fn():
+        os.setsid()
+        for limit, value in limits:
+            resource.setrlimit(limit, (value, value))
+
+    return preexec_fn
+
+
+def kill_process_group(process, signal_number):
+    # Signal the whole process group only if the process leads its own
+    # group, otherwise the agent itself would be signalled.
+    try:
+        if os.getpgid(process.pid) == process.pid:
+            os.killpg(process.pid, signal_number)
+        else:
+            os.kill(process.pid, signal_number)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def start_watchdog(process,
+                   timeout,
+                   kill_timeout=DEFAULT_KILL_TIMEOUT,
+                   logger=None):
+    """
+    Terminate the process group of a process, which runs longer than
+    timeout seconds, and kill it if it doesn't exit within kill_timeout
+    seconds after that.
+
+    :return: Tuple of threading.Event objects (finished, timed_out). The
+        caller sets finished once the process exits, timed_out is set by
+        the watchdog.
+    """
+    finished = threading.Event()
+    timed_out = threading.Event()
+    logger = logger or ctx.logger
+
+    def watch():
+        if finished.wait(timeout):
+            return
+        timed_out.set()
+        logger.warn(
+            'Process {0} timed out after {1} seconds, terminating.'.format(
+                process.pid, timeout))
+        kill_process_group(process, signal.SIGTERM)
+        if not finished.wait(kill_timeout):
+            logger.warn('Process {0} is still running, killing.'.format(
+                process.pid))
+            kill_process_group(process, signal.SIGKILL)
+
+    watchdog = threading.Thread(target=watch)
+    watchdog.daemon = True
+    watchdog.start()
+    return finished, timed_out
+
+
+def parse_resource_config(resource_config):
+    """
+    Validate resource_config and fill in the defaults.
+
+    :return: Dict of parameters of get_package_dir
+    """
 
     resource_dir = resource_config.get('resource_dir', '')
     resource_list = resource_config.get('resource_list', [])
     template_variables = resource_config.get('template_variables', {})
+    download_workers = resource_config.get(
+        'download_workers', DEFAULT_DOWNLOAD_WORKERS)
+    resource_cache = resource_config.get('resource_cache', {})
+    incremental = resource_config.get('incremental', False)
+    stream_archives = resource_config.get('stream_archives', False)
+    render_locally = resource_config.get('render_locally', False)
+    template_filter = resource_config.get('template_filter', {})
+    local_resources = resource_config.get(
+        'local_resources', LOCAL_RESOURCES_COPY)
+    transfer_settings = resource_config.get('transfer', {})
+    extraction_settings = resource_config.get('extraction', {})
 
     if not isinstance(resource_dir, basestring):
         raise NonRecoverableError("'resource_dir' must be a string.")
@@ -390,14 +1664,300 @@ def execute(resource_config,
     if not isinstance(template_variables, dict):
         raise NonRecoverableError("'template_variables' must be a dictionary.")
 
+    if not isinstance(download_workers, int) or download_workers < 1:
+        raise NonRecoverableError(
+            "'download_workers' must be a positive integer.")
+
+    if not isinstance(resource_cache, dict):
+        raise NonRecoverableError("'resource_cache' must be a dictionary.")
+
+    if not isinstance(template_filter, dict) or not all(
+            isinstance(template_filter.get(key, []), list)
+            for key in ('include', 'exclude')):
+        raise NonRecoverableError(
+            "'template_filter' must be a dictionary with lists of globs "
+            "in 'include' and 'exclude'.")
+
+    if local_resources not in LOCAL_RESOURCES_MODES:
+        raise NonRecoverableError(
+            "'local_resources' must be one of: {0}.".format(
+                ', '.join(LOCAL_RESOURCES_MODES)))
+
+    if not isinstance(transfer_settings, dict) or \
+            not isinstance(transfer_settings.get('checksums', {}), dict):
+        raise NonRecoverableError(
+            "'transfer' must be a dictionary with a dictionary of resource "
+            "paths and their SHA-256 in 'checksums'.")
+
+    if not isinstance(transfer_settings.get(
+            'chunk_size', transfer.DEFAULT_CHUNK_SIZE), int) or \
+            transfer_settings.get('chunk_size', 1) < 1:
+        raise NonRecoverableError(
+            "'transfer.chunk_size' must be a positive integer.")
+
+    if not isinstance(extraction_settings, dict) or not all(
+            isinstance(extraction_settings.get(key, 0), (int, long)) and
+            extraction_settings.get(key, 0) >= 0
+            for key in ('workers', 'max_size', 'max_members', 'max_ratio')):
+        raise NonRecoverableError(
+            "'extraction' must be a dictionary of non-negative integers.")
+
+    return {
+        'resource_dir': resource_dir,
+        'resource_list': resource_list,
+        'template_variables': template_variables,
+        'download_workers': download_workers,
+        'resource_cache': resource_cache,
+        'incremental': incremental,
+        'stream_archives': stream_archives,
+        'render_locally': render_locally,
+        'template_filter': template_filter,
+        'local_resources': local_resources,
+        'transfer_settings': transfer_settings,
+        'extraction_settings': extraction_settings
+    }
+
+
+def parse_lazy_settings(resource_config):
+    """
+    :return: Dict with keys: enabled (bool) and eager (list of globs
+        matched against paths in the working directory)
+    """
+    lazy_settings = resource_config.get('lazy', {})
+    if not isinstance(lazy_settings, dict) or \
+            not isinstance(lazy_settings.get('eager', []), list):
+        raise NonRecoverableError(
+            "'lazy' must be a dictionary with a list of globs in 'eager'.")
+    return lazy_settings
+
+
+def parse_workspace_settings(resource_config):
+    """
+    :return: Dict with keys: root, max_size, report_usage, max_age,
+        max_total_size and gc_interval
+    """
+    workspace_settings = resource_config.get('workspace', {})
+    if not isinstance(workspace_settings, dict):
+        raise NonRecoverableError("'workspace' must be a dictionary.")
+    for key in ('max_size', 'max_age', 'max_total_size', 'gc_interval'):
+        value = workspace_settings.get(key)
+        if value is not None and (
+                not isinstance(value, (int, long, float)) or value < 0):
+            raise NonRecoverableError(
+                "'workspace.{0}' must be a positive number.".format(key))
+    return workspace_settings
+
+
+def parse_step_settings(resource_config):
+    """
+    :return: Dict with keys: steps (list of dicts with keys: id,
+        file_to_source, cwd, env, depends_on and timeout), workers and
+        policy
+    """
+    step_settings = {
+        'steps': resource_config.get('steps', []),
+        'workers': resource_config.get('step_workers', dag.DEFAULT_WORKERS),
+        'policy': resource_config.get('step_policy', dag.POLICY_FAIL_FAST)
+    }
+
+    if not isinstance(step_settings['steps'], list) or not all(
+            isinstance(step, dict) and
+            isinstance(step.get('id'), basestring) and
+            isinstance(step.get('file_to_source', ''), basestring) and
+            isinstance(step.get('cwd', ''), basestring) and
+            isinstance(step.get('env', {}), dict) and
+            isinstance(step.get('depends_on', []), list)
+            for step in step_settings['steps']):
+        raise NonRecoverableError(
+            "'steps' must be a list of dictionaries with keys: id, "
+            "file_to_source, cwd, env (dictionary) and depends_on "
+            "(list of ids).")
+
+    if not isinstance(step_settings['workers'], int) or \
+            step_settings['workers'] < 1:
+        raise NonRecoverableError("'step_workers' must be a positive integer.")
+
+    if step_settings['policy'] not in dag.POLICIES:
+        raise NonRecoverableError("'step_policy' must be one of: {0}.".format(
+            ', '.join(dag.POLICIES)))
+
+    for step in step_settings['steps']:
+        validate_process_limits(
+            step.get('timeout'), DEFAULT_KILL_TIMEOUT, {})
+
+    try:
+        dag.get_order(step_settings['steps'])
+    except dag.InvalidSteps as e:
+        raise NonRecoverableError(str(e))
+    return step_settings
+
+
+def collect_workspace_garbage(workspace_settings, transfer_settings=None):
+    """
+    Remove unused workspaces and stale partial downloads, unless it was done
+    recently.
+    """
+    result = workspace.collect_garbage_if_due(
+        workspace_settings.get('root') or workspace.DEFAULT_WORKSPACE_ROOT,
+        workspace_settings.get('gc_interval', workspace.DEFAULT_GC_INTERVAL),
+        max_age=workspace_settings.get('max_age'),
+        max_total_size=workspace_settings.get('max_total_size'),
+        stale_directories=[
+            (transfer_settings or {}).get('directory') or
+            transfer.DEFAULT_PARTIAL_DIRECTORY])
+    if result and (result['workspaces'] or result['bytes']):
+        ctx.logger.info(
+            'Removed {0} unused workspaces, reclaimed {1} bytes.'.format(
+                result['workspaces'], result['bytes']))
+
+
+def check_workspace_usage(working_directory,
+                          workspace_settings,
+                          enforce=True):
+    """
+    Store the disk usage of a workspace in the workspace_usage runtime
+    property and check it against the quota (max_size bytes), if either of
+    them is enabled.
+
+    :param enforce: Raise NonRecoverableError if the quota is exceeded,
+        otherwise only warn
+    """
+    max_size = workspace_settings.get('max_size')
+    if not max_size and not workspace_settings.get('report_usage'):
+        return
+    usage = workspace.get_usage(working_directory)
+    ctx.instance.runtime_properties['workspace_usage'] = usage
+    if max_size and usage['bytes'] > max_size:
+        message = 'Workspace {0} takes {1} bytes, its quota is {2}.'.format(
+            working_directory, usage['bytes'], max_size)
+        if enforce:
+            raise NonRecoverableError(message)
+        ctx.logger.warn(message)
+
+
+def get_lazy_package_dir(package_parameters, lazy_settings, paths, metrics):
+    """
+    Stage directories and the eager resources of a package and start
+    a server, which stages the other resources on demand.
+
+    :return: Tuple (working directory, started lazy.FetchServer)
+    """
+    manifest = get_package_manifest(
+        package_parameters['resource_dir'],
+        package_parameters['resource_list'],
+        paths,
+        package_parameters['stream_archives'],
+        package_parameters['template_filter'],
+        metrics,
+        package_parameters['extraction_settings'])
+    eager_manifest, lazy_manifest = lazy.split_manifest(
+        manifest, lazy_settings.get('eager', []), RESOURCE_DIRECTORY)
+    ctx.logger.debug('Lazy staging: {0} eager, {1} lazy resources.'.format(
+        len(eager_manifest), len(lazy_manifest)))
+    working_directory = stage_manifest(
+        eager_manifest,
+        package_parameters['template_variables'],
+        package_parameters['download_workers'],
+        package_parameters['resource_cache'],
+        package_parameters['incremental'],
+        paths,
+        package_parameters['render_locally'],
+        metrics=metrics,
+        local_resources=package_parameters['local_resources'],
+        transfer_settings=package_parameters['transfer_settings'],
+        retained_paths=set(lazy_manifest))
+
+    def fetch(requested_manifest):
+        ctx.logger.debug('Fetching {0}'.format(', '.join(requested_manifest)))
+        download_resources(
+            requested_manifest,
+            package_parameters['template_variables'],
+            package_parameters['download_workers'],
+            package_parameters['resource_cache'],
+            paths=paths,
+            render_locally=package_parameters['render_locally'],
+            metrics=metrics,
+            local_resources=package_parameters['local_resources'],
+            transfer_settings=package_parameters['transfer_settings'])
+
+    fetch_server = lazy.FetchServer(working_directory, lazy_manifest, fetch)
+    fetch_server.start()
+    return working_directory, fetch_server
+
+
+def validate_process_limits(timeout, kill_timeout, resource_limits):
+    if timeout is not None and (
+            not isinstance(timeout, (int, float)) or timeout < 0):
+        raise NonRecoverableError("'timeout' must be a positive number.")
+
+    if not isinstance(kill_timeout, (int, float)) or kill_timeout < 0:
+        raise NonRecoverableError("'kill_timeout' must be a positive number.")
+
+    if not isinstance(resource_limits, dict) or \
+            set(resource_limits) - set(RESOURCE_LIMITS) or \
+            not all(isinstance(value, (int, long)) and value > 0
+                    for value in resource_limits.values()):
+        raise NonRecoverableError(
+            "'resource_limits' must be a dictionary with positive integer "
+            "values of {0}.".format(', '.join(sorted(RESOURCE_LIMITS))))
+
+
+def validate_persistent_worker(persistent_worker):
+    if persistent_worker is None:
+        return
+    if not isinstance(persistent_worker, dict) or \
+            not isinstance(persistent_worker.get('prepare', ''),
+                           basestring) or \
+            not isinstance(persistent_worker.get(
+                'idle_timeout', worker.DEFAULT_IDLE_TIMEOUT),
+                (int, float)):
+        raise NonRecoverableError(
+            "'persistent_worker' must be a dictionary with keys: enabled, "
+            "prepare (path) and idle_timeout (seconds).")
+
+
+def get_script_directory(working_directory, resource_dir):
+    # in case of resource_dir is zip
     if resource_dir:
-        tmp_dir = get_package_dir(
-            resource_dir, resource_list, template_variables)
-        # in case of resource_dir is zip
-        cwd = os.path.join(
-            tmp_dir, os.path.splitext(resource_dir)[0])
-    else:
-        cwd = get_package_dir(resource_dir, resource_list, template_variables)
+        return os.path.join(
+            working_directory, os.path.splitext(resource_dir)[0])
+    return working_directory
+
+
+def run_script(cwd,
+               file_to_source='exec',
+               subprocess_args_overrides=None,
+               timeout=None,
+               kill_timeout=DEFAULT_KILL_TIMEOUT,
+               resource_limits=None,
+               log_prefix='',
+               persistent_worker=None,
+               environment=None):
+    """
+    Source a file in a bash subprocess and wait for it to finish.
+
+    :param persistent_worker: Dict with keys: enabled, prepare (path of
+        a script relative to cwd, which prepares the environment of the
+        worker) and idle_timeout. If enabled, the file is sourced by the
+        persistent worker of the deployment, or in a new subprocess, if
+        the worker is not available.
+    :param environment: Dict of variables exported by the plugin (see
+        handle_overrides)
+    :return: Tuple (returncode, err, timed_out), where err contains the tail
+        of stderr of the process
+    """
+
+    if persistent_worker and persistent_worker.get('enabled'):
+        try:
+            return run_script_in_worker(
+                cwd, file_to_source, subprocess_args_overrides, timeout,
+                kill_timeout, resource_limits, log_prefix, persistent_worker,
+                environment)
+        except worker.WorkerUnavailable as e:
+            ctx.logger.warn(
+                '{0}Persistent worker is not available, running the script '
+                'in a new process: {1}'.format(log_prefix, e))
+
     command = ['bash', '-c', 'source {0}'.format(file_to_source)]
 
     subprocess_args = \
@@ -406,21 +1966,967 @@ def execute(resource_config,
             'stdin': subprocess.PIPE,
             'stdout': subprocess.PIPE,
             'stderr': subprocess.PIPE,
-            'cwd': cwd
+            'cwd': cwd,
+            'preexec_fn': get_preexec_fn(resource_limits or {})
+        }
+
+    handle_overrides(
+        subprocess_args_overrides, subprocess_args, environment=environment)
+
+    ctx.logger.debug('{0}Args: {1}'.format(log_prefix, subprocess_args))
+
+    process = subprocess.Popen(**subprocess_args)
+
+    if not timeout:
+        err = stream_process_output(process, log_prefix)
+        return process.returncode, err, False
+
+    finished, timed_out = start_watchdog(process, timeout, kill_timeout)
+    try:
+        err = stream_process_output(process, log_prefix)
+    finally:
+        finished.set()
+    return process.returncode, err, timed_out.is_set()
+
+
+def run_script_with_outputs(cwd,
+                            file_to_source='exec',
+                            subprocess_args_overrides=None,
+                            timeout=None,
+                            kill_timeout=DEFAULT_KILL_TIMEOUT,
+                            resource_limits=None,
+                            log_prefix='',
+                            persistent_worker=None):
+    """
+    Run a script by run_script with the path of a file for its outputs
+    exported in the EXEC_OUTPUTS variable.
+
+    :return: Tuple (returncode, err, timed_out, script_outputs), where
+        script_outputs is a dict of the outputs written by the script, empty
+        if it failed or timed out
+    """
+    outputs_path = outputs.create_outputs_file()
+    try:
+        returncode, err, timed_out = run_script(
+            cwd, file_to_source, subprocess_args_overrides, timeout,
+            kill_timeout, resource_limits, log_prefix, persistent_worker,
+            {outputs.OUTPUTS_VARIABLE: outputs_path})
+        script_outputs = {}
+        try:
+            if returncode == 0 and not timed_out:
+                script_outputs = outputs.read_outputs(
+                    outputs_path, reserved=RESERVED_RUNTIME_PROPERTIES)
+        except outputs.InvalidOutputs as e:
+            raise NonRecoverableError(
+                '{0}Invalid outputs: {1}'.format(log_prefix, e))
+    finally:
+        outputs.remove_outputs_file(outputs_path)
+    return returncode, err, timed_out, script_outputs
+
+
+def apply_outputs(script_outputs):
+    """
+    Apply the outputs of scripts to the runtime properties in one update.
+    Should be called only after all of the scripts succeeded.
+    """
+    if script_outputs:
+        ctx.instance.runtime_properties.update(script_outputs)
+
+
+def run_steps(cwd,
+              step_settings,
+              subprocess_args_overrides=None,
+              timeout=None,
+              kill_timeout=DEFAULT_KILL_TIMEOUT,
+              resource_limits=None,
+              persistent_worker=None):
+    """
+    Run the steps of step_settings in the working directory. Each step
+    sources its own file in its own directory (relative to cwd) with its
+    env added to subprocess_args_overrides. The results of the steps are
+    stored in the step_results runtime property.
+
+    :return: Tuple (returncode, err, timed_out, script_outputs) of all of
+        the steps, where err lists the steps, which failed or were skipped,
+        and script_outputs merges the outputs in the order of the steps
+    """
+
+    step_outputs = {}
+
+    def run_step(step):
+        overrides = copy.deepcopy(subprocess_args_overrides) or {}
+        overrides.setdefault('env', {}).update(step.get('env', {}))
+        step_cwd = os.path.join(cwd, step.get('cwd', ''))
+        # A relative path, so that source doesn't search PATH for it.
+        file_to_source = os.path.join('.', step.get('file_to_source', 'exec'))
+        returncode, err, timed_out, step_outputs[step['id']] = \
+            run_script_with_outputs(
+                step_cwd, file_to_source, overrides,
+                step.get('timeout', timeout), kill_timeout, resource_limits,
+                '[{0}] '.format(step['id']), persistent_worker)
+        return {'returncode': returncode, 'stderr': err,
+                'timed_out': timed_out, 'working_directory': step_cwd}
+
+    results = dag.run_steps(
+        step_settings['steps'],
+        run_step,
+        step_settings['workers'],
+        step_settings['policy'],
+        current_ctx.set,
+        (current_ctx.get_ctx(),))
+    ctx.instance.runtime_properties['step_results'] = results
+    script_outputs = {}
+    for step in step_settings['steps']:
+        script_outputs.update(step_outputs.get(step['id'], {}))
+
+    failed = [step['id'] for step in step_settings['steps']
+              if results[step['id']]['status'] != dag.STATUS_SUCCEEDED]
+    err = '\n'.join(
+        '{0} ({1}): {2}'.format(
+            step_id, results[step_id]['status'], results[step_id]['stderr'])
+        for step_id in failed)
+    return (1 if failed else 0,
+            'Failed steps:\n{0}'.format(err) if failed else '',
+            any(result['timed_out'] for result in results.values()),
+            script_outputs)
+
+
+def get_metrics(collect_metrics, store_metrics):
+    return Metrics() if collect_metrics or store_metrics else NULL_METRICS
+
+
+def report_metrics(metrics, store_metrics=False):
+    """
+    Log the metrics of the operation as a single JSON document and store
+    them in the exec_metrics runtime property, if store_metrics is True.
+    """
+    report = metrics.report()
+    if report is None:
+        return
+    ctx.logger.info('Metrics: {0}'.format(json.dumps(report)))
+    if store_metrics:
+        ctx.instance.runtime_properties['exec_metrics'] = report
+
+
+def run_script_in_worker(cwd,
+                         file_to_source,
+                         subprocess_args_overrides,
+                         timeout,
+                         kill_timeout,
+                         resource_limits,
+                         log_prefix,
+                         persistent_worker,
+                         environment=None):
+    prepare_path = None
+    if persistent_worker.get('prepare'):
+        prepare_path = os.path.join(cwd, persistent_worker['prepare'])
+        if not os.path.isfile(prepare_path):
+            raise worker.WorkerUnavailable(
+                'No prepare script {0}.'.format(prepare_path))
+    socket_path = worker.get_socket_path(
+        ctx.tenant_name, ctx.deployment.id, prepare_path)
+    ctx.logger.debug('{0}Running {1} in worker {2}.'.format(
+        log_prefix, file_to_source, socket_path))
+    return worker.run_in_worker(
+        socket_path,
+        {
+            'file_to_source': file_to_source,
+            'cwd': cwd,
+            # The overrides are applied by the worker on top of the
+            # prepared environment.
+            'overrides': copy.deepcopy(subprocess_args_overrides),
+            'environment': environment or {},
+            'timeout': timeout,
+            'kill_timeout': kill_timeout,
+            'resource_limits': resource_limits or {}
+        },
+        lambda name, lines: ctx.logger.debug('{0}{1}: {2}'.format(
+            log_prefix, name, '\n'.join(lines))),
+        persistent_worker.get('idle_timeout', worker.DEFAULT_IDLE_TIMEOUT),
+        prepare_path)
+
+
+def split_templates(manifest):
+    """
+    :return: Tuple of staging manifests (resources, templates), where
+        templates has the entries of manifest, which are rendered, and
+        resources all of the others
+    """
+    resources = OrderedDict()
+    templates = OrderedDict()
+    for relative_path, entry in manifest.iteritems():
+        if entry['kind'] == RESOURCE_TEMPLATE:
+            templates[relative_path] = entry
+        else:
+            resources[relative_path] = entry
+    return resources, templates
+
+
+def get_prefetched_directory(manifest, resource_config, prefetched, paths):
+    """
+    :param prefetched: Dict stored by prefetch with keys: fingerprint and
+        working_directory
+    :return: Working directory staged by prefetch or None, if the package
+        or resource_config changed since or the directory isn't current
+    """
+    if prefetched['working_directory'] != \
+            paths.current_working_directory or \
+            not os.path.isdir(prefetched['working_directory']):
+        return None
+    if get_package_fingerprint(
+            manifest, [resource_config], paths.deployment_directory) != \
+            prefetched['fingerprint']:
+        ctx.logger.debug('The prefetched package is outdated.')
+        return None
+    return prefetched['working_directory']
+
+
+def prefetch(resource_config=None,
+             collect_metrics=False,
+             store_metrics=False, **_):
+
+    """
+    Stage the package in the working directory ahead of the operation,
+    which executes it, e.g. in precreate. Templates are left out, since
+    they are rendered in the context of the operation. The next execute
+    with the same resource_config only renders the templates, if none of
+    the resources changed since.
+    """
+
+    resource_config = \
+        resource_config or ctx.node.properties['resource_config']
+
+    package_parameters = parse_resource_config(resource_config)
+    lazy_settings = parse_lazy_settings(resource_config)
+    workspace_settings = parse_workspace_settings(resource_config)
+
+    if lazy_settings.get('enabled'):
+        ctx.logger.info('The package is staged lazily, nothing to prefetch.')
+        return
+
+    collect_workspace_garbage(
+        workspace_settings, package_parameters['transfer_settings'])
+    paths = ResolvedPaths(workspace_settings.get('root'))
+    metrics = get_metrics(collect_metrics, store_metrics)
+    workspace_lock = workspace.lock_workspace(paths.current_working_directory)
+    try:
+        manifest = get_package_manifest(
+            package_parameters['resource_dir'],
+            package_parameters['resource_list'],
+            paths,
+            package_parameters['stream_archives'],
+            package_parameters['template_filter'],
+            metrics,
+            package_parameters['extraction_settings'])
+        # A package, which execute can't verify, would be staged again by
+        # it, so it isn't staged ahead.
+        fingerprint = get_package_fingerprint(
+            manifest, [resource_config], paths.deployment_directory)
+        if fingerprint:
+            working_directory = stage_package_manifest(
+                split_templates(manifest)[0], package_parameters, paths,
+                metrics)
+            check_workspace_usage(working_directory, workspace_settings)
+    finally:
+        workspace.unlock_workspace(workspace_lock)
+        paths.close()
+        report_metrics(metrics, store_metrics)
+
+    if not fingerprint:
+        ctx.logger.info(
+            'The package is not available locally, so it can\'t be '
+            'verified by execute, nothing to prefetch.')
+        return
+    ctx.instance.runtime_properties['exec_prefetch'] = {
+        'fingerprint': fingerprint,
+        'working_directory': working_directory
+    }
+
+
+def execute(resource_config,
+            file_to_source='exec',
+            subprocess_args_overrides=None,
+            ignore_failure=False,
+            retry_on_failure=False,
+            timeout=None,
+            kill_timeout=DEFAULT_KILL_TIMEOUT,
+            resource_limits=None,
+            collect_metrics=False,
+            store_metrics=False,
+            persistent_worker=None,
+            memoize=False,
+            force=False, **_):
+
+    """
+    Execute some file in an extracted archive.
+
+    If resource_config has steps, they are run by run_steps instead of
+    file_to_source.
+
+    With memoize, the fingerprint of the inputs and of the package is stored
+    in the exec_memo runtime property after a successful run and the
+    operation does nothing, if it didn't change since, unless force is set.
+    """
+
+    resource_config = \
+        resource_config or ctx.node.properties['resource_config']
+
+    package_parameters = parse_resource_config(resource_config)
+    lazy_settings = parse_lazy_settings(resource_config)
+    workspace_settings = parse_workspace_settings(resource_config)
+    step_settings = parse_step_settings(resource_config)
+    resource_limits = resource_limits or {}
+    validate_process_limits(timeout, kill_timeout, resource_limits)
+    validate_persistent_worker(persistent_worker)
+
+    collect_workspace_garbage(
+        workspace_settings, package_parameters['transfer_settings'])
+    paths = ResolvedPaths(workspace_settings.get('root'))
+    metrics = get_metrics(collect_metrics, store_metrics)
+    fetch_server = None
+    manifest = fingerprint = working_directory = None
+    workspace_lock = workspace.lock_workspace(paths.current_working_directory)
+    try:
+        # A package prefetched for this operation is used only once.
+        prefetched = ctx.instance.runtime_properties.pop(
+            'exec_prefetch', None)
+        if lazy_settings.get('enabled'):
+            prefetched = None
+        if memoize or prefetched:
+            manifest = get_package_manifest(
+                package_parameters['resource_dir'],
+                package_parameters['resource_list'],
+                paths,
+                package_parameters['stream_archives'],
+                package_parameters['template_filter'],
+                metrics,
+                package_parameters['extraction_settings'])
+        if memoize:
+            fingerprint = get_package_fingerprint(
+                manifest,
+                [resource_config, file_to_source, subprocess_args_overrides],
+                paths.deployment_directory)
+            memo = ctx.instance.runtime_properties.get(
+                'exec_memo', {}).get(ctx.operation.name)
+            if not fingerprint:
+                ctx.logger.debug(
+                    'The package is not available locally, it can\'t be '
+                    'fingerprinted, so it is executed and not memoized.')
+            elif memo and memo['fingerprint'] == fingerprint and not force:
+                ctx.logger.info(
+                    'Package and inputs did not change since the run of '
+                    'execution {0}, skipping.'.format(memo['execution_id']))
+                return
+
+        if prefetched:
+            working_directory = get_prefetched_directory(
+                manifest, resource_config, prefetched, paths)
+        if working_directory:
+            ctx.logger.info(
+                'Using the package prefetched in {0}.'.format(
+                    working_directory))
+            # The templates of a partial manifest are staged without
+            # incremental sync, which would remove the other resources.
+            stage_package_manifest(
+                split_templates(manifest)[1],
+                dict(package_parameters, incremental=False),
+                paths,
+                metrics)
+        elif lazy_settings.get('enabled'):
+            working_directory, fetch_server = get_lazy_package_dir(
+                package_parameters, lazy_settings, paths, metrics)
+            subprocess_args_overrides = \
+                copy.deepcopy(subprocess_args_overrides) or {}
+            subprocess_args_overrides.setdefault('env', {}).update(
+                fetch_server.get_environment(lazy.install_helper(
+                    fetch_server.socket_directory,
+                    fetch_server.lazy_manifest,
+                    sys.executable)))
+        elif manifest is not None:
+            working_directory = stage_package_manifest(
+                manifest, package_parameters, paths, metrics)
+        else:
+            working_directory = get_package_dir(
+                paths=paths, metrics=metrics, **package_parameters)
+        cwd = get_script_directory(
+            working_directory, package_parameters['resource_dir'])
+        check_workspace_usage(working_directory, workspace_settings)
+
+        with metrics.phase('script'):
+            if step_settings['steps']:
+                returncode, err, timed_out, script_outputs = run_steps(
+                    cwd, step_settings, subprocess_args_overrides,
+                    timeout, kill_timeout, resource_limits,
+                    persistent_worker)
+            else:
+                returncode, err, timed_out, script_outputs = \
+                    run_script_with_outputs(
+                        cwd, file_to_source, subprocess_args_overrides,
+                        timeout, kill_timeout, resource_limits,
+                        persistent_worker=persistent_worker)
+        check_workspace_usage(
+            working_directory, workspace_settings, enforce=False)
+    finally:
+        workspace.unlock_workspace(workspace_lock)
+        if fetch_server:
+            fetch_server.stop()
+        paths.close()
+        report_metrics(metrics, store_metrics)
+
+    if timed_out:
+        message = 'Timed out after {0} seconds: {1}'.format(timeout, err)
+        if retry_on_failure:
+            raise OperationRetry(message)
+        raise NonRecoverableError(message)
+
+    if returncode and retry_on_failure:
+        raise OperationRetry('Retrying: {0}'.format(err))
+
+    elif returncode and not ignore_failure:
+        raise NonRecoverableError('Failed: {0}'.format(err))
+
+    if not returncode:
+        apply_outputs(script_outputs)
+
+    if fingerprint and not returncode:
+        memos = copy.deepcopy(
+            ctx.instance.runtime_properties.get('exec_memo', {}))
+        memos[ctx.operation.name] = {
+            'fingerprint': fingerprint,
+            'execution_id': ctx.execution_id,
+            'finished': time.time(),
+            'returncode': returncode
+        }
+        ctx.instance.runtime_properties['exec_memo'] = memos
+
+    cleanup_on_delete(resource_config)
+
+
+def start_detached_script(cwd,
+                          file_to_source,
+                          subprocess_args_overrides,
+                          resource_limits,
+                          status_directory,
+                          lock_path=None):
+    """
+    Start a script, which outlives the operation. Its output is written
+    to files in status_directory and its exit code to the returncode file,
+    once it finishes.
+
+    :param lock_path: Path of a file, which a shared lock is held of while
+        the script runs (see workspace.lock_workspace)
+
+    :return: Process ID of the script
+    """
+
+    command = ['bash', '-c', 'source {0}'.format(file_to_source)]
+    files = [
+        open(os.devnull),
+        open(os.path.join(status_directory, 'stdout'), 'w'),
+        open(os.path.join(status_directory, 'stderr'), 'w')
+    ]
+
+    subprocess_args = \
+        {
+            'args': command,
+            'stdin': files[0],
+            'stdout': files[1],
+            'stderr': files[2],
+            'cwd': cwd,
+            'close_fds': True,
+            'preexec_fn': get_preexec_fn(resource_limits or {})
         }
 
+    try:
+        return _start_detached_script(
+            subprocess_args, subprocess_args_overrides, status_directory,
+            lock_path)
+    finally:
+        for f in files:
+            f.close()
+
+
+def _start_detached_script(subprocess_args,
+                           subprocess_args_overrides,
+                           status_directory,
+                           lock_path=None):
     handle_overrides(subprocess_args_overrides, subprocess_args)
 
+    if isinstance(subprocess_args['args'], basestring) or \
+            subprocess_args.get('shell'):
+        raise NonRecoverableError(
+            "'args' overrides of execute_async must be a list.")
+
+    # The exit code is written by a wrapping shell, because the process
+    # may not be a child of the agent process, which polls it.
+    # It also holds the lock of the workspace, so that the workspace isn't
+    # removed by the garbage collection while the script runs.
+    returncode_path = os.path.join(status_directory, 'returncode')
+    lock_command = \
+        'exec 9<"{0}" && {{ flock -s 9 || true; }} 2>/dev/null; '.format(
+            lock_path) if lock_path else ''
+    subprocess_args['args'] = [
+        'bash', '-c',
+        lock_command +
+        '"$@"; echo $? > "{0}.tmp" && mv "{0}.tmp" "{0}"'.format(
+            returncode_path),
+        'exec'] + list(subprocess_args['args'])
+
     ctx.logger.debug('Args: {0}'.format(subprocess_args))
 
-    process = subprocess.Popen(**subprocess_args)
+    return subprocess.Popen(**subprocess_args).pid
+
 
-    out, err = process.communicate()
-    ctx.logger.debug('Out: {0}'.format(out))
-    ctx.logger.debug('Err: {0}'.format(err))
+def is_process_running(pid):
+    try:
+        # Reap the process, if it is a child of this one.
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            return False
+    except OSError as e:
+        if e.errno != errno.ECHILD:
+            raise
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        raise
+    return True
 
-    if process.returncode and retry_on_failure:
+
+def signal_detached_script(pid, signal_number):
+    try:
+        os.killpg(pid, signal_number)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+
+
+def log_detached_output(status_directory, offsets):
+    """
+    Log the output written by a detached script since the last poll.
+
+    :param offsets: Dict mapping Out and Err to the number of bytes,
+        which were already logged. It is updated in place.
+    """
+    for name, filename in (('Out', 'stdout'), ('Err', 'stderr')):
+        with open(os.path.join(status_directory, filename), 'rb') as f:
+            f.seek(offsets.get(name, 0))
+            output = f.read()
+        # Incomplete lines are logged once they are finished.
+        output = output[:output.rfind('\n') + 1]
+        if output:
+            offsets[name] = offsets.get(name, 0) + len(output)
+            ctx.logger.debug('{0}: {1}'.format(name, output.rstrip('\n')))
+
+
+def read_stderr_tail(status_directory):
+    with open(os.path.join(status_directory, 'stderr'), 'rb') as f:
+        return '\n'.join(
+            line.rstrip('\n')
+            for line in deque(f, maxlen=STDERR_TAIL_LINES))
+
+
+def stop_detached_script(record):
+    """ Kill a detached script and remove its status files. """
+    if is_process_running(record['pid']):
+        ctx.logger.warn(
+            'Killing process {0} left by execution {1}.'.format(
+                record['pid'], record['execution_id']))
+        signal_detached_script(record['pid'], signal.SIGKILL)
+    shutil.rmtree(record['status_directory'], ignore_errors=True)
+
+
+def execute_async(resource_config,
+                  file_to_source='exec',
+                  subprocess_args_overrides=None,
+                  ignore_failure=False,
+                  retry_on_failure=False,
+                  timeout=None,
+                  kill_timeout=DEFAULT_KILL_TIMEOUT,
+                  resource_limits=None,
+                  collect_metrics=False,
+                  store_metrics=False,
+                  poll_interval=DEFAULT_POLL_INTERVAL, **_):
+
+    """
+    Execute some file in an extracted archive without blocking the agent.
+
+    The first call stages the package and starts the script detached from
+    the operation. The operation is then retried every poll_interval
+    seconds, so the agent thread is free while the script runs. Each retry
+    logs the new output and enforces the timeout, the last one reports the
+    result like execute does. A script left running by another execution
+    (e.g. a cancelled one) is killed before the script is started again.
+    """
+
+    records = copy.deepcopy(
+        ctx.instance.runtime_properties.get('exec_async', {}))
+    record = records.get(ctx.operation.name)
+
+    if record and record['execution_id'] != ctx.execution_id:
+        stop_detached_script(record)
+        record = None
+
+    if not record:
+        resource_config = \
+            resource_config or ctx.node.properties['resource_config']
+
+        package_parameters = parse_resource_config(resource_config)
+        workspace_settings = parse_workspace_settings(resource_config)
+        resource_limits = resource_limits or {}
+        validate_process_limits(timeout, kill_timeout, resource_limits)
+
+        if not isinstance(poll_interval, (int, float)) or poll_interval <= 0:
+            raise NonRecoverableError(
+                "'poll_interval' must be a positive number.")
+
+        collect_workspace_garbage(
+            workspace_settings, package_parameters['transfer_settings'])
+        paths = ResolvedPaths(workspace_settings.get('root'))
+        metrics = get_metrics(collect_metrics, store_metrics)
+        workspace_lock = workspace.lock_workspace(
+            paths.current_working_directory)
+        try:
+            working_directory = get_package_dir(
+                paths=paths, metrics=metrics, **package_parameters)
+            cwd = get_script_directory(
+                working_directory, package_parameters['resource_dir'])
+            check_workspace_usage(working_directory, workspace_settings)
+        finally:
+            workspace.unlock_workspace(workspace_lock)
+            paths.close()
+            report_metrics(metrics, store_metrics)
+
+        status_directory = tempfile.mkdtemp(prefix='exec-async-')
+        record = {
+            'execution_id': ctx.execution_id,
+            'status_directory': status_directory,
+            'pid': start_detached_script(
+                cwd, file_to_source, subprocess_args_overrides,
+                resource_limits, status_directory,
+                workspace_lock.name if workspace_lock else None),
+            'started': time.time(),
+            'terminated': None,
+            'offsets': {}
+        }
+        records[ctx.operation.name] = record
+        ctx.instance.runtime_properties['exec_async'] = records
+        raise OperationRetry(
+            'Started process {0}.'.format(record['pid']),
+            retry_after=poll_interval)
+
+    status_directory = record['status_directory']
+    log_detached_output(status_directory, record['offsets'])
+    returncode_path = os.path.join(status_directory, 'returncode')
+    running = not os.path.exists(returncode_path) and \
+        is_process_running(record['pid'])
+
+    if running:
+        now = time.time()
+        if timeout and not record['terminated'] and \
+                now - record['started'] > timeout:
+            ctx.logger.warn(
+                'Process {0} timed out after {1} seconds, '
+                'terminating.'.format(record['pid'], timeout))
+            signal_detached_script(record['pid'], signal.SIGTERM)
+            record['terminated'] = now
+        elif record['terminated'] and \
+                now - record['terminated'] > kill_timeout:
+            ctx.logger.warn('Process {0} is still running, killing.'.format(
+                record['pid']))
+            signal_detached_script(record['pid'], signal.SIGKILL)
+        ctx.instance.runtime_properties['exec_async'] = records
+        raise OperationRetry(
+            'Process {0} is running.'.format(record['pid']),
+            retry_after=poll_interval)
+
+    try:
+        with open(returncode_path) as f:
+            returncode = int(f.read())
+    except (IOError, ValueError):
+        returncode = None
+    err = read_stderr_tail(status_directory)
+    del records[ctx.operation.name]
+    ctx.instance.runtime_properties['exec_async'] = records
+    shutil.rmtree(status_directory, ignore_errors=True)
+
+    if record['terminated']:
+        message = 'Timed out after {0} seconds: {1}'.format(timeout, err)
+        if retry_on_failure:
+            raise OperationRetry(message)
+        raise NonRecoverableError(message)
+
+    if returncode is None:
+        raise NonRecoverableError(
+            'Process {0} exited without an exit code: {1}'.format(
+                record['pid'], err))
+
+    if returncode and retry_on_failure:
         raise OperationRetry('Retrying: {0}'.format(err))
 
-    elif process.returncode and not ignore_failure:
+    elif returncode and not ignore_failure:
         raise NonRecoverableError('Failed: {0}'.format(err))
+
+    cleanup_on_delete(resource_config)
+
+
+def cleanup(resource_config=None, **_):
+    """
+    Stop the scripts started by execute_async and remove the workspaces of
+    the node instance. Meant for the delete operation.
+    """
+
+    resource_config = \
+        resource_config or ctx.node.properties.get('resource_config') or {}
+    workspace_settings = parse_workspace_settings(resource_config)
+    runtime_properties = ctx.instance.runtime_properties
+
+    for record in runtime_properties.get('exec_async', {}).values():
+        stop_detached_script(record)
+
+    removed = 0
+    for path, metadata, _ in workspace.list_workspaces(
+            workspace_settings.get('root') or
+            workspace.DEFAULT_WORKSPACE_ROOT):
+        if metadata.get('deployment_id') != ctx.deployment.id or \
+                metadata.get('instance_id') != ctx.instance.id:
+            continue
+        if workspace.remove_workspace(path):
+            removed += 1
+        else:
+            ctx.logger.warn('Workspace {0} is in use.'.format(path))
+    ctx.logger.info('Removed {0} workspaces.'.format(removed))
+
+    for property_name in ('exec_async', 'current_working_directory',
+                          'workspace_usage', 'exec_prefetch'):
+        if property_name in runtime_properties:
+            del runtime_properties[property_name]
+
+
+def cleanup_on_delete(resource_config):
+    # A script mapped to the delete operation replaces cleanup, so the
+    # workspaces are removed after it.
+    if ctx.operation.name == DELETE_OPERATION:
+        cleanup(resource_config)
+
+
+def fork_working_directory(manifest, working_directory, target_directory):
+    """
+    Create a copy of a staged working directory for a single batch item.
+    Resources, which are not templates, are placed by reflink or copy, so
+    that an item modifying them in place doesn't affect the other items,
+    templates are left out to be rendered separately.
+
+    :return: Staging manifest of the templates pointing to target_directory
+    """
+    templates = OrderedDict()
+    for relative_path, entry in manifest.iteritems():
+        target_path = os.path.join(target_directory, relative_path)
+        if entry['kind'] == RESOURCE_TEMPLATE:
+            add_manifest_entry(
+                templates, relative_path, entry['kind'], entry['source'],
+                target_path, entry['archive'])
+            continue
+        if entry['kind'] == RESOURCE_DIRECTORY:
+            directory = target_path
+        else:
+            directory = os.path.dirname(target_path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        source_path = os.path.join(working_directory, relative_path)
+        if entry['kind'] == RESOURCE_COPY and os.path.isfile(source_path):
+            cache.clone_file(source_path, target_path, allow_link=False)
+    return templates
+
+
+def _run_batch_item(item):
+    (item_id, cwd, file_to_source, subprocess_args_overrides, timeout,
+     kill_timeout, resource_limits, persistent_worker) = item
+    try:
+        returncode, err, timed_out = run_script(
+            cwd, file_to_source, subprocess_args_overrides, timeout,
+            kill_timeout, resource_limits, '[{0}] '.format(item_id),
+            persistent_worker)
+    except Exception as e:
+        return item_id, {'returncode': None, 'stderr': str(e),
+                         'timed_out': False, 'working_directory': cwd}
+    return item_id, {'returncode': returncode, 'stderr': err,
+                     'timed_out': timed_out, 'working_directory': cwd}
+
+
+def execute_batch(resource_config,
+                  batch,
+                  file_to_source='exec',
+                  subprocess_args_overrides=None,
+                  ignore_failure=False,
+                  retry_on_failure=False,
+                  timeout=None,
+                  kill_timeout=DEFAULT_KILL_TIMEOUT,
+                  resource_limits=None,
+                  batch_workers=DEFAULT_BATCH_WORKERS,
+                  collect_metrics=False,
+                  store_metrics=False,
+                  persistent_worker=None, **_):
+
+    """
+    Execute some file in an extracted archive once for each item of batch.
+
+    The package is staged only once. Each item gets its own working
+    directory, where the files are linked from the staged package and only
+    templates are rendered with template_variables of the item. Scripts are
+    executed concurrently by at most batch_workers processes. Results are
+    stored in the batch_results runtime property.
+
+    :param batch: List of dicts with keys: id, template_variables (merged
+        with these from resource_config) and subprocess_args_overrides
+        (replacing the shared ones).
+    """
+
+    resource_config = \
+        resource_config or ctx.node.properties['resource_config']
+
+    package_parameters = parse_resource_config(resource_config)
+    workspace_settings = parse_workspace_settings(resource_config)
+    resource_limits = resource_limits or {}
+    validate_process_limits(timeout, kill_timeout, resource_limits)
+    validate_persistent_worker(persistent_worker)
+
+    if not isinstance(batch, list) or \
+            not all(isinstance(item, dict) for item in batch):
+        raise NonRecoverableError("'batch' must be a list of dictionaries.")
+
+    # Results are stored by the ids, so an item must not hide another one.
+    item_ids = [str(item.get('id', index)) for index, item in enumerate(batch)]
+    duplicate_ids = sorted(set(
+        item_id for item_id in item_ids if item_ids.count(item_id) > 1))
+    if duplicate_ids:
+        raise NonRecoverableError(
+            "Ids of the items of 'batch' must be unique: {0}.".format(
+                ', '.join(duplicate_ids)))
+
+    if not isinstance(batch_workers, int) or batch_workers < 1:
+        raise NonRecoverableError(
+            "'batch_workers' must be a positive integer.")
+
+    collect_workspace_garbage(
+        workspace_settings, package_parameters['transfer_settings'])
+    paths = ResolvedPaths(workspace_settings.get('root'))
+    metrics = get_metrics(collect_metrics, store_metrics)
+    workspace_lock = workspace.lock_workspace(paths.current_working_directory)
+    # Directories of the items are workspaces of their own, which are
+    # removed once the batch is done.
+    item_directories = []
+    try:
+        # Stage the shared part of the package once.
+        manifest = get_package_manifest(
+            package_parameters['resource_dir'],
+            package_parameters['resource_list'],
+            paths,
+            package_parameters['stream_archives'],
+            package_parameters['template_filter'],
+            metrics,
+            package_parameters['extraction_settings'])
+        shared_manifest = split_templates(manifest)[0]
+        working_directory = stage_manifest(
+            shared_manifest,
+            package_parameters['template_variables'],
+            package_parameters['download_workers'],
+            package_parameters['resource_cache'],
+            package_parameters['incremental'],
+            paths,
+            metrics=metrics,
+            local_resources=package_parameters['local_resources'],
+            transfer_settings=package_parameters['transfer_settings'])
+
+        # Sources of the templates are fetched only once for all of the items.
+        template_sources = {}
+
+        def stage_and_run_item(item):
+            # The items are forked and their templates rendered by the
+            # workers of the batch, so that they are not staged one by one
+            # before the first script starts.
+            item_directory, template_variables, run_arguments = item
+            with metrics.phase('fork'):
+                item_manifest = fork_working_directory(
+                    manifest, working_directory, item_directory)
+            if item_manifest:
+                download_resources(
+                    item_manifest,
+                    template_variables,
+                    package_parameters['download_workers'],
+                    package_parameters['resource_cache'],
+                    paths=paths,
+                    render_locally=package_parameters['render_locally'],
+                    template_sources=template_sources,
+                    metrics=metrics,
+                    local_resources=package_parameters['local_resources'],
+                    transfer_settings=package_parameters[
+                        'transfer_settings'])
+            with metrics.phase('script'):
+                return _run_batch_item(run_arguments)
+
+        items = []
+        for item_id, item in zip(item_ids, batch):
+            item_directory = workspace.create_workspace(
+                workspace_settings.get('root') or
+                workspace.DEFAULT_WORKSPACE_ROOT,
+                ctx.deployment.id,
+                ctx.instance.id,
+                'batch')
+            item_directories.append(item_directory)
+            template_variables = \
+                package_parameters['template_variables'].copy()
+            template_variables.update(item.get('template_variables', {}))
+            items.append((item_directory, template_variables, (
+                item_id,
+                get_script_directory(
+                    item_directory, package_parameters['resource_dir']),
+                file_to_source,
+                copy.deepcopy(item.get(
+                    'subprocess_args_overrides', subprocess_args_overrides)),
+                timeout,
+                kill_timeout,
+                resource_limits,
+                persistent_worker)))
+
+        if len(items) < 2 or batch_workers == 1:
+            results = dict(map(stage_and_run_item, items))
+        else:
+            # The pool of the downloads of the operation can't be reused,
+            # since the items stage their templates with it.
+            pool = ThreadPool(
+                min(batch_workers, len(items)),
+                current_ctx.set,
+                (current_ctx.get_ctx(),))
+            try:
+                results = dict(pool.map(stage_and_run_item, items))
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        for item_directory in item_directories:
+            workspace.remove_workspace(item_directory)
+        workspace.unlock_workspace(workspace_lock)
+        paths.close()
+        report_metrics(metrics, store_metrics)
+
+    ctx.instance.runtime_properties['batch_results'] = results
+
+    failed = sorted(
+        item_id for item_id, result in results.items()
+        if result['returncode'] != 0 or result['timed_out'])
+    if failed:
+        message = 'Failed batch items: {0}'.format('\n'.join(
+            '{0}: {1}'.format(item_id, results[item_id]['stderr'])
+            for item_id in failed))
+        if retry_on_failure:
+            raise OperationRetry(message)
+        elif not ignore_failure or any(
+                results[item_id]['timed_out'] for item_id in failed):
+            raise NonRecoverableError(message)
+
+    cleanup_on_delete(resource_config)
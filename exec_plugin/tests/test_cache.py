@@ -0,0 +1,94 @@
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+# Built-in Imports
+import os
+import mock
+import shutil
+import tempfile
+import testtools
+
+from .. import cache
+
+
+class TestCache(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCache, self).setUp()
+        self.cache_directory = tempfile.mkdtemp()
+        self.source_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestCache, self).tearDown()
+        shutil.rmtree(self.cache_directory)
+        shutil.rmtree(self.source_directory)
+
+    def write_source(self, name, content):
+        path = os.path.join(self.source_directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_store_and_lookup(self):
+        source = self.write_source('data', 'content')
+        cache_key = cache.get_cache_key(source)
+        self.assertIsNone(cache.lookup(self.cache_directory, cache_key))
+        cache.store(self.cache_directory, cache_key, source)
+        object_path = cache.lookup(self.cache_directory, cache_key)
+        self.assertEqual(
+            os.path.basename(object_path), cache.get_content_hash(source))
+        target = os.path.join(self.source_directory, 'target')
+        cache.clone_file(object_path, target)
+        with open(target) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_clone_file_other_file_system(self):
+        source = self.write_source('data', 'content')
+        target = os.path.join(self.source_directory, 'target')
+        self.assertTrue(cache.is_same_file_system(source, target))
+        # Files on other file systems are copied, not linked.
+        with mock.patch('exec_plugin.cache.is_same_file_system',
+                        return_value=False), \
+                mock.patch('os.link') as m_link:
+            cache.clone_file(source, target)
+        self.assertFalse(m_link.called)
+        with open(target) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_cache_key_changes_with_content(self):
+        source = self.write_source('data', 'content')
+        cache_key = cache.get_cache_key(source)
+        os.utime(source, (0, 0))
+        self.assertNotEqual(cache_key, cache.get_cache_key(source))
+        self.assertIsNone(
+            cache.get_cache_key(os.path.join(self.source_directory, 'none')))
+
+    def test_resource_key(self):
+        url = u'https://manager/resources/blueprints/default_tenant/b/data'
+        self.assertEqual(cache.get_resource_key(url, '"1"'),
+                         cache.get_resource_key(str(url), '"1"'))
+        self.assertNotEqual(cache.get_resource_key(url, '"1"'),
+                            cache.get_resource_key(url, '"2"'))
+
+    def test_evict(self):
+        old_source = self.write_source('old', 'a' * 10)
+        new_source = self.write_source('new', 'b' * 10)
+        old_key = cache.get_cache_key(old_source)
+        new_key = cache.get_cache_key(new_source)
+        old_object = cache.store(self.cache_directory, old_key, old_source)
+        cache.store(self.cache_directory, new_key, new_source)
+        os.utime(old_object, (0, 0))
+        cache.evict(self.cache_directory, 15)
+        self.assertIsNone(cache.lookup(self.cache_directory, old_key))
+        self.assertIsNotNone(cache.lookup(self.cache_directory, new_key))
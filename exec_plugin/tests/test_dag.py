@@ -0,0 +1,93 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import time
+import threading
+import testtools
+
+from .. import dag
+
+
+class TestDag(testtools.TestCase):
+
+    def test_get_order(self):
+        self.assertEqual(
+            dag.get_order([
+                {'id': 'app', 'depends_on': ['db', 'cache']},
+                {'id': 'db'},
+                {'id': 'cache', 'depends_on': []},
+                {'id': 'proxy', 'depends_on': ['app']}]),
+            ['db', 'cache', 'app', 'proxy'])
+        for steps in [
+                [{'id': 'a'}, {'id': 'a'}],
+                [{'id': 'a', 'depends_on': ['b']}],
+                [{'id': 'a', 'depends_on': ['b']},
+                 {'id': 'b', 'depends_on': ['a']}]]:
+            self.assertRaises(dag.InvalidSteps, dag.get_order, steps)
+
+    def test_run_steps(self):
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0, 'finished': []}
+
+        def run_step(step):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(
+                    state['max_running'], state['running'])
+            time.sleep(0.1)
+            with lock:
+                state['running'] -= 1
+                state['finished'].append(step['id'])
+            return {'returncode': 0, 'stderr': '', 'timed_out': False}
+
+        steps = [{'id': str(index)} for index in range(4)] + [
+            {'id': 'last', 'depends_on': ['0', '1', '2', '3']}]
+        results = dag.run_steps(steps, run_step, workers=2)
+        self.assertEqual(
+            set(result['status'] for result in results.values()),
+            set([dag.STATUS_SUCCEEDED]))
+        # Independent steps ran concurrently, bounded by the workers, and
+        # the last step ran after all of its dependencies.
+        self.assertEqual(state['max_running'], 2)
+        self.assertEqual(state['finished'][-1], 'last')
+
+    def test_run_steps_failure(self):
+        def run_step(step):
+            if step['id'] == 'broken':
+                raise RuntimeError('broken')
+            time.sleep(0.1)
+            return {'returncode': 0, 'stderr': '', 'timed_out': False}
+
+        steps = [
+            {'id': 'broken'},
+            {'id': 'dependent', 'depends_on': ['broken']},
+            {'id': 'slow'},
+            {'id': 'independent', 'depends_on': ['slow']}]
+
+        results = dag.run_steps(steps, run_step, workers=2)
+        self.assertEqual(results['broken']['status'], dag.STATUS_FAILED)
+        self.assertEqual(results['broken']['stderr'], 'broken')
+        self.assertEqual(results['dependent']['status'], dag.STATUS_SKIPPED)
+        # The running step finished, no new steps were started.
+        self.assertEqual(results['slow']['status'], dag.STATUS_SUCCEEDED)
+        self.assertEqual(
+            results['independent']['status'], dag.STATUS_SKIPPED)
+
+        results = dag.run_steps(
+            steps, run_step, workers=2, policy=dag.POLICY_CONTINUE)
+        self.assertEqual(results['dependent']['status'], dag.STATUS_SKIPPED)
+        self.assertEqual(
+            results['independent']['status'], dag.STATUS_SUCCEEDED)
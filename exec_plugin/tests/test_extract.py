@@ -0,0 +1,99 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import shutil
+import zipfile
+import tempfile
+import testtools
+
+from .. import extract
+
+
+class TestExtract(testtools.TestCase):
+
+    def setUp(self):
+        super(TestExtract, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.archive_path = os.path.join(self.directory, 'package.zip')
+
+    def write_archive(self, members):
+        with zipfile.ZipFile(
+                self.archive_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in members:
+                archive.writestr(name, content)
+        return zipfile.ZipFile(self.archive_path)
+
+    def read_tree(self, directory):
+        tree = {}
+        for root, directories, files in os.walk(directory):
+            for name in directories:
+                tree[os.path.relpath(os.path.join(root, name), directory)] = \
+                    None
+            for name in files:
+                with open(os.path.join(root, name), 'rb') as f:
+                    tree[os.path.relpath(
+                        os.path.join(root, name), directory)] = f.read()
+        return tree
+
+    def test_extract_archive(self):
+        members = [('empty/', '')] + [
+            ('dir{0}/file{1}'.format(index % 7, index), os.urandom(index))
+            for index in range(extract.PARALLEL_MIN_MEMBERS * 2)]
+        archive = self.write_archive(members + [('../outside', 'x')])
+        expected_directory = os.path.join(self.directory, 'expected')
+        archive.extractall(expected_directory)
+        for workers in (1, 4):
+            target_directory = os.path.join(
+                self.directory, 'target{0}'.format(workers))
+            files, size = extract.extract_archive(
+                archive, self.archive_path, target_directory,
+                {'workers': workers})
+            # The directory isn't counted, ../outside is sanitized.
+            self.assertEqual(files, len(members))
+            self.assertEqual(
+                size, sum(len(content) for _, content in members) + 1)
+            self.assertEqual(
+                self.read_tree(target_directory),
+                self.read_tree(expected_directory))
+        self.assertIn('outside', self.read_tree(expected_directory))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, 'outside')))
+
+    def test_limits(self):
+        archive = self.write_archive([
+            ('zeros', b'\0' * (4 * extract.CHUNK_SIZE)),
+            ('data', 'data')])
+        target_directory = os.path.join(self.directory, 'target')
+        for limits in [{'max_members': 1},
+                       {'max_size': extract.CHUNK_SIZE},
+                       {'max_ratio': 100}]:
+            self.assertRaises(
+                extract.ArchiveLimitExceeded,
+                extract.extract_archive,
+                archive, self.archive_path, target_directory, limits)
+            # Nothing was written.
+            self.assertFalse(os.path.exists(target_directory))
+        extract.extract_archive(
+            archive, self.archive_path, target_directory, {'max_ratio': 0})
+
+        # A member, which is larger than its declared size, is rejected.
+        member = archive.getinfo('data')
+        member.file_size = 2
+        self.assertRaises(
+            extract.ArchiveLimitExceeded,
+            extract.extract_member,
+            archive, member, os.path.join(target_directory, 'data'))
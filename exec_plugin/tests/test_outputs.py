@@ -0,0 +1,65 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from .. import outputs
+
+
+class TestOutputs(testtools.TestCase):
+
+    def setUp(self):
+        super(TestOutputs, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'outputs')
+
+    def write_outputs(self, content):
+        with open(self.path, 'w') as f:
+            f.write(content)
+
+    def test_read_outputs(self):
+        self.write_outputs(
+            'endpoint=http://10.0.0.1:8080/?a=b\n'
+            '\n'
+            '{"port": 8080, "nodes": ["a", "b"]}\n'
+            'port=8081\n'
+            '{"ready": true}\n')
+        self.assertEqual(outputs.read_outputs(self.path), {
+            'endpoint': 'http://10.0.0.1:8080/?a=b',
+            'port': '8081',
+            'nodes': ['a', 'b'],
+            'ready': True
+        })
+        self.assertEqual(
+            outputs.read_outputs(os.path.join(self.directory, 'missing')),
+            {})
+
+    def test_invalid_outputs(self):
+        for content in ['{"port": \n', '["a"]\n', 'ready\n']:
+            self.write_outputs(content)
+            self.assertRaises(
+                outputs.InvalidOutputs, outputs.read_outputs, self.path)
+        self.write_outputs('{"reserved": 1}\n')
+        self.assertRaises(
+            outputs.InvalidOutputs, outputs.read_outputs, self.path,
+            reserved=['reserved'])
+        self.write_outputs('key=value\n' * 10)
+        self.assertRaises(
+            outputs.InvalidOutputs, outputs.read_outputs, self.path, 50)
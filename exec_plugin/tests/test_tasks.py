@@ -13,10 +13,16 @@
 #    * limitations under the License.
 
 # Built-in Imports
+import io
 import os
+import shutil
 import mock
+import time
 import tempfile
 import testtools
+import zipfile
+import subprocess
+from collections import OrderedDict
 
 # Third Party Imports
 from cloudify.state import current_ctx
@@ -25,7 +31,8 @@ from cloudify.exceptions import (
     NonRecoverableError,
     OperationRetry)
 
-from .. import tasks
+from .. import tasks, lazy, render, extract
+from ..metrics import Metrics
 
 
 class TestTasks(testtools.TestCase):
@@ -37,6 +44,17 @@ class TestTasks(testtools.TestCase):
 
     def setUp(self):
         super(TestTasks, self).setUp()
+        # Workspaces are created in a temporary root, not in the default
+        # root of the agent.
+        patcher = mock.patch(
+            'exec_plugin.workspace.DEFAULT_WORKSPACE_ROOT', self.mkdtemp())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mkdtemp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return directory
 
     def mock_ctx(self, test_name):
 
@@ -55,6 +73,22 @@ class TestTasks(testtools.TestCase):
             node_id=test_node_id,
             properties=test_properties)
 
+    def mock_manifest(self, target_dir, resources):
+        manifest = OrderedDict()
+        for resource_path, kind in resources:
+            tasks.add_manifest_entry(
+                manifest, resource_path, kind, resource_path,
+                os.path.join(target_dir, resource_path))
+        return manifest
+
+    def mock_process(self, returncode=1):
+        process = mock.MagicMock()
+        process.returncode = returncode
+        process.stdin = None
+        process.stdout = io.BytesIO(b'Out\n')
+        process.stderr = io.BytesIO(b'Err\n')
+        return process
+
     @mock.patch('os.environ.copy',
                 return_value={'PATH': '/bin:/usr/sbin:/sbin'})
     def test_handle_overrides_persist(self, m_env):
@@ -174,10 +208,7 @@ class TestTasks(testtools.TestCase):
     def test_execute_bad_script(self, m_cwd):
         ctx = self.mock_ctx('test_execute_bad_script')
         current_ctx.set(ctx=ctx)
-        process = mock.MagicMock()
-        process.return_code = True
-        process.communicate = mock.MagicMock(
-            return_value=('Out', 'Err'))
+        process = self.mock_process()
         with mock.patch('subprocess.Popen', return_value=process):
             self.assertRaises(
                 NonRecoverableError,
@@ -189,10 +220,7 @@ class TestTasks(testtools.TestCase):
     def test_execute_bad_script_retry(self, m_cwd):
         ctx = self.mock_ctx('test_execute_bad_script_retry')
         current_ctx.set(ctx=ctx)
-        process = mock.MagicMock()
-        process.return_code = True
-        process.communicate = mock.MagicMock(
-            return_value=('Out', 'Err'))
+        process = self.mock_process()
         with mock.patch('subprocess.Popen', return_value=process):
             self.assertRaises(
                 OperationRetry,
@@ -205,12 +233,1054 @@ class TestTasks(testtools.TestCase):
     def test_execute_bad_script_ignore(self, m_cwd):
         ctx = self.mock_ctx('test_execute_bad_script_ignore')
         current_ctx.set(ctx=ctx)
-        process = mock.MagicMock()
-        process.return_code = True
-        process.communicate = mock.MagicMock(
-            return_value=('Out', 'Err'))
+        process = self.mock_process()
         with mock.patch('subprocess.Popen', return_value=process):
             tasks.execute(
                 ignore_failure=True,
                 resource_config=ctx.node.properties['resource_config'],
                 ctx=ctx)
+
+    def test_download_resources(self):
+        ctx = self.mock_ctx('test_download_resources')
+        ctx.download_resource_and_render = mock.MagicMock()
+        ctx.download_resource = mock.MagicMock()
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        manifest = self.mock_manifest(target_dir, [
+            ('a/exec', tasks.RESOURCE_TEMPLATE),
+            ('a/b/data', tasks.RESOURCE_COPY),
+            ('a/c', tasks.RESOURCE_DIRECTORY),
+        ])
+        tasks.download_resources(manifest, {'key': 'value'}, 2)
+        self.assertTrue(os.path.isdir(os.path.join(target_dir, 'a', 'b')))
+        self.assertTrue(os.path.isdir(os.path.join(target_dir, 'a', 'c')))
+        ctx.download_resource_and_render.assert_called_once_with(
+            'a/exec', os.path.join(target_dir, 'a', 'exec'), {'key': 'value'})
+        ctx.download_resource.assert_called_once_with(
+            'a/b/data', os.path.join(target_dir, 'a', 'b', 'data'))
+
+    def test_download_resources_pool(self):
+        ctx = self.mock_ctx('test_download_resources_pool')
+        ctx.download_resource = mock.MagicMock()
+        current_ctx.set(ctx=ctx)
+        paths = tasks.ResolvedPaths()
+        with mock.patch('exec_plugin.tasks.ThreadPool',
+                        wraps=tasks.ThreadPool) as m_pool:
+            # A single resource is staged without a pool.
+            tasks.download_resources(
+                self.mock_manifest(
+                    self.mkdtemp(), [('a', tasks.RESOURCE_COPY)]),
+                paths=paths)
+            self.assertFalse(m_pool.called)
+            # The pool is started once and reused by the operation.
+            for _ in range(2):
+                tasks.download_resources(
+                    self.mock_manifest(self.mkdtemp(), [
+                        ('a', tasks.RESOURCE_COPY),
+                        ('b', tasks.RESOURCE_COPY)]),
+                    paths=paths)
+            paths.close()
+        self.assertEqual(m_pool.call_count, 1)
+        self.assertEqual(ctx.download_resource.call_count, 5)
+
+    def test_download_resources_errors(self):
+        ctx = self.mock_ctx('test_download_resources_errors')
+        ctx.download_resource = mock.MagicMock(
+            side_effect=IOError('Not found'))
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        manifest = self.mock_manifest(target_dir, [
+            ('first', tasks.RESOURCE_COPY),
+            ('second', tasks.RESOURCE_COPY),
+        ])
+        error = self.assertRaises(
+            NonRecoverableError,
+            tasks.download_resources,
+            manifest)
+        self.assertIn('Failed to download 2 of 2 resources', str(error))
+        self.assertIn('first: Not found', str(error))
+        self.assertIn('second: Not found', str(error))
+
+    def test_download_resources_local(self):
+        ctx = self.mock_ctx('test_download_resources_local')
+        source_dir = self.mkdtemp()
+        with open(os.path.join(source_dir, 'data'), 'w') as f:
+            f.write('content')
+        ctx.download_resource = mock.MagicMock()
+        ctx.instance.runtime_properties['deployment_directory'] = source_dir
+        current_ctx.set(ctx=ctx)
+        for local_resources in [tasks.LOCAL_RESOURCES_COPY,
+                                tasks.LOCAL_RESOURCES_LINK]:
+            target_dir = self.mkdtemp()
+            tasks.download_resources(
+                self.mock_manifest(target_dir, [
+                    ('data', tasks.RESOURCE_COPY),
+                    ('missing', tasks.RESOURCE_COPY)]),
+                local_resources=local_resources)
+            with open(os.path.join(target_dir, 'data')) as f:
+                self.assertEqual(f.read(), 'content')
+        ctx.download_resource.assert_has_calls([
+            mock.call('missing', mock.ANY), mock.call('missing', mock.ANY)])
+        self.assertEqual(ctx.download_resource.call_count, 2)
+
+    def test_download_resources_link_executable(self):
+        ctx = self.mock_ctx('test_download_resources_link_executable')
+        source_dir = self.mkdtemp()
+        source_path = os.path.join(source_dir, 'script.py')
+        with open(source_path, 'w') as f:
+            f.write('print(1)')
+        os.chmod(source_path, 0644)
+        ctx.instance.runtime_properties['deployment_directory'] = source_dir
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        tasks.download_resources(
+            self.mock_manifest(
+                target_dir, [('script.py', tasks.RESOURCE_COPY)]),
+            local_resources=tasks.LOCAL_RESOURCES_LINK)
+        target_path = os.path.join(target_dir, 'script.py')
+        self.assertEqual(os.stat(target_path).st_mode & 0777, 0755)
+        # The source in the deployment directory is not modified.
+        self.assertEqual(os.stat(source_path).st_mode & 0777, 0644)
+        self.assertFalse(os.path.samefile(source_path, target_path))
+
+    def test_execute_invalid_download_workers(self):
+        ctx = self.mock_ctx('test_execute_invalid_download_workers')
+        current_ctx.set(ctx=ctx)
+        ctx.node.properties['resource_config']['download_workers'] = 0
+        self.assertRaises(
+            NonRecoverableError,
+            tasks.execute,
+            resource_config=ctx.node.properties['resource_config'],
+            ctx=ctx)
+
+    @mock.patch('exec_plugin.tasks.get_deployment_directory',
+                return_value=None)
+    @mock.patch('exec_plugin.transfer.get_resource_version')
+    def test_download_resources_cached(self, m_version, _):
+        ctx = self.mock_ctx('test_download_resources_cached')
+
+        def download_resource(resource_path, target_path):
+            with open(target_path, 'w') as f:
+                f.write('content')
+        ctx.download_resource = mock.MagicMock(side_effect=download_resource)
+        current_ctx.set(ctx=ctx)
+        resource_cache = {'enabled': True, 'directory': self.mkdtemp()}
+        # The resource is downloaded, when the file server reports a new
+        # version of it or no version at all.
+        for version in [('url', '"1"'), ('url', '"1"'), ('url', '"1"'),
+                        ('url', '"2"'), None, None]:
+            m_version.return_value = version
+            target_dir = self.mkdtemp()
+            tasks.download_resources(
+                self.mock_manifest(
+                    target_dir, [('data', tasks.RESOURCE_COPY)]),
+                resource_cache=resource_cache)
+            with open(os.path.join(target_dir, 'data')) as f:
+                self.assertEqual(f.read(), 'content')
+            # Modifying a staged file in place doesn't modify the cache.
+            with open(os.path.join(target_dir, 'data'), 'a') as f:
+                f.write(' modified')
+        self.assertEqual(ctx.download_resource.call_count, 4)
+
+    @mock.patch('exec_plugin.transfer.get_resource_version')
+    def test_download_resources_cached_local(self, m_version):
+        ctx = self.mock_ctx('test_download_resources_cached_local')
+        source_dir = self.mkdtemp()
+        with open(os.path.join(source_dir, 'data'), 'w') as f:
+            f.write('content')
+        ctx.download_resource = mock.MagicMock()
+        ctx.instance.runtime_properties['deployment_directory'] = source_dir
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        # Local sources are copied, neither downloaded nor cached.
+        tasks.download_resources(
+            self.mock_manifest(target_dir, [('data', tasks.RESOURCE_COPY)]),
+            resource_cache={'enabled': True, 'directory': self.mkdtemp()})
+        with open(os.path.join(target_dir, 'data')) as f:
+            self.assertEqual(f.read(), 'content')
+        self.assertFalse(ctx.download_resource.called)
+        self.assertFalse(m_version.called)
+
+    def test_download_resources_incremental(self):
+        ctx = self.mock_ctx('test_download_resources_incremental')
+        source_dir = self.mkdtemp()
+        for name in ['exec', 'data']:
+            with open(os.path.join(source_dir, name), 'w') as f:
+                f.write(name)
+
+        def download_resource(resource_path, target_path, *_):
+            with open(target_path, 'w') as f:
+                f.write(resource_path)
+        ctx.download_resource = mock.MagicMock(side_effect=download_resource)
+        ctx.download_resource_and_render = mock.MagicMock(
+            side_effect=download_resource)
+        ctx.instance.runtime_properties['deployment_directory'] = source_dir
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        manifest_path = os.path.join(target_dir, '.exec_manifest.json')
+        manifest = self.mock_manifest(target_dir, [
+            ('exec', tasks.RESOURCE_TEMPLATE),
+            ('data', tasks.RESOURCE_COPY),
+        ])
+
+        for _ in range(2):
+            tasks.download_resources(
+                manifest, {'a': 1}, sync_manifest_path=manifest_path,
+                local_resources=tasks.LOCAL_RESOURCES_DOWNLOAD)
+        self.assertEqual(ctx.download_resource.call_count, 1)
+        self.assertEqual(ctx.download_resource_and_render.call_count, 1)
+
+        del manifest['data']
+        tasks.download_resources(
+            manifest, {'a': 2}, sync_manifest_path=manifest_path)
+        self.assertEqual(ctx.download_resource_and_render.call_count, 2)
+        self.assertFalse(os.path.exists(os.path.join(target_dir, 'data')))
+
+    @mock.patch('exec_plugin.tasks.get_deployment_directory',
+                return_value=None)
+    def test_download_resources_incremental_remote(self, _):
+        ctx = self.mock_ctx('test_download_resources_incremental_remote')
+
+        def download_resource(resource_path, target_path, *_):
+            with open(target_path, 'w') as f:
+                f.write(resource_path)
+        ctx.download_resource = mock.MagicMock(side_effect=download_resource)
+        current_ctx.set(ctx=ctx)
+        target_dir = self.mkdtemp()
+        manifest_path = os.path.join(target_dir, '.exec_manifest.json')
+        manifest = self.mock_manifest(
+            target_dir, [('data', tasks.RESOURCE_COPY)])
+        self.assertIsNone(tasks.get_source_key(manifest['data'], None, {}))
+        # Resources without a local source are never up to date.
+        for _ in range(2):
+            tasks.download_resources(
+                manifest, sync_manifest_path=manifest_path)
+        self.assertEqual(ctx.download_resource.call_count, 2)
+
+    @mock.patch('exec_plugin.tasks.get_package_dir', return_value=os.curdir)
+    def test_execute_bad_script_stderr_tail(self, m_cwd):
+        ctx = self.mock_ctx('test_execute_bad_script_stderr_tail')
+        current_ctx.set(ctx=ctx)
+        process = self.mock_process()
+        process.stderr = io.BytesIO(b''.join(
+            b'line {0}\n'.format(i) for i in range(1000)))
+        with mock.patch('subprocess.Popen', return_value=process):
+            error = self.assertRaises(
+                NonRecoverableError,
+                tasks.execute,
+                resource_config=ctx.node.properties['resource_config'],
+                ctx=ctx)
+        self.assertIn('line 999', str(error))
+        self.assertNotIn('line 949', str(error))
+        self.assertIn('line 950', str(error))
+
+    def test_stream_process_output(self):
+        ctx = self.mock_ctx('test_stream_process_output')
+        current_ctx.set(ctx=ctx)
+        process = subprocess.Popen(
+            ['bash', '-c', 'echo out; echo err >&2'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        self.assertEqual(tasks.stream_process_output(process), 'err')
+        self.assertEqual(process.returncode, 0)
+
+    def test_resolved_paths(self):
+        ctx = self.mock_ctx('test_resolved_paths')
+        current_ctx.set(ctx=ctx)
+        deployment_dir = self.mkdtemp()
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        paths = tasks.ResolvedPaths()
+        with mock.patch('exec_plugin.tasks.get_deployment_directory',
+                        side_effect=tasks.get_deployment_directory) as m_dir:
+            self.assertEqual(paths.deployment_directory, deployment_dir)
+            self.assertEqual(paths.deployment_directory, deployment_dir)
+            self.assertEqual(m_dir.call_count, 1)
+            paths.invalidate('deployment_directory')
+            self.assertEqual(paths.deployment_directory, deployment_dir)
+            self.assertEqual(m_dir.call_count, 2)
+
+    def test_get_package_dir_from_dir_and_list(self):
+        ctx = self.mock_ctx('test_get_package_dir_from_dir_and_list')
+        deployment_dir = self.mkdtemp()
+        working_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package', 'empty'))
+        for name in ['exec', 'data']:
+            with open(os.path.join(deployment_dir, 'package', name), 'w') as f:
+                f.write('echo {{ name }}')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        resource_list = ['exec']
+        with mock.patch('exec_plugin.tasks.download_resources') as m_dl:
+            tasks.get_package_dir_from_dir_and_list('package', resource_list)
+        manifest = m_dl.call_args[0][0]
+        self.assertEqual(
+            sorted(manifest),
+            ['package/data', 'package/empty', 'package/exec'])
+        self.assertEqual(
+            manifest['package/exec']['kind'], tasks.RESOURCE_TEMPLATE)
+        self.assertEqual(manifest['package/data']['kind'], tasks.RESOURCE_COPY)
+        self.assertEqual(
+            manifest['package/empty']['kind'], tasks.RESOURCE_DIRECTORY)
+        self.assertEqual(
+            manifest['package/data']['dest'],
+            os.path.join(working_dir, 'package', 'data'))
+        self.assertEqual(resource_list, ['exec'])
+
+    def test_classify_templates(self):
+        ctx = self.mock_ctx('test_classify_templates')
+        deployment_dir = self.mkdtemp()
+        working_dir = self.mkdtemp()
+        files = {
+            'exec': 'echo {{ name }}',
+            'plain.sh': 'echo world',
+            'binary': '{{ name }}\0',
+            'large': '{% if name %}' + ' ' * 100,
+            'excluded.j2': '{{ name }}',
+            'included.txt': 'world'
+        }
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        for name, content in files.items():
+            with open(os.path.join(deployment_dir, 'package', name), 'w') as f:
+                f.write(content)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        manifest = tasks.get_package_manifest(
+            'package', template_filter={
+                'exclude': ['*.j2'],
+                'include': ['package/included.*'],
+                'max_size': 50
+            })
+        self.assertEqual(
+            sorted(relative_path for relative_path, entry
+                   in manifest.items()
+                   if entry['kind'] == tasks.RESOURCE_TEMPLATE),
+            ['package/exec', 'package/included.txt'])
+        # Templates listed explicitly are rendered, even without jinja2
+        # delimiters.
+        manifest = tasks.get_package_manifest(
+            'package', ['plain.sh', 'excluded.j2'],
+            template_filter={'exclude': ['*.j2']})
+        self.assertEqual(
+            manifest['package/plain.sh']['kind'], tasks.RESOURCE_TEMPLATE)
+        self.assertEqual(
+            manifest['package/binary']['kind'], tasks.RESOURCE_COPY)
+        self.assertEqual(
+            manifest['package/excluded.j2']['kind'], tasks.RESOURCE_COPY)
+        manifest = tasks.get_package_manifest(
+            '', ['package/plain.sh'])
+        self.assertEqual(
+            manifest['plain.sh']['kind'], tasks.RESOURCE_TEMPLATE)
+        manifest = tasks.get_package_manifest(
+            'package', template_filter={'detect': False})
+        self.assertTrue(all(
+            entry['kind'] == tasks.RESOURCE_TEMPLATE
+            for entry in manifest.values()))
+
+    def test_extract_archive_from_path_cached(self):
+        ctx = self.mock_ctx('test_extract_archive_from_path_cached')
+        current_ctx.set(ctx=ctx)
+        directory = self.mkdtemp()
+        archive_path = os.path.join(directory, 'package.zip')
+        target_directory = os.path.join(directory, 'package')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('exec', 'echo first')
+
+        metrics = Metrics()
+        with mock.patch(
+                'exec_plugin.extract.extract_archive',
+                wraps=extract.extract_archive) as m_extract:
+            tasks.extract_archive_from_path(
+                archive_path, target_directory, metrics=metrics)
+            self.assertEqual(m_extract.call_count, 1)
+            tasks.extract_archive_from_path(
+                archive_path, target_directory, metrics=metrics)
+            self.assertEqual(m_extract.call_count, 1)
+        # Only the extraction, which wasn't skipped, is counted.
+        phase = metrics.report()['phases']['extract']
+        self.assertEqual(phase['files'], 1)
+        self.assertEqual(phase['bytes'], len('echo first'))
+
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('exec', 'echo second')
+        tasks.extract_archive_from_path(archive_path, target_directory)
+        with open(os.path.join(target_directory, 'exec')) as f:
+            self.assertEqual(f.read(), 'echo second')
+        self.assertEqual(
+            sorted(os.listdir(directory)), ['package', 'package.zip'])
+        self.assertEqual(
+            list(tasks.walk_resources(target_directory, directory)),
+            [('package/exec', tasks.RESOURCE_COPY)])
+
+    def test_extract_archive_from_path_existing_directory(self):
+        ctx = self.mock_ctx(
+            'test_extract_archive_from_path_existing_directory')
+        current_ctx.set(ctx=ctx)
+        directory = self.mkdtemp()
+        archive_path = os.path.join(directory, 'package.zip')
+        target_directory = os.path.join(directory, 'package')
+        os.makedirs(target_directory)
+        with open(os.path.join(target_directory, 'data'), 'w') as f:
+            f.write('data')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('exec', 'echo first')
+
+        tasks.extract_archive_from_path(archive_path, target_directory)
+        with mock.patch(
+                'exec_plugin.extract.extract_archive') as m_extract:
+            tasks.extract_archive_from_path(archive_path, target_directory)
+            self.assertFalse(m_extract.called)
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('exec', 'echo second')
+        tasks.extract_archive_from_path(archive_path, target_directory)
+        # The directory wasn't created by the plugin, so it is extracted into
+        # and never replaced nor marked.
+        self.assertEqual(
+            sorted(os.listdir(target_directory)), ['data', 'exec'])
+        with open(os.path.join(target_directory, 'exec')) as f:
+            self.assertEqual(f.read(), 'echo second')
+        self.assertEqual(
+            sorted(tasks.walk_resources(directory, directory)),
+            [('package.zip', tasks.RESOURCE_COPY),
+             ('package/data', tasks.RESOURCE_COPY),
+             ('package/exec', tasks.RESOURCE_COPY)])
+
+    def test_get_package_dir_stream_archives(self):
+        ctx = self.mock_ctx('test_get_package_dir_stream_archives')
+        deployment_dir = self.mkdtemp()
+        working_dir = self.mkdtemp()
+        with zipfile.ZipFile(
+                os.path.join(deployment_dir, 'package.zip'), 'w') as archive:
+            archive.writestr('exec', 'echo {{ name }}')
+            archive.writestr('bin/data', '{{ name }}')
+            archive.writestr('empty/', '')
+        ctx.download_resource = mock.MagicMock()
+        ctx.download_resource_and_render = mock.MagicMock()
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        tasks.get_package_dir(
+            'package.zip', ['exec'], {'name': 'world'}, stream_archives=True)
+        self.assertEqual(os.listdir(deployment_dir), ['package.zip'])
+        with open(os.path.join(working_dir, 'package', 'exec')) as f:
+            self.assertEqual(f.read(), 'echo world')
+        with open(os.path.join(working_dir, 'package', 'bin', 'data')) as f:
+            self.assertEqual(f.read(), '{{ name }}')
+        self.assertTrue(
+            os.path.isdir(os.path.join(working_dir, 'package', 'empty')))
+        self.assertFalse(ctx.download_resource.called)
+        self.assertFalse(ctx.download_resource_and_render.called)
+
+    def test_get_package_dir_stream_archives_sanitized(self):
+        ctx = self.mock_ctx('test_get_package_dir_stream_archives_sanitized')
+        deployment_dir = self.mkdtemp()
+        working_dir = os.path.join(deployment_dir, 'work', 'dir')
+        os.makedirs(working_dir)
+        archive_path = os.path.join(deployment_dir, 'package.zip')
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr('exec', 'echo')
+            archive.writestr('../../escaped.txt', 'escaped')
+            archive.writestr('/absolute.txt', 'absolute')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        tasks.get_package_dir('package.zip', stream_archives=True)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(working_dir, 'package'))),
+            ['absolute.txt', 'escaped.txt', 'exec'])
+        self.assertEqual(
+            sorted(os.listdir(deployment_dir)), ['package.zip', 'work'])
+        self.assertEqual(
+            os.listdir(os.path.join(deployment_dir, 'work')), ['dir'])
+
+        # Streamed archives are checked against the limits of extraction.
+        self.assertRaises(
+            NonRecoverableError, tasks.get_package_dir, 'package.zip',
+            stream_archives=True, extraction_settings={'max_members': 2})
+
+    def test_download_resources_render_locally(self):
+        ctx = self.mock_ctx('test_download_resources_render_locally')
+        ctx.get_resource = mock.MagicMock(return_value='echo {{ name }}')
+        ctx.download_resource_and_render = mock.MagicMock()
+        current_ctx.set(ctx=ctx)
+        render.clear_cache()
+        template_sources = {}
+        for name in ['first', 'second']:
+            target_dir = self.mkdtemp()
+            manifest = self.mock_manifest(
+                target_dir, [('exec', tasks.RESOURCE_TEMPLATE)])
+            with mock.patch.object(ctx.logger, 'debug') as debug:
+                tasks.download_resources(
+                    manifest, {'name': name}, 1, render_locally=True,
+                    template_sources=template_sources)
+            # Each call logs only the hits and misses of its own renders.
+            debug.assert_any_call(
+                'Template cache: {0} hits, {1} misses.'.format(
+                    int(name == 'second'), int(name == 'first')))
+            with open(os.path.join(target_dir, 'exec')) as f:
+                self.assertEqual(f.read(), 'echo {0}'.format(name))
+        ctx.get_resource.assert_called_once_with('exec')
+        self.assertFalse(ctx.download_resource_and_render.called)
+        statistics = render.get_cache_statistics()
+        self.assertEqual(statistics['hits'], 1)
+        self.assertEqual(statistics['misses'], 1)
+        self.assertEqual(render.render_resource('echo {{ x }}', {'x': 1}),
+                         ('echo 1', False))
+        self.assertEqual(render.render_resource('echo {{ x }}', {'x': 2}),
+                         ('echo 2', True))
+
+    def test_execute_timeout(self):
+        ctx = self.mock_ctx('test_execute_timeout')
+        current_ctx.set(ctx=ctx)
+        working_dir = self.mkdtemp()
+        with open(os.path.join(working_dir, 'exec'), 'w') as f:
+            f.write('trap "" TERM\nsleep 30 & sleep 30\n')
+        with mock.patch('exec_plugin.tasks.get_package_dir',
+                        return_value=working_dir):
+            self.assertRaises(
+                NonRecoverableError,
+                tasks.execute,
+                resource_config=ctx.node.properties['resource_config'],
+                timeout=0.5,
+                kill_timeout=0.5,
+                ignore_failure=True,
+                ctx=ctx)
+            self.assertRaises(
+                OperationRetry,
+                tasks.execute,
+                resource_config=ctx.node.properties['resource_config'],
+                timeout=0.5,
+                kill_timeout=0.5,
+                retry_on_failure=True,
+                ctx=ctx)
+
+    def test_execute_resource_limits(self):
+        ctx = self.mock_ctx('test_execute_resource_limits')
+        current_ctx.set(ctx=ctx)
+        working_dir = self.mkdtemp()
+        with open(os.path.join(working_dir, 'exec'), 'w') as f:
+            f.write('ulimit -n > limit\n')
+        with mock.patch('exec_plugin.tasks.get_package_dir',
+                        return_value=working_dir):
+            tasks.execute(
+                resource_config=ctx.node.properties['resource_config'],
+                resource_limits={'open_files': 64},
+                ctx=ctx)
+            self.assertRaises(
+                NonRecoverableError,
+                tasks.execute,
+                resource_config=ctx.node.properties['resource_config'],
+                resource_limits={'memory': 64},
+                ctx=ctx)
+        with open(os.path.join(working_dir, 'limit')) as f:
+            self.assertEqual(f.read().strip(), '64')
+
+    def test_execute_batch(self):
+        ctx = self.mock_ctx('test_execute_batch')
+        deployment_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        with open(os.path.join(deployment_dir, 'package', 'data'), 'w') as f:
+            f.write('data')
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('exit {{ code }}')
+
+        def download_resource(resource_path, target_path):
+            with open(os.path.join(deployment_dir, resource_path)) as src:
+                with open(target_path, 'w') as dst:
+                    dst.write(src.read())
+
+        def download_resource_and_render(resource_path, target_path,
+                                         template_variables):
+            with open(target_path, 'w') as dst:
+                # Items modify the files of the package in place.
+                dst.write('echo modified >> data && exit {0}'.format(
+                    template_variables['code']))
+        ctx.download_resource = mock.MagicMock(side_effect=download_resource)
+        ctx.download_resource_and_render = mock.MagicMock(
+            side_effect=download_resource_and_render)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        working_dir = self.mkdtemp()
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'resource_list': ['exec'],
+            'template_variables': {'code': 0},
+            'local_resources': tasks.LOCAL_RESOURCES_DOWNLOAD
+        }
+        tasks.execute_batch(
+            resource_config,
+            batch=[{'id': 'first'},
+                   {'id': 'second', 'template_variables': {'code': 3}}],
+            ignore_failure=True,
+            ctx=ctx)
+        results = ctx.instance.runtime_properties['batch_results']
+        self.assertEqual(results['first']['returncode'], 0)
+        self.assertEqual(results['second']['returncode'], 3)
+        self.assertEqual(ctx.download_resource.call_count, 1)
+        self.assertEqual(ctx.download_resource_and_render.call_count, 2)
+        with open(os.path.join(working_dir, 'package', 'data')) as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertRaises(
+            NonRecoverableError,
+            tasks.execute_batch,
+            resource_config,
+            batch=[{'id': 'second', 'template_variables': {'code': 3}}],
+            ctx=ctx)
+        # The results of the items are stored by their ids.
+        ctx.download_resource_and_render.reset_mock()
+        self.assertRaises(
+            NonRecoverableError,
+            tasks.execute_batch,
+            resource_config,
+            batch=[{'id': '1'}, {}, {'id': 1}],
+            ctx=ctx)
+        self.assertFalse(ctx.download_resource_and_render.called)
+
+    def test_execute_metrics(self):
+        ctx = self.mock_ctx('test_execute_metrics')
+        deployment_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        with open(os.path.join(deployment_dir, 'package', 'data'), 'w') as f:
+            f.write('data')
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('cat data > {{ name }}')
+        ctx.get_resource = mock.MagicMock(
+            return_value='cat data > {{ name }}')
+
+        def download_resource(resource_path, target_path):
+            with open(os.path.join(deployment_dir, resource_path)) as src:
+                with open(target_path, 'w') as dst:
+                    dst.write(src.read())
+        ctx.download_resource = mock.MagicMock(side_effect=download_resource)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            self.mkdtemp()
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'template_variables': {'name': 'out'},
+            'render_locally': True
+        }
+        tasks.execute(resource_config, ctx=ctx)
+        self.assertNotIn('exec_metrics', ctx.instance.runtime_properties)
+        tasks.execute(resource_config, store_metrics=True, ctx=ctx)
+        report = ctx.instance.runtime_properties['exec_metrics']
+        self.assertEqual(
+            sorted(report['phases']),
+            ['classify', 'download', 'render', 'script', 'stage', 'walk'])
+        self.assertEqual(report['phases']['render']['files'], 1)
+        self.assertEqual(report['phases']['download']['bytes'], 4)
+        self.assertEqual(
+            sorted(item['path'] for item in report['slowest_files']),
+            ['package/data', 'package/exec'])
+
+    def test_execute_async(self):
+        working_dir = self.mkdtemp()
+        with open(os.path.join(working_dir, 'exec'), 'w') as f:
+            f.write('echo out\nsleep 0.2\necho err >&2\nexit $CODE\n')
+
+        def mock_async_ctx(execution_id, runtime_properties=None):
+            ctx = MockCloudifyContext(
+                node_id='test_execute_async',
+                execution_id=execution_id,
+                operation={'name': 'create'},
+                runtime_properties=runtime_properties)
+            current_ctx.set(ctx=ctx)
+            return ctx
+
+        def poll(ctx, code):
+            while True:
+                try:
+                    return tasks.execute_async(
+                        {'resource_list': ['exec']},
+                        subprocess_args_overrides={'env': {'CODE': code}},
+                        poll_interval=0.1)
+                except OperationRetry:
+                    time.sleep(0.1)
+                finally:
+                    ctx = mock_async_ctx(
+                        ctx.execution_id,
+                        ctx.instance.runtime_properties)
+
+        with mock.patch('exec_plugin.tasks.get_package_dir',
+                        return_value=working_dir):
+            ctx = mock_async_ctx('first')
+            poll(ctx, '0')
+            self.assertEqual(
+                current_ctx.get_ctx().instance.runtime_properties[
+                    'exec_async'], {})
+
+            error = self.assertRaises(
+                NonRecoverableError, poll, ctx, '3')
+            self.assertEqual(str(error), 'Failed: err')
+
+            # A script left by a cancelled execution is killed.
+            ctx = mock_async_ctx('second')
+            self.assertRaises(
+                OperationRetry, tasks.execute_async,
+                {'resource_list': ['exec']},
+                subprocess_args_overrides={'env': {'CODE': '0'}})
+            record = ctx.instance.runtime_properties['exec_async']['create']
+            ctx = mock_async_ctx('third', ctx.instance.runtime_properties)
+            poll(ctx, '0')
+            self.assertFalse(tasks.is_process_running(record['pid']))
+            self.assertFalse(os.path.exists(record['status_directory']))
+
+    def test_execute_lazy(self):
+        ctx = self.mock_ctx('test_execute_lazy')
+        deployment_dir = self.mkdtemp()
+        working_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package', 'assets'))
+        files = {
+            'exec': '$EXEC_FETCH assets/chart && cat assets/chart > out\n'
+                    '$EXEC_FETCH --list > listed\n'
+                    'test ! -e assets/other || exit 1\n'
+                    '$EXEC_FETCH missing || exit 0\nexit 2\n',
+            'assets/chart': 'chart',
+            'assets/other': 'other'
+        }
+        for name, content in files.items():
+            with open(os.path.join(
+                    deployment_dir, 'package', name), 'w') as f:
+                f.write(content)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        tasks.execute(
+            {
+                'resource_dir': 'package',
+                'lazy': {'enabled': True, 'eager': ['*/exec']}
+            },
+            ctx=ctx)
+        with open(os.path.join(working_dir, 'package', 'out')) as f:
+            self.assertEqual(f.read(), 'chart')
+        self.assertFalse(os.path.exists(
+            os.path.join(working_dir, 'package', 'assets', 'other')))
+        self.assertFalse(os.path.exists(
+            os.path.join(working_dir, lazy.LAZY_MANIFEST)))
+        self.assertFalse(os.path.exists(
+            os.path.join(working_dir, lazy.FETCH_HELPER)))
+        with open(os.path.join(working_dir, 'package', 'listed')) as f:
+            self.assertEqual(
+                sorted(f.read().split()),
+                ['package/assets/chart', 'package/assets/other'])
+
+    def test_execute_lazy_incremental(self):
+        ctx = self.mock_ctx('test_execute_lazy_incremental')
+        deployment_dir = self.mkdtemp()
+        working_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package', 'assets'))
+        files = {
+            'exec': '${EXEC_FETCH:-true} assets/chart && '
+                    'cat assets/chart > out\n',
+            'assets/chart': 'chart',
+            'assets/other': 'other'
+        }
+        for name, content in files.items():
+            with open(os.path.join(
+                    deployment_dir, 'package', name), 'w') as f:
+                f.write(content)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        ctx.instance.runtime_properties['current_working_directory'] = \
+            working_dir
+        current_ctx.set(ctx=ctx)
+        for enabled in [False, True, True]:
+            tasks.execute(
+                {
+                    'resource_dir': 'package',
+                    'incremental': True,
+                    'lazy': {'enabled': enabled, 'eager': ['*/exec']}
+                },
+                ctx=ctx)
+            # The resources staged before are kept by the lazy runs.
+            with open(os.path.join(
+                    working_dir, 'package', 'assets', 'other')) as f:
+                self.assertEqual(f.read(), 'other')
+            with open(os.path.join(working_dir, 'package', 'out')) as f:
+                self.assertEqual(f.read(), 'chart')
+
+    def test_execute_workspace(self):
+        ctx = self.mock_ctx('test_execute_workspace')
+        deployment_dir = self.mkdtemp()
+        workspace_root = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('head -c 100000 /dev/zero > out\n')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'workspace': {'root': workspace_root, 'report_usage': True}
+        }
+        tasks.execute(resource_config, ctx=ctx)
+        working_dir = \
+            ctx.instance.runtime_properties['current_working_directory']
+        self.assertEqual(os.path.dirname(working_dir), workspace_root)
+        self.assertTrue(os.path.isfile(
+            os.path.join(working_dir, 'package', 'out')))
+        usage = ctx.instance.runtime_properties['workspace_usage']
+        self.assertEqual(usage['files'], 2)
+        self.assertGreaterEqual(usage['bytes'], 100000)
+
+        # The quota is checked before the script runs again.
+        resource_config['workspace']['max_size'] = 50000
+        self.assertRaises(
+            NonRecoverableError, tasks.execute, resource_config, ctx=ctx)
+
+        tasks.cleanup(resource_config, ctx=ctx)
+        self.assertEqual(os.listdir(workspace_root), ['.gc'])
+        self.assertNotIn(
+            'current_working_directory', ctx.instance.runtime_properties)
+
+    def test_execute_memoize(self):
+        ctx = self.mock_ctx('test_execute_memoize')
+        deployment_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        runs_path = os.path.join(deployment_dir, 'runs')
+        script_path = os.path.join(deployment_dir, 'package', 'exec')
+
+        def write_script(value):
+            with open(script_path, 'w') as f:
+                f.write('echo {0} >> {1}\n'.format(value, runs_path))
+
+        def runs():
+            with open(runs_path) as f:
+                return f.read().split()
+
+        write_script('first')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'template_variables': {'value': 1}
+        }
+        tasks.execute(resource_config, memoize=True, ctx=ctx)
+        self.assertIn('fingerprint', ctx.instance.runtime_properties[
+            'exec_memo'][ctx.operation.name])
+        # Nothing changed, so the script is not executed again.
+        tasks.execute(resource_config, memoize=True, ctx=ctx)
+        self.assertEqual(runs(), ['first'])
+        tasks.execute(resource_config, memoize=True, force=True, ctx=ctx)
+        self.assertEqual(runs(), ['first', 'first'])
+        # Changed inputs and a changed package are executed.
+        resource_config['template_variables']['value'] = 2
+        tasks.execute(resource_config, memoize=True, ctx=ctx)
+        self.assertEqual(runs(), ['first', 'first', 'first'])
+        write_script('second')
+        tasks.execute(resource_config, memoize=True, ctx=ctx)
+        tasks.execute(resource_config, memoize=True, ctx=ctx)
+        self.assertEqual(runs(), ['first', 'first', 'first', 'second'])
+
+    def test_execute_memoize_remote(self):
+        ctx = self.mock_ctx('test_execute_memoize_remote')
+        runs_path = os.path.join(self.mkdtemp(), 'runs')
+
+        def download_resource_and_render(resource_path, target_path, *_):
+            with open(target_path, 'w') as f:
+                f.write('echo run >> {0}\n'.format(runs_path))
+        ctx.download_resource_and_render = mock.MagicMock(
+            side_effect=download_resource_and_render)
+        current_ctx.set(ctx=ctx)
+        # A host agent has no local copy of the package, so it can't be
+        # fingerprinted and it is executed every time.
+        with mock.patch('exec_plugin.tasks.get_deployment_directory',
+                        return_value=None):
+            for _ in range(2):
+                tasks.execute({'resource_list': ['exec']}, memoize=True,
+                              ctx=ctx)
+        with open(runs_path) as f:
+            self.assertEqual(f.read().split(), ['run', 'run'])
+        self.assertNotIn('exec_memo', ctx.instance.runtime_properties)
+
+    def test_execute_steps(self):
+        ctx = self.mock_ctx('test_execute_steps')
+        deployment_dir = self.mkdtemp()
+        for path, content in [
+                ('db/install', 'echo $NAME > ../db.out\n'),
+                ('app/install', 'cat ../db.out > ../app.out\n'),
+                ('broken', 'echo broken >&2; exit 3\n')]:
+            path = os.path.join(deployment_dir, 'package', path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'steps': [
+                {'id': 'app', 'cwd': 'app', 'file_to_source': 'install',
+                 'depends_on': ['db']},
+                {'id': 'db', 'cwd': 'db', 'file_to_source': 'install',
+                 'env': {'NAME': 'db'}}
+            ]
+        }
+        tasks.execute(resource_config, ctx=ctx)
+        working_dir = \
+            ctx.instance.runtime_properties['current_working_directory']
+        with open(os.path.join(working_dir, 'package', 'app.out')) as f:
+            self.assertEqual(f.read(), 'db\n')
+        results = ctx.instance.runtime_properties['step_results']
+        self.assertEqual(results['app']['status'], 'succeeded')
+        self.assertEqual(results['db']['returncode'], 0)
+
+        resource_config['steps'][1]['depends_on'] = ['broken']
+        resource_config['steps'].append(
+            {'id': 'broken', 'file_to_source': 'broken'})
+        error = self.assertRaises(
+            NonRecoverableError, tasks.execute, resource_config, ctx=ctx)
+        self.assertIn('broken (failed): broken', str(error))
+        results = ctx.instance.runtime_properties['step_results']
+        self.assertEqual(results['broken']['returncode'], 3)
+        self.assertEqual(results['app']['status'], 'skipped')
+
+        resource_config['steps'][0]['depends_on'] = ['app']
+        self.assertRaises(
+            NonRecoverableError, tasks.execute, resource_config, ctx=ctx)
+
+    def test_execute_outputs(self):
+        ctx = self.mock_ctx('test_execute_outputs')
+        deployment_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('echo endpoint=$ENDPOINT >> $EXEC_OUTPUTS\n'
+                    'echo \'{"port": 8080}\' >> $EXEC_OUTPUTS\n')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {'resource_dir': 'package'}
+        tasks.execute(
+            resource_config,
+            subprocess_args_overrides={'env': {'ENDPOINT': 'http://a'}},
+            ctx=ctx)
+        self.assertEqual(
+            ctx.instance.runtime_properties['endpoint'], 'http://a')
+        self.assertEqual(ctx.instance.runtime_properties['port'], 8080)
+
+        # Outputs of steps are applied in the order of the steps.
+        resource_config['steps'] = [
+            {'id': 'second', 'depends_on': ['first'],
+             'env': {'ENDPOINT': 'http://second'}},
+            {'id': 'first', 'env': {'ENDPOINT': 'http://first'}}]
+        tasks.execute(resource_config, ctx=ctx)
+        self.assertEqual(
+            ctx.instance.runtime_properties['endpoint'], 'http://first')
+
+        # Outputs of failed scripts are not applied.
+        del resource_config['steps']
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('echo endpoint=failed >> $EXEC_OUTPUTS\nexit 1\n')
+        tasks.execute(resource_config, ignore_failure=True, ctx=ctx)
+        self.assertEqual(
+            ctx.instance.runtime_properties['endpoint'], 'http://first')
+
+        # Runtime properties of the plugin can't be overwritten.
+        with open(os.path.join(deployment_dir, 'package', 'exec'), 'w') as f:
+            f.write('echo exec_memo=x >> $EXEC_OUTPUTS\n')
+        self.assertRaises(
+            NonRecoverableError, tasks.execute, resource_config, ctx=ctx)
+        self.assertNotIn('exec_memo', ctx.instance.runtime_properties)
+
+    def test_handle_overrides_environment(self):
+        current = {'args': 'hello world'}
+        tasks.handle_overrides(
+            {}, current, {'PATH': '/bin'}, {'EXEC_OUTPUTS': '/outputs'})
+        self.assertEqual(
+            current['env'], {'PATH': '/bin', 'EXEC_OUTPUTS': '/outputs'})
+        current = {'args': 'hello world'}
+        tasks.handle_overrides(
+            {'PERSIST_CFY_AGENT_ENV_BOOL': False, 'env': {'A': 'a'}},
+            current, environment={'EXEC_OUTPUTS': '/outputs'})
+        self.assertEqual(
+            current['env'], {'A': 'a', 'EXEC_OUTPUTS': '/outputs'})
+
+    def test_prefetch(self):
+        ctx = self.mock_ctx('test_prefetch')
+        ctx.get_resource = mock.MagicMock(return_value='{{ name }}')
+        deployment_dir = self.mkdtemp()
+        os.makedirs(os.path.join(deployment_dir, 'package'))
+        script_path = os.path.join(deployment_dir, 'package', 'exec')
+        with open(script_path, 'w') as f:
+            f.write('cat message > out\n')
+        with open(os.path.join(deployment_dir, 'package', 'message'),
+                  'w') as f:
+            f.write('{{ name }}')
+        ctx.instance.runtime_properties['deployment_directory'] = \
+            deployment_dir
+        current_ctx.set(ctx=ctx)
+        resource_config = {
+            'resource_dir': 'package',
+            'resource_list': ['message'],
+            'template_variables': {'name': 'rendered'},
+            'render_locally': True
+        }
+        tasks.prefetch(resource_config, ctx=ctx)
+        working_dir = \
+            ctx.instance.runtime_properties['current_working_directory']
+        self.assertTrue(os.path.isfile(
+            os.path.join(working_dir, 'package', 'exec')))
+        # Templates are rendered by the operation, which executes them.
+        self.assertFalse(os.path.exists(
+            os.path.join(working_dir, 'package', 'message')))
+        self.assertEqual(
+            ctx.instance.runtime_properties['exec_prefetch'][
+                'working_directory'],
+            working_dir)
+
+        with mock.patch('exec_plugin.tasks.get_package_dir') as m_stage, \
+                mock.patch('exec_plugin.tasks.stage_package_manifest',
+                           wraps=tasks.stage_package_manifest) \
+                as m_stage_manifest:
+            tasks.execute(resource_config, ctx=ctx)
+        self.assertFalse(m_stage.called)
+        self.assertEqual(
+            [list(call[0][0]) for call in m_stage_manifest.call_args_list],
+            [['package/message']])
+        with open(os.path.join(working_dir, 'package', 'out')) as f:
+            self.assertEqual(f.read(), 'rendered')
+        # The prefetched package is used only once.
+        self.assertNotIn('exec_prefetch', ctx.instance.runtime_properties)
+
+        # A package, which changed since it was prefetched, is staged again.
+        tasks.prefetch(resource_config, ctx=ctx)
+        with open(script_path, 'w') as f:
+            f.write('echo staged again > out\n')
+        tasks.execute(resource_config, ctx=ctx)
+        with open(os.path.join(working_dir, 'package', 'out')) as f:
+            self.assertEqual(f.read(), 'staged again\n')
+
+    def test_prefetch_remote(self):
+        ctx = self.mock_ctx('test_prefetch_remote')
+        ctx.download_resource = mock.MagicMock()
+        current_ctx.set(ctx=ctx)
+        # Without a local copy of the package the prefetched package
+        # couldn't be verified, so nothing is staged.
+        with mock.patch('exec_plugin.tasks.get_deployment_directory',
+                        return_value=None):
+            tasks.prefetch(
+                {'resource_list': ['exec'], 'template_filter': {
+                    'exclude': ['exec']}},
+                ctx=ctx)
+        self.assertFalse(ctx.download_resource.called)
+        self.assertNotIn('exec_prefetch', ctx.instance.runtime_properties)
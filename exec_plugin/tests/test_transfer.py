@@ -0,0 +1,198 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import mock
+import shutil
+import hashlib
+import tempfile
+import testtools
+import threading
+import BaseHTTPServer
+from collections import OrderedDict
+
+from cloudify.state import current_ctx
+from cloudify.mocks import MockCloudifyContext
+from cloudify.exceptions import OperationRetry
+
+from .. import tasks, transfer
+
+
+class ResourceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve /resource with support of Range and If-Range. """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('Range'))
+        if self.path != '/resource':
+            self.send_error(404)
+            return
+        content = server.content
+        start = 0
+        if self.headers.get('Range') and \
+                self.headers.get('If-Range', server.etag) == server.etag:
+            start = int(self.headers['Range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, len(content) - 1, len(content)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(content) - start))
+        self.end_headers()
+        body = content[start:]
+        if server.fail_after is not None:
+            # Close the connection in the middle of the response.
+            body = body[:server.fail_after]
+            server.fail_after = None
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        if self.path != '/resource':
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('ETag', self.server.etag)
+        self.send_header('Content-Length', str(len(self.server.content)))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTransfer(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTransfer, self).setUp()
+        self.ctx = MockCloudifyContext(
+            node_id='test_transfer',
+            deployment_id='test_transfer')
+        current_ctx.set(ctx=self.ctx)
+        self.addCleanup(current_ctx.clear)
+
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), ResourceHandler)
+        self.server.content = os.urandom(10 * 1000 + 123)
+        self.server.etag = '"1"'
+        self.server.fail_after = None
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        base_url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        for target, value in [
+                ('get_resource_urls',
+                 lambda _: [base_url + '/missing', base_url + '/resource']),
+                ('get_request_arguments',
+                 lambda: {'headers': {}, 'timeout': 10}),
+                ('RETRY_INTERVAL', 0)]:
+            patcher = mock.patch(
+                'exec_plugin.transfer.{0}'.format(target), value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.settings = {
+            'enabled': True,
+            'chunk_size': 1000,
+            'retries': 0,
+            'directory': os.path.join(self.directory, 'partial')
+        }
+        self.target_path = os.path.join(self.directory, 'resource')
+
+    def read_target(self):
+        with open(self.target_path, 'rb') as f:
+            return f.read()
+
+    def test_resume_interrupted_download(self):
+        self.server.fail_after = 3500
+        self.assertRaises(
+            transfer.TransferInterrupted,
+            transfer.download_resource,
+            'resource', self.target_path, self.settings)
+        self.assertFalse(os.path.exists(self.target_path))
+
+        checksum = hashlib.sha256(self.server.content).hexdigest()
+        self.settings['checksums'] = {'resource': checksum}
+        self.assertEqual(
+            transfer.download_resource(
+                'resource', self.target_path, self.settings),
+            checksum)
+        self.assertEqual(self.read_target(), self.server.content)
+        # The URL was resolved once and the retry continued after the last
+        # complete chunk.
+        self.assertEqual(self.server.requests, [None, None, 'bytes=3000-'])
+        self.assertEqual(os.listdir(self.settings['directory']), [])
+
+    def test_restart_changed_download(self):
+        self.server.fail_after = 2500
+        self.settings['retries'] = 1
+        # The request is retried within the call.
+        transfer.download_resource(
+            'resource', self.target_path, self.settings)
+        self.assertEqual(self.read_target(), self.server.content)
+        self.assertEqual(self.server.requests, [None, None, 'bytes=2000-'])
+
+        del self.server.requests[:]
+        self.server.fail_after = 2500
+        self.settings['retries'] = 0
+        self.assertRaises(
+            transfer.TransferInterrupted,
+            transfer.download_resource,
+            'resource', self.target_path, self.settings)
+        self.server.content = os.urandom(5000)
+        self.server.etag = '"2"'
+        self.settings['checksums'] = {'resource': 'invalid'}
+        self.assertRaises(
+            transfer.TransferError,
+            transfer.download_resource,
+            'resource', self.target_path, self.settings)
+        # The resource changed, so it was sent whole.
+        self.assertEqual(self.server.requests, [None, None, 'bytes=2000-'])
+        self.assertEqual(os.listdir(self.settings['directory']), [])
+
+    def test_get_resource_version(self):
+        url, validator = transfer.get_resource_version('resource')
+        self.assertTrue(url.endswith('/resource'))
+        self.assertEqual(validator, '"1"')
+        self.server.etag = '"2"'
+        self.assertEqual(
+            transfer.get_resource_version('resource'), (url, '"2"'))
+        with mock.patch('exec_plugin.transfer.get_resource_urls',
+                        return_value=[url + '/missing']):
+            self.assertIsNone(transfer.get_resource_version('resource'))
+
+    def test_download_resources_retry(self):
+        self.server.fail_after = 1500
+        manifest = OrderedDict()
+        tasks.add_manifest_entry(
+            manifest, 'resource', tasks.RESOURCE_COPY, 'resource',
+            self.target_path)
+        self.assertRaises(
+            OperationRetry,
+            tasks.download_resources,
+            manifest,
+            local_resources=tasks.LOCAL_RESOURCES_DOWNLOAD,
+            transfer_settings=self.settings)
+        tasks.download_resources(
+            manifest,
+            local_resources=tasks.LOCAL_RESOURCES_DOWNLOAD,
+            transfer_settings=self.settings)
+        self.assertEqual(self.read_target(), self.server.content)
+        self.assertEqual(self.server.requests[-1], 'bytes=1000-')
@@ -0,0 +1,140 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import mock
+import stat
+import shutil
+import tempfile
+import testtools
+
+from cloudify.state import current_ctx
+from cloudify.mocks import MockCloudifyContext
+
+from .. import tasks, worker
+
+
+class TestWorker(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWorker, self).setUp()
+        self.ctx = MockCloudifyContext(
+            node_id='test_worker',
+            deployment_id=self.id())
+        current_ctx.set(ctx=self.ctx)
+        self.addCleanup(current_ctx.clear)
+        patcher = mock.patch(
+            'exec_plugin.worker.WORKER_DIRECTORY', tempfile.mkdtemp())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def mock_script_directory(self, directory=None):
+        script_directory = tempfile.mkdtemp(dir=directory)
+        with open(os.path.join(script_directory, 'prepare'), 'w') as f:
+            f.write('export PREPARED=yes\necho x >> {0}\n'.format(
+                os.path.join(script_directory, 'prepare.log')))
+        with open(os.path.join(script_directory, 'exec'), 'w') as f:
+            f.write('echo $PREPARED $REQUEST > output\n'
+                    'echo $REQUEST >&2\nexit $CODE\n')
+        return script_directory
+
+    def test_run_script_in_worker(self):
+        script_directory = self.mock_script_directory()
+        persistent_worker = {
+            'enabled': True, 'prepare': '../prepare', 'idle_timeout': 1}
+        for request, code in [('first', 0), ('second', 3)]:
+            # Each request runs in its own working directory.
+            cwd = self.mock_script_directory(script_directory)
+            returncode, err, timed_out = tasks.run_script(
+                cwd,
+                subprocess_args_overrides={
+                    'env': {'REQUEST': request, 'CODE': str(code)}},
+                persistent_worker=persistent_worker)
+            self.assertEqual((returncode, err, timed_out),
+                             (code, request, False))
+            with open(os.path.join(cwd, 'output')) as f:
+                self.assertEqual(f.read(), 'yes {0}\n'.format(request))
+        # The environment was prepared only once.
+        with open(os.path.join(script_directory, 'prepare.log')) as f:
+            self.assertEqual(f.read(), 'x\n')
+
+    def test_run_script_fallback(self):
+        script_directory = self.mock_script_directory()
+        with mock.patch('exec_plugin.worker.start_worker',
+                        side_effect=worker.WorkerUnavailable('failed')):
+            returncode, err, _ = tasks.run_script(
+                script_directory,
+                subprocess_args_overrides={
+                    'env': {'REQUEST': 'direct', 'CODE': '0'}},
+                persistent_worker={'enabled': True})
+        self.assertEqual((returncode, err), (0, 'direct'))
+        with open(os.path.join(script_directory, 'output')) as f:
+            self.assertEqual(f.read(), 'direct\n')
+
+    def test_run_script_worker_died(self):
+        script_directory = self.mock_script_directory()
+        with open(os.path.join(script_directory, 'prepare'), 'a') as f:
+            f.write('export IN_WORKER=yes\n')
+        with open(os.path.join(script_directory, 'exec'), 'w') as f:
+            f.write('echo started >> log\n'
+                    'test -n "$IN_WORKER" && kill -9 $PPID && sleep 1\n'
+                    'echo done >&2\n')
+        returncode, err, _ = tasks.run_script(
+            script_directory,
+            persistent_worker={'enabled': True, 'prepare': 'prepare'})
+        # The script is run again in a new process.
+        self.assertEqual((returncode, err), (0, 'done'))
+        with open(os.path.join(script_directory, 'log')) as f:
+            self.assertEqual(f.read(), 'started\nstarted\n')
+
+    def test_run_script_pythonpath(self):
+        script_directory = self.mock_script_directory()
+        with open(os.path.join(script_directory, 'exec'), 'w') as f:
+            f.write('echo -n "${PYTHONPATH-unset}" >&2\n')
+        for pythonpath in ['/original', None]:
+            with mock.patch.dict(os.environ):
+                os.environ.pop('PYTHONPATH', None)
+                if pythonpath:
+                    os.environ['PYTHONPATH'] = pythonpath
+                # A new worker is started for every prepare script.
+                with open(os.path.join(script_directory, 'prepare'), 'a') as f:
+                    f.write('\n')
+                _, err, _ = tasks.run_script(
+                    script_directory,
+                    persistent_worker={'enabled': True, 'prepare': 'prepare'})
+            self.assertEqual(err, pythonpath or 'unset')
+
+    def test_get_socket_path(self):
+        self.assertNotEqual(
+            worker.get_socket_path('first', 'deployment'),
+            worker.get_socket_path('second', 'deployment'))
+
+    def test_ensure_worker_directory(self):
+        directory = os.path.join(tempfile.mkdtemp(), 'workers')
+        self.addCleanup(shutil.rmtree, os.path.dirname(directory))
+        worker.ensure_worker_directory(directory)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0700)
+        os.chmod(directory, 0777)
+        worker.ensure_worker_directory(directory)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0700)
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            self.assertRaises(
+                worker.WorkerUnavailable,
+                worker.ensure_worker_directory, directory)
+        os.rmdir(directory)
+        os.symlink(tempfile.gettempdir(), directory)
+        self.assertRaises(
+            worker.WorkerUnavailable,
+            worker.ensure_worker_directory, directory)
@@ -0,0 +1,95 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+import os
+import time
+import shutil
+import tempfile
+import testtools
+
+from .. import workspace
+
+
+class TestWorkspace(testtools.TestCase):
+
+    def setUp(self):
+        super(TestWorkspace, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def create_workspace(self, size, age=0):
+        path = workspace.create_workspace(self.root, 'deployment', 'instance')
+        with open(os.path.join(path, 'data'), 'wb') as f:
+            f.write(b'x' * size)
+        last_used = time.time() - age
+        os.utime(path + workspace.METADATA_SUFFIX, (last_used, last_used))
+        return path
+
+    def test_usage(self):
+        path = self.create_workspace(10000)
+        os.link(os.path.join(path, 'data'), os.path.join(path, 'link'))
+        usage = workspace.get_usage(path)
+        self.assertEqual(usage['files'], 1)
+        self.assertGreaterEqual(usage['bytes'], 10000)
+
+    def test_collect_garbage_by_age(self):
+        old = self.create_workspace(100, age=1000)
+        used = self.create_workspace(100, age=1000)
+        recent = self.create_workspace(100)
+        lock = workspace.lock_workspace(used)
+        try:
+            result = workspace.collect_garbage(self.root, max_age=500)
+        finally:
+            workspace.unlock_workspace(lock)
+        self.assertEqual(result['workspaces'], 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertFalse(os.path.exists(old + workspace.METADATA_SUFFIX))
+        # Workspaces in use and recently used ones are kept.
+        self.assertTrue(os.path.exists(used))
+        self.assertTrue(os.path.exists(recent))
+        self.assertEqual(
+            sorted(path for path, _, _ in
+                   workspace.list_workspaces(self.root)),
+            sorted([used, recent]))
+
+    def test_collect_garbage_opt_in(self):
+        old = self.create_workspace(100, age=10 ** 8)
+        # Workspaces may hold state of their node instances, so they are
+        # kept, unless max_age or max_total_size is set.
+        result = workspace.collect_garbage(self.root)
+        self.assertEqual(result['workspaces'], 0)
+        self.assertTrue(os.path.exists(old))
+
+    def test_collect_garbage_by_size(self):
+        oldest = self.create_workspace(40000, age=30)
+        older = self.create_workspace(40000, age=20)
+        newest = self.create_workspace(40000, age=10)
+        result = workspace.collect_garbage(
+            self.root, max_total_size=workspace.get_usage(newest)['bytes'])
+        self.assertEqual(result['workspaces'], 2)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(older))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_collect_garbage_if_due(self):
+        old = self.create_workspace(100, age=1000)
+        result = workspace.collect_garbage_if_due(
+            self.root, interval=60, max_age=500)
+        self.assertEqual(result['workspaces'], 1)
+        self.assertFalse(os.path.exists(old))
+        # It doesn't run again within the interval.
+        self.create_workspace(100, age=1000)
+        self.assertIsNone(workspace.collect_garbage_if_due(
+            self.root, interval=60, max_age=500))
@@ -0,0 +1,399 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Chunked, resumable downloads of resources from the file server.
+#
+# ctx.download_resource fetches a resource in a single response held in
+# memory, so a transient failure restarts the whole transfer. Here the
+# resource is streamed to a partial file in the partial directory and
+# split into chunks of chunk_size bytes. The SHA-256 of each completed
+# chunk is saved in a state file next to the partial file, together with
+# the validator (ETag or Last-Modified) of the resource. A retried
+# download verifies the chunks on disk and requests the rest of the
+# resource with an HTTP Range request starting after the last good chunk.
+# If-Range makes the file server send the whole resource instead, if it
+# changed in the meantime. The complete file is verified against the
+# expected SHA-256 (if there is one) and moved to its destination.
+#
+# With compress, the first request accepts a gzip encoded response. File
+# servers don't compress partial responses, so resumed requests are plain.
+
+import os
+import json
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+
+import requests
+
+from cloudify import ctx, constants, utils
+
+DEFAULT_PARTIAL_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), 'cloudify-exec-partial')
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_RETRIES = 3
+RETRY_INTERVAL = 1.0
+REQUEST_TIMEOUT = 60
+READ_SIZE = 64 * 1024
+STATE_SUFFIX = '.state'
+
+# Resources with these extensions are compressed already, so they are not
+# worth compressing in transport.
+COMPRESSED_EXTENSIONS = (
+    '.gz', '.tgz', '.bz2', '.xz', '.zip', '.jar', '.whl', '.7z', '.zst',
+    '.rpm', '.deb', '.png', '.jpg', '.jpeg', '.gif')
+
+
+class TransferError(Exception):
+    """ The resource couldn't be downloaded and nothing was kept of it. """
+
+
+class TransferInterrupted(TransferError):
+    """
+    The transfer failed, but its partial file was kept, so that a retry
+    of the operation resumes it.
+    """
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def get_resource_urls(resource_path):
+    """
+    :return: URLs of the resource in the deployment and in the blueprint
+        folders of the file server, in the order ctx.download_resource
+        tries them
+    """
+    base_url = utils.get_manager_file_server_url()
+    return [
+        '/'.join([base_url, folder, ctx.tenant_name, folder_id,
+                  resource_path])
+        for folder, folder_id in [
+            (constants.FILE_SERVER_DEPLOYMENTS_FOLDER, ctx.deployment.id),
+            (constants.FILE_SERVER_BLUEPRINTS_FOLDER, ctx.blueprint.id)]]
+
+
+def get_request_arguments():
+    return {
+        'headers': {
+            constants.CLOUDIFY_TOKEN_AUTHENTICATION_HEADER: ctx.rest_token
+        },
+        'verify': os.environ.get(constants.LOCAL_REST_CERT_FILE_KEY, True),
+        'timeout': REQUEST_TIMEOUT
+    }
+
+
+def get_resource_version(resource_path):
+    """
+    Ask the file server for the version of a resource without downloading
+    it.
+
+    :return: Tuple (url, validator), where validator is the ETag or the
+        Last-Modified of the resource, or None if the file server can't be
+        reached or doesn't provide either of them
+    """
+    try:
+        urls = get_resource_urls(resource_path)
+        arguments = get_request_arguments()
+    except KeyError:
+        # The address of the file server is not known, e.g. in local mode.
+        return None
+    for url in urls:
+        try:
+            response = requests.head(url, allow_redirects=True, **arguments)
+        except requests.RequestException:
+            return None
+        response.close()
+        if response.status_code == 404:
+            continue
+        if response.status_code != 200:
+            return None
+        validator = response.headers.get('ETag') or \
+            response.headers.get('Last-Modified')
+        return (url, validator) if validator else None
+    return None
+
+
+def get_partial_path(partial_directory, resource_path):
+    """
+    :return: Path of the partial file of a resource. Each node instance
+        has its own partial files, so that concurrent operations don't
+        write to the same one.
+    """
+    return os.path.join(partial_directory, hashlib.sha1('{0}:{1}:{2}'.format(
+        ctx.deployment.id, ctx.instance.id, resource_path)).hexdigest())
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_state(state_path, state):
+    tmp_state_path = state_path + '.tmp'
+    with open(tmp_state_path, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp_state_path, state_path)
+
+
+def remove_partial(partial_path):
+    for path in (partial_path, partial_path + STATE_SUFFIX):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+def verify_chunks(partial_path, state, digest):
+    """
+    Drop the chunks of the state, which don't match the partial file, and
+    feed the good ones to the digest.
+
+    :return: Offset after the last good chunk
+    """
+    good_chunks = offset = 0
+    try:
+        with open(partial_path, 'rb') as f:
+            for checksum in state['chunks']:
+                data = f.read(state['chunk_size'])
+                if hashlib.sha256(data).hexdigest() != checksum:
+                    break
+                digest.update(data)
+                good_chunks += 1
+                offset += len(data)
+    except IOError:
+        pass
+    del state['chunks'][good_chunks:]
+    return offset
+
+
+def _parse_content_range(response):
+    """
+    :return: Tuple (first byte, total size) of the Content-Range header
+    """
+    content_range = response.headers.get('Content-Range', '')
+    try:
+        unit, ranges = content_range.split(' ', 1)
+        byte_range, total_size = ranges.split('/', 1)
+        first_byte = None if byte_range == '*' \
+            else int(byte_range.split('-', 1)[0])
+        return first_byte, int(total_size)
+    except ValueError:
+        raise TransferError(
+            'Invalid Content-Range: {0!r}'.format(content_range))
+
+
+def request_resource(state, offset, compress):
+    """
+    Request the resource from the offset on, resolving its URL first if
+    necessary.
+
+    :return: Response with the status 200, 206 or 416
+    """
+    arguments = get_request_arguments()
+    if offset:
+        arguments['headers']['Range'] = 'bytes={0}-'.format(offset)
+        if state['validator']:
+            arguments['headers']['If-Range'] = state['validator']
+    arguments['headers']['Accept-Encoding'] = \
+        'gzip' if compress and not offset else 'identity'
+    for url in [state['url']] if state['url'] else \
+            get_resource_urls(state['resource']):
+        response = requests.get(url, stream=True, **arguments)
+        if response.status_code == 404 and not state['url']:
+            response.close()
+            continue
+        if response.status_code >= 500:
+            # Errors of the server are transient, the request is retried.
+            response.close()
+            response.raise_for_status()
+        if response.status_code not in (200, 206, 416):
+            response.close()
+            raise TransferError('{0}: {1} {2}'.format(
+                url, response.status_code, response.reason))
+        state['url'] = url
+        return response
+    raise TransferError('Resource not found: {0}'.format(state['resource']))
+
+
+def write_response(response, partial_path, state_path, state, offset,
+                   digest):
+    """
+    Write the body of the response to the partial file from the offset on,
+    saving the state after each completed chunk.
+
+    :return: Offset after the last written chunk
+    """
+    chunk_size = state['chunk_size']
+    buffered = bytearray()
+    with open(partial_path, 'r+b' if offset else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        for data in response.iter_content(READ_SIZE):
+            buffered.extend(data)
+            while len(buffered) >= chunk_size:
+                chunk = bytes(buffered[:chunk_size])
+                del buffered[:chunk_size]
+                f.write(chunk)
+                f.flush()
+                digest.update(chunk)
+                state['chunks'].append(hashlib.sha256(chunk).hexdigest())
+                offset += len(chunk)
+                save_state(state_path, state)
+        if buffered and (state['size'] is None or
+                         offset + len(buffered) == state['size']):
+            # The last chunk is shorter. If the size is unknown, the
+            # response was complete, since reading it didn't fail.
+            chunk = bytes(buffered)
+            f.write(chunk)
+            digest.update(chunk)
+            state['chunks'].append(hashlib.sha256(chunk).hexdigest())
+            offset += len(chunk)
+            save_state(state_path, state)
+    return offset
+
+
+def transfer_once(partial_path, state_path, state, offset, digest,
+                  compress):
+    """
+    Make a single request for the rest of the resource.
+
+    :return: Tuple (offset, digest) after the request
+    """
+    response = request_resource(state, offset, compress)
+    try:
+        if response.status_code == 416:
+            _, state['size'] = _parse_content_range(response)
+            if offset != state['size']:
+                raise TransferError('Requested range not satisfiable.')
+            return offset, digest
+        if response.status_code == 200:
+            # The server ignored the range or the resource changed, so the
+            # transfer starts over.
+            if offset:
+                ctx.logger.debug('Restarting the download of {0}'.format(
+                    state['resource']))
+            offset = 0
+            digest = hashlib.sha256()
+            del state['chunks'][:]
+            state['size'] = None \
+                if response.headers.get('Content-Encoding', 'identity') \
+                != 'identity' else \
+                int(response.headers.get('Content-Length', 0)) or None
+        else:
+            first_byte, state['size'] = _parse_content_range(response)
+            if first_byte != offset:
+                raise TransferError('Unexpected Content-Range: {0}'.format(
+                    response.headers['Content-Range']))
+        state['validator'] = response.headers.get('ETag') or \
+            response.headers.get('Last-Modified')
+        offset = write_response(
+            response, partial_path, state_path, state, offset, digest)
+        if state['size'] is None:
+            state['size'] = offset
+            save_state(state_path, state)
+        return offset, digest
+    finally:
+        response.close()
+
+
+def download_resource(resource_path, target_path, settings=None):
+    """
+    Download a resource in chunks, resuming a previous partial download.
+
+    :param settings: Dict with keys: chunk_size, retries (number of
+        retries of failed requests within the call), compress (accept a gzip
+        encoded response for resources, which are not compressed already),
+        checksums (dict mapping resource paths to their expected SHA-256)
+        and directory (of the partial files)
+    :return: SHA-256 of the resource
+    :raises: TransferInterrupted if the resource wasn't downloaded
+        completely, but the partial file was kept, TransferError if the
+        resource can't be downloaded or its checksum doesn't match.
+    """
+    settings = settings or {}
+    chunk_size = settings.get('chunk_size', DEFAULT_CHUNK_SIZE)
+    retries = settings.get('retries', DEFAULT_RETRIES)
+    compress = settings.get('compress', False) and not \
+        resource_path.lower().endswith(COMPRESSED_EXTENSIONS)
+    expected_checksum = settings.get('checksums', {}).get(resource_path)
+    partial_directory = settings.get('directory') or \
+        DEFAULT_PARTIAL_DIRECTORY
+    _makedirs(partial_directory)
+    partial_path = get_partial_path(partial_directory, resource_path)
+    state_path = partial_path + STATE_SUFFIX
+
+    digest = hashlib.sha256()
+    state = load_state(state_path)
+    if state and state.get('resource') == resource_path and \
+            state.get('chunk_size') == chunk_size:
+        offset = verify_chunks(partial_path, state, digest)
+        ctx.logger.debug('Resuming the download of {0} at {1} bytes.'.format(
+            resource_path, offset))
+    else:
+        offset = 0
+        state = {
+            'resource': resource_path,
+            'chunk_size': chunk_size,
+            'chunks': [],
+            'size': None,
+            'url': None,
+            'validator': None
+        }
+
+    attempt = 0
+    while state['size'] is None or offset < state['size']:
+        try:
+            offset, digest = transfer_once(
+                partial_path, state_path, state, offset, digest, compress)
+        except TransferError:
+            remove_partial(partial_path)
+            raise
+        except (requests.RequestException, IOError) as e:
+            error = e
+        else:
+            if offset >= state['size']:
+                break
+            error = 'The response ended early.'
+        attempt += 1
+        if attempt > retries:
+            raise TransferInterrupted(
+                'Interrupted at {0} of {1} bytes: {2}'.format(
+                    offset, state['size'] or 'unknown', error))
+        ctx.logger.debug('Download of {0} failed, retrying: {1}'.format(
+            resource_path, error))
+        time.sleep(RETRY_INTERVAL * attempt)
+
+    checksum = digest.hexdigest()
+    if expected_checksum and checksum != expected_checksum.lower():
+        remove_partial(partial_path)
+        raise TransferError('Checksum mismatch: expected {0}, got {1}'.format(
+            expected_checksum, checksum))
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+    shutil.move(partial_path, target_path)
+    remove_partial(partial_path)
+    return checksum
@@ -0,0 +1,357 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Persistent worker, which runs scripts in a prepared environment.
+#
+# The worker is a long-lived process started by the first operation, which
+# uses it, and listening on a Unix socket. On start it sources the prepare
+# script once (e.g. activating a virtualenv or initializing kubectl) and
+# keeps the resulting environment. Each request runs file_to_source in its
+# own bash process with its own working directory and environment overrides
+# applied on top of the prepared environment. The worker exits after
+# idle_timeout seconds without requests.
+#
+# The protocol consists of JSON documents, one per line. The client sends
+# a request and the worker answers with {"started": pid}, any number of
+# {"stream": "Out" | "Err", "lines": [...]} and finally {"returncode": ...,
+# "timed_out": ..., "stderr": ...}, or with {"error": ...} if the script
+# couldn't be started.
+#
+# Usage: python -m exec_plugin.worker SOCKET_PATH IDLE_TIMEOUT [PREPARE]
+
+import os
+import sys
+import json
+import stat
+import time
+import errno
+import fcntl
+import signal
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+
+WORKER_DIRECTORY = os.path.join(
+    tempfile.gettempdir(), 'cloudify-exec-workers')
+DEFAULT_IDLE_TIMEOUT = 600
+START_TIMEOUT = 10
+ACCEPT_INTERVAL = 1.0
+# PYTHONPATH of the operation, which started the worker. The worker itself
+# runs with the plugin prepended to it, which the scripts must not inherit.
+ORIGINAL_PYTHONPATH = 'EXEC_WORKER_ORIGINAL_PYTHONPATH'
+
+logger = logging.getLogger('exec_plugin.worker')
+
+
+class WorkerUnavailable(Exception):
+    """ The script was not run by the worker and can run without it. """
+
+
+def get_socket_path(tenant_name, deployment_id, prepare_path=None):
+    """
+    :return: Path of the socket of the worker of a deployment. Workers of
+        deployments of different tenants and workers with a different
+        prepare script (or a different version of it) don't share the
+        socket.
+    """
+    digest = hashlib.sha1(
+        '{0}\0{1}'.format(tenant_name or '', deployment_id or ''))
+    if prepare_path:
+        digest.update(os.path.abspath(prepare_path))
+        with open(prepare_path, 'rb') as f:
+            digest.update(f.read())
+    return os.path.join(
+        WORKER_DIRECTORY, '{0}.sock'.format(digest.hexdigest()[:16]))
+
+
+def _send(connection, message):
+    connection.sendall(json.dumps(message) + '\n')
+
+
+# Server side.
+
+def load_prepared_environment(prepare_path):
+    """
+    Source the prepare script in bash and return the environment it leaves.
+    """
+    if not prepare_path:
+        return os.environ.copy()
+    output = subprocess.check_output(
+        ['bash', '-c', 'source "$0" >&2 && env -0', prepare_path],
+        cwd=os.path.dirname(os.path.abspath(prepare_path)))
+    return dict(
+        variable.split('=', 1) for variable in output.split('\0')
+        if '=' in variable)
+
+
+def run_request(connection, request, prepared_env):
+    # The tasks module imports this one, so it is imported lazily.
+    from . import tasks
+
+    subprocess_args = {
+        'args': [
+            'bash', '-c', 'source {0}'.format(request['file_to_source'])],
+        'stdin': subprocess.PIPE,
+        'stdout': subprocess.PIPE,
+        'stderr': subprocess.PIPE,
+        'cwd': request['cwd'],
+        'env': prepared_env,
+        'preexec_fn': tasks.get_preexec_fn(
+            request.get('resource_limits') or {})
+    }
+    tasks.handle_overrides(
+        request.get('overrides') or {}, subprocess_args, prepared_env,
+        request.get('environment'))
+    try:
+        process = subprocess.Popen(**subprocess_args)
+    except OSError as e:
+        _send(connection, {'error': str(e)})
+        return
+    _send(connection, {'started': process.pid})
+
+    finished = timed_out = None
+    if request.get('timeout'):
+        finished, timed_out = tasks.start_watchdog(
+            process, request['timeout'],
+            request.get('kill_timeout', tasks.DEFAULT_KILL_TIMEOUT),
+            logger)
+    try:
+        err = tasks.stream_process_output(
+            process,
+            emit=lambda name, lines: _send(connection, {
+                'stream': name,
+                'lines': [line.decode('utf-8', 'replace') for line in lines]
+            }))
+    except socket.error:
+        # The client is gone, so there is nobody to report to.
+        tasks.kill_process_group(process, signal.SIGKILL)
+        process.wait()
+        raise
+    finally:
+        if finished:
+            finished.set()
+    _send(connection, {
+        'returncode': process.returncode,
+        'timed_out': bool(timed_out and timed_out.is_set()),
+        'stderr': err.decode('utf-8', 'replace')
+    })
+
+
+def handle_connection(connection, prepared_env, state):
+    try:
+        request = json.loads(connection.makefile('rb').readline())
+        run_request(connection, request, prepared_env)
+    except Exception:
+        logger.exception('Request failed.')
+    finally:
+        connection.close()
+        with state['lock']:
+            state['active'] -= 1
+            state['last_activity'] = time.time()
+
+
+def serve(socket_path, idle_timeout, prepare_path=None):
+    # Only one worker serves a socket. The lock is held until the worker
+    # exits, so a socket file left without the lock is stale.
+    lock_file = open(socket_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        logger.info('Another worker is serving %s.', socket_path)
+        return
+    prepared_env = load_prepared_environment(prepare_path)
+    try:
+        os.remove(socket_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    os.chmod(socket_path, 0600)
+    server.listen(16)
+    server.settimeout(ACCEPT_INTERVAL)
+    state = {
+        'lock': threading.Lock(),
+        'active': 0,
+        'last_activity': time.time()
+    }
+    logger.info('Worker serving %s.', socket_path)
+    try:
+        while True:
+            try:
+                connection, _ = server.accept()
+            except socket.timeout:
+                with state['lock']:
+                    if not state['active'] and time.time() - \
+                            state['last_activity'] > idle_timeout:
+                        break
+                continue
+            connection.settimeout(None)
+            with state['lock']:
+                state['active'] += 1
+            handler = threading.Thread(
+                target=handle_connection,
+                args=(connection, prepared_env, state))
+            handler.daemon = True
+            handler.start()
+    finally:
+        os.remove(socket_path)
+        server.close()
+        lock_file.close()
+    logger.info('Worker idle for %s seconds, exiting.', idle_timeout)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    os.environ.pop('PYTHONPATH', None)
+    if ORIGINAL_PYTHONPATH in os.environ:
+        os.environ['PYTHONPATH'] = os.environ.pop(ORIGINAL_PYTHONPATH)
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    serve(argv[0], float(argv[1]), argv[2] if len(argv) > 2 else None)
+
+
+# Client side.
+
+def connect(socket_path):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error:
+        client.close()
+        raise
+    return client
+
+
+def ensure_worker_directory(directory):
+    """
+    Create the directory of the sockets accessible only to the current user.
+
+    :raises: WorkerUnavailable if the directory exists and belongs to
+        another user or isn't a directory
+    """
+    try:
+        os.makedirs(directory, 0700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise WorkerUnavailable(str(e))
+    # The directory is in a world writable location, so it might have been
+    # created by anybody.
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode) or \
+            directory_stat.st_uid != os.getuid():
+        raise WorkerUnavailable(
+            '{0} is not a directory owned by the current user.'.format(
+                directory))
+    if stat.S_IMODE(directory_stat.st_mode) != 0700:
+        os.chmod(directory, 0700)
+
+
+def start_worker(socket_path, idle_timeout, prepare_path=None):
+    """
+    Start a worker in the background and wait until it listens. The
+    directory of the socket is expected to be checked already (see
+    ensure_worker_directory).
+
+    :raises: WorkerUnavailable if it doesn't start within START_TIMEOUT
+    """
+    env = os.environ.copy()
+    if 'PYTHONPATH' in env:
+        env[ORIGINAL_PYTHONPATH] = env['PYTHONPATH']
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env.get('PYTHONPATH')]))
+    args = [sys.executable, '-m', 'exec_plugin.worker',
+            socket_path, str(idle_timeout)]
+    if prepare_path:
+        args.append(os.path.abspath(prepare_path))
+    with open(socket_path + '.log', 'a') as log:
+        process = subprocess.Popen(
+            args, stdin=open(os.devnull), stdout=log, stderr=log,
+            env=env, close_fds=True, preexec_fn=os.setsid)
+
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            return connect(socket_path)
+        except socket.error:
+            # The worker exits immediately, if another one holds the lock.
+            if process.poll() not in (None, 0):
+                raise WorkerUnavailable(
+                    'Worker exited with {0}, see {1}.log'.format(
+                        process.returncode, socket_path))
+            time.sleep(0.05)
+    raise WorkerUnavailable('Worker did not start in {0} seconds.'.format(
+        START_TIMEOUT))
+
+
+def get_connection(socket_path, idle_timeout, prepare_path=None):
+    ensure_worker_directory(os.path.dirname(socket_path))
+    try:
+        return connect(socket_path)
+    except socket.error:
+        return start_worker(socket_path, idle_timeout, prepare_path)
+
+
+def run_in_worker(socket_path, request, on_output, idle_timeout,
+                  prepare_path=None):
+    """
+    Run a script in the worker, starting it if necessary.
+
+    :param request: Dict with keys: file_to_source, cwd, overrides,
+        environment, timeout, kill_timeout and resource_limits
+    :param on_output: Function called with the name of the pipe and a list
+        of lines
+    :return: Tuple (returncode, err, timed_out)
+    :raises: WorkerUnavailable if the script wasn't started or the worker
+        died while running it, so that it can be run without the worker
+    """
+    connection = get_connection(socket_path, idle_timeout, prepare_path)
+    try:
+        try:
+            _send(connection, request)
+            responses = connection.makefile('rb')
+            response = json.loads(responses.readline() or 'null')
+        except (socket.error, TypeError, ValueError) as e:
+            raise WorkerUnavailable(str(e))
+        if not response or 'started' not in response:
+            raise WorkerUnavailable(
+                (response or {}).get('error', 'No response from worker.'))
+        try:
+            for line in iter(responses.readline, b''):
+                response = json.loads(line)
+                if 'stream' in response:
+                    on_output(
+                        str(response['stream']),
+                        [line.encode('utf-8') for line in response['lines']])
+                else:
+                    return (response['returncode'],
+                            response['stderr'].encode('utf-8'),
+                            response['timed_out'])
+        except (IOError, socket.error, ValueError) as e:
+            raise WorkerUnavailable(
+                'Worker died while running the script: {0}'.format(e))
+        raise WorkerUnavailable(
+            'Worker closed the connection of a running script.')
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
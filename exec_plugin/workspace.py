@@ -0,0 +1,247 @@
+#########
+# Copyright (c) 2018 Cloudify Platform Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#  * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  * See the License for the specific language governing permissions and
+#  * limitations under the License.
+
+# Managed workspaces (working directories) of operations.
+#
+# Workspaces are created under a known root as <root>/<name>, next to
+# a metadata file <root>/<name>.json naming the deployment and the node
+# instance, which own them. An operation holds a shared lock of the
+# metadata file while it uses the workspace and touches it, so its
+# modification time is the time of the last use. The garbage collection
+# takes an exclusive lock before removing a workspace, so it never removes
+# one in use. It runs at the start of operations, at most once per
+# interval, and removes workspaces, which were not used for max_age
+# seconds, and then the least recently used ones, while all of them take
+# more than max_total_size bytes. Both are opt-in, since scripts may keep
+# state in their working directory between operations (e.g. terraform or
+# helm state), which an idle node instance still needs. Stale files, like
+# partial downloads, are removed after DEFAULT_STALE_AGE seconds.
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import tempfile
+
+DEFAULT_WORKSPACE_ROOT = os.path.join(
+    tempfile.gettempdir(), 'cloudify-exec-workspaces')
+DEFAULT_STALE_AGE = 7 * 24 * 60 * 60
+DEFAULT_GC_INTERVAL = 60 * 60
+METADATA_SUFFIX = '.json'
+GC_STAMP = '.gc'
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def create_workspace(root, deployment_id, instance_id, kind='work'):
+    """
+    :param kind: Prefix of the name of the workspace, e.g. work or batch
+    :return: Path of a new workspace
+    """
+    _makedirs(root)
+    path = tempfile.mkdtemp(dir=root, prefix='{0}-'.format(kind))
+    with open(path + METADATA_SUFFIX, 'w') as f:
+        json.dump({
+            'deployment_id': deployment_id,
+            'instance_id': instance_id,
+            'kind': kind,
+            'created': time.time()
+        }, f)
+    return path
+
+
+def lock_workspace(path):
+    """
+    Mark a workspace as used and hold a shared lock of it, so that it isn't
+    removed by the garbage collection.
+
+    :return: Lock to release with unlock_workspace or None, if the
+        directory is not a managed workspace
+    """
+    try:
+        lock = open(path + METADATA_SUFFIX)
+    except IOError:
+        return None
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    os.utime(lock.name, None)
+    return lock
+
+
+def unlock_workspace(lock):
+    if lock:
+        os.utime(lock.name, None)
+        lock.close()
+
+
+def remove_workspace(path):
+    """
+    Remove a workspace, unless it is in use.
+
+    :return: True if it was removed
+    """
+    try:
+        lock = open(path + METADATA_SUFFIX)
+    except IOError:
+        return False
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        os.remove(lock.name)
+    return True
+
+
+def list_workspaces(root):
+    """
+    :return: List of tuples (path, metadata, time of the last use)
+    """
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return []
+    workspaces = []
+    for name in names:
+        if not name.endswith(METADATA_SUFFIX):
+            continue
+        metadata_path = os.path.join(root, name)
+        try:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            last_used = os.path.getmtime(metadata_path)
+        except (IOError, OSError, ValueError):
+            continue
+        workspaces.append((
+            metadata_path[:-len(METADATA_SUFFIX)], metadata, last_used))
+    return workspaces
+
+
+def get_usage(path):
+    """
+    :return: Dict with the number of bytes allocated by the files in a
+        directory tree (hard links are counted once) and the number of files
+    """
+    allocated = files = 0
+    inodes = set()
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(directory, filename))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) in inodes:
+                continue
+            inodes.add((stat.st_dev, stat.st_ino))
+            allocated += stat.st_blocks * 512
+            files += 1
+    return {'bytes': allocated, 'files': files}
+
+
+def remove_stale_files(directory, max_age):
+    """
+    Remove files directly in a directory, which were not modified for
+    max_age seconds, e.g. partial downloads, which were never resumed.
+
+    :return: Number of removed bytes
+    """
+    removed = 0
+    deadline = time.time() - max_age
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat = os.lstat(path)
+            if stat.st_mtime < deadline and os.path.isfile(path):
+                os.remove(path)
+                removed += stat.st_size
+        except OSError:
+            continue
+    return removed
+
+
+def collect_garbage(root,
+                    max_age=None,
+                    max_total_size=None,
+                    stale_directories=(),
+                    stale_age=DEFAULT_STALE_AGE):
+    """
+    Remove workspaces, which are not in use, if they were not used for
+    max_age seconds, or if all of the workspaces take more than
+    max_total_size bytes (the least recently used ones first). No
+    workspace is removed, unless either of them is set. Files in
+    stale_directories older than stale_age are removed too.
+
+    :return: Dict with the number of removed workspaces and of reclaimed
+        bytes
+    """
+    now = time.time()
+    removed = reclaimed = 0
+    workspaces = sorted(
+        list_workspaces(root), key=lambda workspace: workspace[2])
+    usage = {}
+    if max_total_size is not None:
+        for path, _, _ in workspaces:
+            usage[path] = get_usage(path)['bytes']
+    total_size = sum(usage.values())
+    for path, _, last_used in workspaces:
+        expired = max_age is not None and now - last_used > max_age
+        oversized = max_total_size is not None and total_size > max_total_size
+        if not expired and not oversized:
+            continue
+        size = usage[path] if path in usage else get_usage(path)['bytes']
+        if remove_workspace(path):
+            removed += 1
+            reclaimed += size
+            total_size -= size
+    for directory in stale_directories:
+        reclaimed += remove_stale_files(directory, stale_age)
+    return {'workspaces': removed, 'bytes': reclaimed}
+
+
+def collect_garbage_if_due(root,
+                           interval=DEFAULT_GC_INTERVAL,
+                           **kwargs):
+    """
+    Run collect_garbage, unless it ran in the last interval seconds or it
+    is running in another operation.
+
+    :return: Result of collect_garbage or None, if it didn't run
+    """
+    stamp_path = os.path.join(root, GC_STAMP)
+    try:
+        if time.time() - os.path.getmtime(stamp_path) < interval:
+            return None
+    except OSError:
+        pass
+    _makedirs(root)
+    with open(stamp_path, 'a') as stamp:
+        try:
+            fcntl.flock(stamp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return None
+        os.utime(stamp_path, None)
+        return collect_garbage(root, **kwargs)